@@ -0,0 +1,19 @@
+"""
+Benchmarks of the hot paths: RPC handling, pose updates, I2C traffic,
+allocations and boot time.
+
+On the board, from the REPL:
+
+    import bench
+    bench.main()
+
+prints the results as a single line of JSON. On the host tools/bench.py runs
+the suite against the simulated hardware and compares results.
+"""
+from .suite import run
+
+
+def main(robot_name: str = "21-dof-humanoid", iterations: int = 200):
+    import json
+
+    print(json.dumps(run(robot_name, iterations)))
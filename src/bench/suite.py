@@ -0,0 +1,346 @@
+import gc
+import os
+import sys
+import json
+import time
+import ustruct
+from core.robot import Robot
+from core.framework import RobotFramework, CONFIG_PATH
+from core.networking import (
+    RobotServerClient,
+    BINARY_HEADER,
+    BINARY_HEADER_SIZE,
+    BINARY_JOINT,
+    BINARY_JOINT_SIZE,
+    BINARY_SET_JOINTS,
+    BINARY_GET_JOINTS,
+)
+from libs.websockets.ws_connection import OP_TEXT, OP_BINARY
+
+# Allocations are counted with the garbage collector disabled, keep the number
+# of iterations small so the heap of the board does not run out
+ALLOC_ITERATIONS = 20
+
+# Timings are the best of a few runs, which filters out interrupts and
+# collections on the board and scheduling noise on the host
+TIME_REPEATS = 5
+
+# The two poses the pose benchmarks alternate between, so every iteration
+# changes every servo
+POSE_ANGLES = (80, 100)
+
+
+class LoopbackConnection:
+    """Connection that answers reads with the given messages in turn and keeps
+    the last written message, lets RobotServerClient.process run without a
+    socket"""
+
+    def __init__(self, messages: tuple, opcode: int):
+        self.messages = messages
+        self.opcode = opcode
+        self.client_close = False
+        self.last_write = None
+        self._next = 0
+
+    async def read(self):
+        message = self.messages[self._next]
+        self._next = (self._next + 1) % len(self.messages)
+        return message
+
+    async def write(self, msg, opcode=None):
+        self.last_write = msg
+
+    def is_closed(self):
+        return False
+
+    def close(self):
+        pass
+
+
+class CountingI2C:
+    """Wraps an I2C bus and counts the transactions and bytes sent over it"""
+
+    def __init__(self, i2c):
+        self.i2c = i2c
+        self.transactions = 0
+        self.bytes = 0
+
+    def writeto_mem(self, addr, memaddr, buf):
+        self.transactions += 1
+        self.bytes += 1 + len(buf)
+        self.i2c.writeto_mem(addr, memaddr, buf)
+
+    def readfrom_mem(self, addr, memaddr, nbytes):
+        self.transactions += 1
+        self.bytes += 1 + nbytes
+        return self.i2c.readfrom_mem(addr, memaddr, nbytes)
+
+    def readfrom_mem_into(self, addr, memaddr, buf):
+        self.transactions += 1
+        self.bytes += 1 + len(buf)
+        self.i2c.readfrom_mem_into(addr, memaddr, buf)
+
+
+class BusCounters:
+    """The totals of the CountingI2C of every bus"""
+
+    def __init__(self, counters: list):
+        self.counters = counters
+
+    @property
+    def transactions(self):
+        return sum(counter.transactions for counter in self.counters)
+
+    @property
+    def bytes(self):
+        return sum(counter.bytes for counter in self.counters)
+
+    def reset(self):
+        for counter in self.counters:
+            counter.transactions = 0
+            counter.bytes = 0
+
+
+def run_sync(coro):
+    """Run a coroutine that never suspends, avoids the event loop overhead"""
+    try:
+        coro.send(None)
+    except StopIteration as e:
+        return e.value
+    raise RuntimeError("benchmark coroutine suspended")
+
+
+def time_per_op(op, iterations: int):
+    """Average time of op in microseconds, the best of TIME_REPEATS runs"""
+    for _ in range(iterations // 10):
+        op()  # warm up caches
+    best = None
+    for _ in range(TIME_REPEATS):
+        gc.collect()
+        start = time.ticks_us()
+        for _ in range(iterations):
+            op()
+        elapsed = time.ticks_diff(time.ticks_us(), start)
+        if best is None or elapsed < best:
+            best = elapsed
+    return best / iterations
+
+
+def alloc_per_op(op, iterations: int = ALLOC_ITERATIONS):
+    """Average bytes allocated by op.
+    MicroPython counts every allocation, CPython frees objects as soon as they
+    are unused so the growth of the peak traced memory is used instead.
+    Returns None when neither is available."""
+    if hasattr(gc, "mem_alloc"):
+        gc.collect()
+        gc.disable()
+        try:
+            start = gc.mem_alloc()
+            for _ in range(iterations):
+                op()
+            used = gc.mem_alloc() - start
+        finally:
+            gc.enable()
+        return used / iterations
+
+    try:
+        import tracemalloc
+    except ImportError:
+        return None
+    tracemalloc.start()
+    used = 0
+    try:
+        for _ in range(iterations):
+            tracemalloc.reset_peak()
+            start = tracemalloc.get_traced_memory()[0]
+            op()
+            used += tracemalloc.get_traced_memory()[1] - start
+    finally:
+        tracemalloc.stop()
+    return used / iterations
+
+
+def measure(op, iterations: int, counter: BusCounters = None):
+    us = time_per_op(op, iterations)
+    result = {
+        "us_per_op": us,
+        "ops_per_s": 1000000 / us if us else 0,
+        "alloc_bytes_per_op": alloc_per_op(op),
+    }
+    if counter is not None:
+        counter.reset()
+        op()
+        result["i2c_transactions_per_op"] = counter.transactions
+        result["i2c_bytes_per_op"] = counter.bytes
+    return result
+
+
+def bench_boot(robot_name: str, iterations: int):
+    """Robot.from_config with and without the compiled model cache"""
+    try:
+        os.remove(f"config/robots/{robot_name}.model")
+    except OSError:
+        pass
+    start = time.ticks_us()
+    Robot.from_config(robot_name)
+    cold = time.ticks_diff(time.ticks_us(), start)
+
+    robot = None
+    start = time.ticks_us()
+    for _ in range(iterations):
+        robot = Robot.from_config(robot_name)
+    warm = time.ticks_diff(time.ticks_us(), start) / iterations
+    return robot, {"cold_us": cold, "warm_us": warm}
+
+
+class PoseOps:
+    """Ops that move every joint to the other of the two POSE_ANGLES"""
+
+    def __init__(self, robot: Robot):
+        self.robot = robot
+        self.side = 0
+        self.poses = [
+            {name: angle for name in robot.joint_names} for angle in POSE_ANGLES
+        ]
+        duties = []
+        for angle in POSE_ANGLES:
+            duties.append(
+                [joint.servo._angle_to_duty(angle) for joint in robot.joint_list]
+            )
+        self.duties = duties
+
+    def joint_angle(self):
+        self.side ^= 1
+        angle = POSE_ANGLES[self.side]
+        for joint in self.robot.joint_list:
+            joint.angle = angle
+
+    def servo_duty(self):
+        self.side ^= 1
+        duties = self.duties[self.side]
+        joints = self.robot.joint_list
+        for i in range(len(joints)):
+            joints[i].servo.duty(duties[i])
+
+    def apply_pose(self):
+        self.side ^= 1
+        self.robot.apply_pose(self.poses[self.side])
+
+
+class RpcOps:
+    """RobotServerClient.process on a loopback connection, for every message"""
+
+    def __init__(self, framework: RobotFramework, commands: dict, binary: dict):
+        self.framework = framework
+        self.commands = commands
+        self.binary_commands = binary
+
+    def client(self, messages: tuple, opcode: int):
+        client = RobotServerClient(
+            LoopbackConnection(messages, opcode), self.commands, self.binary_commands
+        )
+
+        def op():
+            run_sync(client.process())
+
+        return op
+
+    def json(self, method: str, *params_list):
+        """Op sending a JSON request, cycling through the given params"""
+        messages = []
+        for params in params_list or (None,):
+            request = {"method": method, "id": 1}
+            if params is not None:
+                request["params"] = params
+            messages.append(json.dumps(request).encode("utf-8"))
+        return self.client(tuple(messages), OP_TEXT)
+
+    def binary(self, method_id: int, *angles):
+        """Op sending a binary request for every joint, cycling through the
+        given angles in tenths of a degree. Without angles the request has no
+        joints."""
+        count = len(self.framework.robot.joint_list) if angles else 0
+        messages = []
+        for angle in angles or (0,):
+            message = bytearray(BINARY_HEADER_SIZE + BINARY_JOINT_SIZE * count)
+            ustruct.pack_into(BINARY_HEADER, message, 0, method_id, 1, count)
+            offset = BINARY_HEADER_SIZE
+            for index in range(count):
+                ustruct.pack_into(BINARY_JOINT, message, offset, index, angle)
+                offset += BINARY_JOINT_SIZE
+            messages.append(bytes(message))
+        return self.client(tuple(messages), OP_BINARY)
+
+
+def count_i2c(robot: Robot):
+    """Route the PCA9685 boards through a CountingI2C per bus"""
+    if not robot.boards:
+        return None
+    counters = []
+    for board in robot.boards:
+        if not isinstance(board.i2c, CountingI2C):
+            counter = None
+            for existing in counters:
+                if existing.i2c is board.i2c:
+                    counter = existing
+            if counter is None:
+                counter = CountingI2C(board.i2c)
+                counters.append(counter)
+            board.i2c = counter
+        elif board.i2c not in counters:
+            counters.append(board.i2c)
+    return BusCounters(counters)
+
+
+def run(
+    robot_name: str = "21-dof-humanoid",
+    iterations: int = 200,
+    config_path: str = CONFIG_PATH,
+):
+    """Run every benchmark, returns the results as a dict"""
+    results = {}
+    robot, results["boot"] = bench_boot(robot_name, max(1, iterations // 50))
+    counter = count_i2c(robot)
+
+    pose = PoseOps(robot)
+    results["pose_joint_angle"] = measure(pose.joint_angle, iterations, counter)
+    results["pose_servo_duty"] = measure(pose.servo_duty, iterations, counter)
+    results["pose_apply"] = measure(pose.apply_pose, iterations, counter)
+
+    framework = RobotFramework(robot, web_server=False, config_path=config_path)
+    rpc = RpcOps(
+        framework,
+        {
+            "ping": framework.ping,
+            "set_joints": framework.set_joints,
+            "get_joints": framework.get_joints,
+        },
+        {
+            BINARY_SET_JOINTS: framework.binary_set_joints,
+            BINARY_GET_JOINTS: framework.binary_get_joints,
+        },
+    )
+    results["rpc_ping"] = measure(rpc.json("ping"), iterations)
+    results["rpc_set_joints"] = measure(
+        rpc.json("set_joints", {"joints": pose.poses[0]}, {"joints": pose.poses[1]}),
+        iterations,
+        counter,
+    )
+    results["rpc_get_joints"] = measure(rpc.json("get_joints"), iterations)
+    results["rpc_binary_set_joints"] = measure(
+        rpc.binary(BINARY_SET_JOINTS, 10 * POSE_ANGLES[0], 10 * POSE_ANGLES[1]),
+        iterations,
+        counter,
+    )
+    results["rpc_binary_get_joints"] = measure(
+        rpc.binary(BINARY_GET_JOINTS), iterations
+    )
+
+    return {
+        "platform": sys.platform,
+        "implementation": sys.implementation.name,
+        "robot": robot_name,
+        "joints": len(robot.joint_list),
+        "iterations": iterations,
+        "results": results,
+    }
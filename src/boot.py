@@ -1 +1,6 @@
-# boot.py - - runs on boot-up
\ No newline at end of file
+# boot.py - - runs on boot-up
+
+# Uncomment to compile with __debug__ False, debug log calls are then left out
+# or return straight away, see libs/logging
+# import micropython
+# micropython.opt_level(1)
@@ -0,0 +1,167 @@
+import time
+import ustruct
+from array import array
+from .keyframes import (
+    HOLD,
+    ANIMATION_MAGIC,
+    ANIMATION_VERSION,
+    ANIMATION_HEADER,
+    ANIMATION_HEADER_SIZE,
+)
+from .robot import Robot
+
+NO_JOINT = 255  # animation column without a matching robot joint
+
+
+class AnimationPlayer:
+    """
+    Streams an animation file from flash to the servos at the control rate.
+    Frames are read ahead into a ring buffer of buffer_frames frames, so the
+    memory used does not depend on the length of the animation. The file
+    format is described in core.keyframes, files are made on the host with
+    tools/anim_convert.py.
+    tick() stages the angles of the current frame, the caller flushes the robot.
+    """
+
+    def __init__(self, robot: Robot, buffer_frames: int = 8):
+        self.robot = robot
+        self.buffer_frames = buffer_frames
+        self._file = None
+        self._name = None
+        self._fps = 0
+        self._frame_count = 0
+        self._joint_count = 0
+        self._data_offset = 0
+        self._columns = None  # animation column -> robot joint index
+        self._ring = None  # array("h"), frame n lives in slot n % buffer_frames
+        self._slots = None  # writable memoryview per ring slot
+        self._head = 0  # first buffered frame
+        self._count = 0  # number of buffered frames
+        self._next_read = 0  # next frame to read from the file
+        self._start_ms = 0
+        self._frame = 0
+        self._underruns = 0
+
+    @property
+    def playing(self):
+        return self._file is not None
+
+    def play(self, path: str, name: str = None):
+        self.stop()
+        animation_file = open(path, "rb")
+        try:
+            header = animation_file.read(ANIMATION_HEADER_SIZE)
+            if len(header) < ANIMATION_HEADER_SIZE:
+                raise ValueError(f"{path} is not an animation")
+            magic, version, joint_count, fps, frame_count = ustruct.unpack(
+                ANIMATION_HEADER, header
+            )
+            if magic != ANIMATION_MAGIC or version != ANIMATION_VERSION:
+                raise ValueError(
+                    f"{path} is not a version {ANIMATION_VERSION} animation"
+                )
+            if not fps or not frame_count:
+                raise ValueError(f"{path} has no frames")
+
+            columns = bytearray(joint_count)
+            data_offset = ANIMATION_HEADER_SIZE
+            for column in range(joint_count):
+                length = animation_file.read(1)[0]
+                joint_name = animation_file.read(length).decode("utf-8")
+                data_offset += 1 + length
+                if joint_name in self.robot.joints:
+                    columns[column] = self.robot.joint_index(joint_name)
+                else:
+                    columns[column] = NO_JOINT
+        except Exception:
+            animation_file.close()
+            raise
+
+        if self._ring is None or len(self._ring) != self.buffer_frames * joint_count:
+            self._ring = array("h", bytearray(2 * self.buffer_frames * joint_count))
+            ring_view = memoryview(self._ring)
+            self._slots = [
+                ring_view[slot * joint_count : (slot + 1) * joint_count]
+                for slot in range(self.buffer_frames)
+            ]
+
+        self._file = animation_file
+        self._name = name or path
+        self._fps = fps
+        self._frame_count = frame_count
+        self._joint_count = joint_count
+        self._data_offset = data_offset
+        self._columns = columns
+        self._head = 0
+        self._count = 0
+        self._next_read = 0
+        self._frame = 0
+        self._underruns = 0
+        self._fill()
+        self._start_ms = time.ticks_ms()
+
+    def stop(self):
+        if self._file:
+            self._file.close()
+        self._file = None
+
+    def _fill(self):
+        """Read ahead until the ring buffer is full or the file ends"""
+        while (
+            self._count < self.buffer_frames
+            and self._head + self._count < self._frame_count
+        ):
+            frame = self._head + self._count
+            if frame != self._next_read:
+                self._file.seek(self._data_offset + 2 * self._joint_count * frame)
+            self._file.readinto(self._slots[frame % self.buffer_frames])
+            self._next_read = frame + 1
+            self._count += 1
+
+    def tick(self):
+        if self._file is None:
+            return
+
+        elapsed = time.ticks_diff(time.ticks_ms(), self._start_ms)
+        frame = elapsed * self._fps // 1000
+        finished = frame >= self._frame_count - 1
+        if finished:
+            frame = self._frame_count - 1
+
+        skip = frame - self._head
+        if skip >= self._count:
+            # Playback overtook the read ahead, drop the buffer and seek
+            if skip > self._count:
+                self._underruns += 1
+            self._count = 0
+        else:
+            self._count -= skip
+        self._head = frame
+        self._fill()
+        self._frame = frame
+
+        ring = self._ring
+        columns = self._columns
+        joints = self.robot.joint_list
+        base = (frame % self.buffer_frames) * self._joint_count
+        for column in range(self._joint_count):
+            joint_index = columns[column]
+            angle = ring[base + column]
+            if joint_index != NO_JOINT and angle != HOLD:
+                joints[joint_index].stage_angle(angle / 10)
+
+        if finished:
+            self.stop()
+
+    def status(self):
+        status = {"playing": self.playing, "underruns": self._underruns}
+        if self._name:
+            status.update(
+                {
+                    "name": self._name,
+                    "frame": self._frame,
+                    "frames": self._frame_count,
+                    "fps": self._fps,
+                }
+            )
+        return status
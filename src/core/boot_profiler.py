@@ -0,0 +1,44 @@
+import time
+
+
+class BootProfiler:
+    """
+    Timestamps the boot phases with time.ticks_us.
+    Each mark records the time since the profiler was created, it is imported
+    first by main.py so that is as close to power on as Python gets. The time
+    of a phase is the time since the previous mark, phases that overlap, such as
+    the network bring up running next to the control loop, are marked as they
+    finish.
+    """
+
+    def __init__(self):
+        self._start = time.ticks_us()
+        self._phases = []  # (name, us since start)
+
+    def mark(self, name: str):
+        """Record the end of a boot phase"""
+        self._phases.append((name, time.ticks_diff(time.ticks_us(), self._start)))
+
+    def elapsed_us(self, name: str):
+        """Time from boot to the end of a phase, None if it was not marked"""
+        for phase_name, at in self._phases:
+            if phase_name == name:
+                return at
+        return None
+
+    def report(self):
+        phases = []
+        last = 0
+        for name, at in self._phases:
+            phases.append({"name": name, "us": at - last, "at_us": at})
+            last = at
+        return {
+            # ticks_us starts at reset on MicroPython, this is the time spent
+            # before main.py ran
+            "start_us": self._start,
+            "phases": phases,
+            "total_us": last,
+        }
+
+
+boot_profiler = BootProfiler()
@@ -0,0 +1,87 @@
+import os
+import json
+import binascii
+from libs import logging
+
+_logger = logging.getLogger(name="config")
+
+
+def merge_patch(target, patch):
+    """Apply a JSON merge patch (RFC 7386), a None value removes the key"""
+    if not isinstance(patch, dict):
+        return patch
+    result = dict(target) if isinstance(target, dict) else {}
+    for key, value in patch.items():
+        if value is None:
+            result.pop(key, None)
+        else:
+            result[key] = merge_patch(result.get(key, None), value)
+    return result
+
+
+class ConfigFile:
+    """
+    A JSON config file read once. version is the crc32 of the file contents,
+    response the compact JSON answer of the config RPCs, made when the file is
+    read so answering is a copy of the string.
+    """
+
+    def __init__(self, path: str, source: bytes, data: dict = None):
+        self.path = path
+        self.version = "%08x" % binascii.crc32(source)
+        if data is None:
+            data = json.loads(source)
+        self._data = data
+        self.response = json.dumps({"version": self.version, "config": data})
+
+    @property
+    def data(self):
+        return self._data
+
+
+class ConfigService:
+    """
+    Caches the JSON config files by path. Writes go through the service so
+    the cache never serves a stale file, a file is written to <path>.tmp and
+    renamed over the old one so a power cut leaves either the old or the new
+    file.
+    """
+
+    def __init__(self):
+        self._files = {}
+
+    def get(self, path: str):
+        """The ConfigFile of path, read on first use"""
+        config_file = self._files.get(path, None)
+        if config_file is None:
+            with open(path, "rb") as source_file:
+                config_file = ConfigFile(path, source_file.read())
+            self._files[path] = config_file
+        return config_file
+
+    def data(self, path: str):
+        return self.get(path).data
+
+    def write(self, path: str, data: dict, version: str = None):
+        """Replace the config at path. With a version the write only happens
+        if the file is still at that version."""
+        if not isinstance(data, dict):
+            raise ValueError("a config must be an object")
+        if version is not None and self.get(path).version != version:
+            raise ValueError(
+                f"{path} changed, it is at version {self.get(path).version}"
+            )
+        source = json.dumps(data).encode("utf-8")
+        temp_path = path + ".tmp"
+        with open(temp_path, "wb") as temp_file:
+            temp_file.write(source)
+        try:
+            os.rename(temp_path, path)
+        except OSError:
+            # FAT does not rename over an existing file
+            os.remove(path)
+            os.rename(temp_path, path)
+        config_file = ConfigFile(path, source, data)
+        self._files[path] = config_file
+        _logger.info("wrote %s version %s", path, config_file.version)
+        return config_file
@@ -1,31 +1,98 @@
+import gc
+import json
+import time
 from libs import logging
-from core.networking import NetworkManager
+from core.networking import (
+    NetworkManager,
+    BINARY_SET_JOINTS,
+    BINARY_GET_JOINTS,
+    BINARY_ANGLE_NONE,
+    DEFAULT_LEASE_MS,
+    RawJson,
+)
+from core.boot_profiler import boot_profiler
+from core.metrics import Metrics
+from core.motion import MotionEngine
 from core.robot import Robot
-from core.util import load_json_config
+from core.scheduler import Scheduler
+from core.telemetry import Telemetry
+from core.config_service import ConfigService, merge_patch
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+CONFIG_PATH = "config/config.json"
+# Shipped example of config.json, used off the board
+EXAMPLE_CONFIG_PATH = "config/config.example.json"
+
+# Default rate in hertz and priority of the framework tasks,
+# the rates can be overridden with the tick_rates key of config.json
+DEFAULT_TASKS = {
+    "control": (50, 1),  # matches the servo PWM frequency
+    "gc": (1, 0),
+    "metrics": (1, 0),
+    "telemetry": (20, 0),  # also the highest rate a client can subscribe at
+}
 
 
 class RobotFramework:
     __robot: Robot = None
     __config: dict = None
+    __config_path: str = None
+    __configs: ConfigService = None
     __network_manager: NetworkManager = None
+    __scheduler: Scheduler = None
+    __metrics: Metrics = None
+    __telemetry: Telemetry = None
+    __motion: MotionEngine = None
+    __animation = None  # AnimationPlayer, created on first use
+    __kinematics = None  # Kinematics, created on first use
+    __ik = None  # IKSolver, created on first use
     __logger: logging.Logger = None
+    __log_buffer: logging.RingBufferHandler = None
 
-    def __init__(self, robot: Robot, web_server: bool = True):
+    def __init__(
+        self, robot: Robot, web_server: bool = True, config_path: str = CONFIG_PATH
+    ):
 
         self.__robot = robot
-        self.__config = load_json_config("config/config.json")
+        self.__motion = MotionEngine(robot)
+        self.__configs = ConfigService()
+        self.__config_path = config_path
+        self.__config = self.__configs.data(config_path)
+        boot_profiler.mark("framework_config")
 
-        logging.leveledConfig(self.config.get("log_level", "info"))
+        self.configure_logging()
         self.__logger = logging.getLogger(name="core-framework")
+        self.__metrics = Metrics(self.config.get("metrics_window_ms", 5000))
+        self.__flush_histogram = self.__metrics.histogram("i2c_flush_us")
+        self.__scheduler = Scheduler(metrics=self.__metrics)
 
         if web_server:
             network_config = self.config.get("network", None)
             if not network_config:
                 raise Exception("config.json must contain a network key")
 
-            self.__network_manager = NetworkManager(network_config)
-            self.__network_manager.start_ws_server()
+            profiler = None
+            if self.config.get("profile_rpc", False):
+                from core.rpc_profiler import RpcProfiler
+
+                profiler = RpcProfiler()
+            self.__network_manager = NetworkManager(network_config, profiler)
+            self.__network_manager.rpc_histogram = self.__metrics.histogram("rpc_us")
+            telemetry_rate = self.config.get("tick_rates", {}).get(
+                "telemetry", DEFAULT_TASKS["telemetry"][0]
+            )
+            self.__telemetry = Telemetry(telemetry_rate)
+            self.__telemetry.add_topic("joints", self.get_joints)
+            self.__telemetry.add_topic("metrics", self.get_metrics)
+            self.__telemetry.add_topic("motion", self.get_motion_status)
             self.register_rpc_commands()
+            boot_profiler.mark("network_init")
+
+        self.register_tasks()
 
     @property
     def config(self):
@@ -43,28 +110,478 @@ class RobotFramework:
     def network_manager(self):
         return self.__network_manager
 
+    @property
+    def scheduler(self):
+        return self.__scheduler
+
+    @property
+    def metrics(self):
+        return self.__metrics
+
+    @property
+    def telemetry(self):
+        return self.__telemetry
+
+    @property
+    def motion(self):
+        return self.__motion
+
+    @property
+    def animation(self):
+        if self.__animation is None:
+            # Most shows never stream an animation, keep it out of the boot path
+            from core.animation import AnimationPlayer
+
+            self.__animation = AnimationPlayer(self.robot)
+        return self.__animation
+
+    def configure_logging(self):
+        """Set the log levels and handlers from the config.
+        log_level is the default level, log_levels sets the level of single
+        loggers by name. The last log_buffer_size records are kept in memory
+        for get_logs, log_console false stops them being written to the
+        console as well, which blocks on the UART."""
+        logging.leveledConfig(self.config.get("log_level", "info"))
+        for name, level in self.config.get("log_levels", {}).items():
+            logging.getLogger(name).setLevel(logging.levelFromName(level))
+
+        handlers = []
+        capacity = self.config.get("log_buffer_size", 32)
+        if capacity:
+            self.__log_buffer = logging.RingBufferHandler(capacity)
+            handlers.append(self.__log_buffer)
+            if self.config.get("log_console", True):
+                handlers.append(logging.StreamHandler())
+        logging.setHandlers(handlers)
+
+    @property
+    def kinematics(self):
+        if self.__kinematics is None:
+            from core.kinematics import Kinematics
+
+            self.__kinematics = Kinematics(self.robot)
+        return self.__kinematics
+
+    @property
+    def ik(self):
+        if self.__ik is None:
+            from core.ik import IKSolver
+
+            self.__ik = IKSolver(
+                self.robot, self.config.get("ik_iterations_per_tick", 2)
+            )
+        return self.__ik
+
+    def register_tasks(self):
+        tick_rates = self.config.get("tick_rates", {})
+        callbacks = {
+            "control": self.control_tick,
+            "gc": gc.collect,
+            "metrics": self.metrics.tick,
+        }
+        if self.telemetry:
+            callbacks["telemetry"] = self.telemetry.tick
+        for name, callback in callbacks.items():
+            rate, priority = DEFAULT_TASKS[name]
+            self.scheduler.add(name, callback, tick_rates.get(name, rate), priority)
+
+    def control_tick(self):
+        if self.__animation and self.__animation.playing:
+            self.__animation.tick()
+        elif self.__ik and self.__ik.active:
+            self.__ik.tick()
+        else:
+            self.motion.tick()
+        start = time.ticks_us()
+        self.robot.flush()
+        self.__flush_histogram.record(time.ticks_diff(time.ticks_us(), start))
+
+    async def start_network(self):
+        await self.network_manager.wait_for_wifi()
+        boot_profiler.mark("wifi")
+        await self.network_manager.start_ws_server()
+        boot_profiler.mark("server")
+
+    async def push_metrics(self, interval_ms: int):
+        """Send the metrics to every client every interval_ms"""
+        while True:
+            await asyncio.sleep(interval_ms / 1000)
+            await self.network_manager.broadcast(
+                json.dumps({"type": "metrics", "payload": self.get_metrics()}),
+                "metrics",
+            )
+
+    async def main(self):
+        # The websocket server runs on the event loop, serving clients
+        # while the scheduler waits for its next deadline. The control loop
+        # starts straight away, the network comes up next to it.
+        if self.network_manager:
+            asyncio.create_task(self.start_network())
+            push_interval = self.config.get("metrics_push_ms", None)
+            if push_interval:
+                asyncio.create_task(self.push_metrics(push_interval))
+        boot_profiler.mark("control_ready")
+        await self.scheduler.run_async()
+
     def run_forever(self):
         try:
             # Main framework loop
-            # TODO: allow each componant to declare their tick rate
-            while True:
-                self.network_manager.tick()
+            asyncio.run(self.main())
         except KeyboardInterrupt:
             pass
         # Teardown
-        self.network_manager.stop_ws_server()
+        if self.network_manager:
+            self.network_manager.stop_ws_server()
         self.logger.info("framework shutdown")
 
     def ping(self):
         return "pong"
 
-    def get_config(self):
-        return self.config
-    
-    def get_robot_config(self):
-        return Robot.get_config(self.robot.name)
+    def _config_path(self, file: str):
+        if file == "config":
+            return self.__config_path
+        if file == "robot":
+            return f"config/robots/{self.robot.name}.json"
+        raise ValueError('file must be "config" or "robot"')
+
+    def _config_response(self, file: str, version: str = None):
+        config_file = self.__configs.get(self._config_path(file))
+        if version is not None and version == config_file.version:
+            return {"version": version, "not_modified": True}
+        return RawJson(config_file.response)
+
+    def _write_config(self, file: str, config: dict, version: str = None):
+        if file == "robot":
+            from core.model_compiler import compile_model
+
+            try:
+                compile_model(config)
+            except Exception as e:
+                raise ValueError(f"invalid robot config: {e}")
+        config_file = self.__configs.write(self._config_path(file), config, version)
+        return {"version": config_file.version}
+
+    def get_config(self, version: str = None):
+        """config.json and its version. Given the version the client has, the
+        answer is not_modified while the file is unchanged."""
+        return self._config_response("config", version)
+
+    def get_robot_config(self, version: str = None):
+        """The config of the robot and its version, see get_config"""
+        return self._config_response("robot", version)
+
+    def set_config(self, config: dict, file: str = "config", version: str = None):
+        """Replace config.json, or the robot config when file is robot. With a
+        version the write is refused if the file changed since. The settings
+        are read at boot, a new config is used after a restart."""
+        return self._write_config(file, config, version)
+
+    def patch_config(self, patch: dict, file: str = "config", version: str = None):
+        """Change part of a config with a JSON merge patch, null removes a key,
+        see set_config"""
+        if not isinstance(patch, dict):
+            raise ValueError("a config patch must be an object")
+        config = merge_patch(self.__configs.data(self._config_path(file)), patch)
+        return self._write_config(file, config, version)
+
+    def get_scheduler_stats(self):
+        return self.scheduler.stats()
+
+    def acquire_control(self, duration_ms: int = DEFAULT_LEASE_MS, client=None):
+        """Take or renew the control lease, while it is held only the holder
+        can move the robot. Call again before duration_ms to keep it."""
+        if not self.network_manager.lease.acquire(client, duration_ms):
+            raise ValueError("another client holds the control lease")
+        return self.network_manager.lease.status(client)
+
+    def release_control(self, client=None):
+        self.network_manager.lease.release(client)
+        return self.network_manager.lease.status(client)
+
+    def get_control(self, client=None):
+        return self.network_manager.lease.status(client)
+
+    def get_connections(self):
+        """Send queue counters of every connected client"""
+        return self.network_manager.connection_stats()
+
+    def get_metrics(self):
+        """Timing histograms of the last metrics window in microseconds:
+        <task>_us and <task>_late_us for every scheduler task, gc_us being the
+        collector pauses, i2c_flush_us for the servo writes and rpc_us for the
+        websocket messages"""
+        return self.metrics.report()
+
+    def get_rpc_profile(self):
+        """Calls, time in microseconds, errors and message sizes of every RPC
+        method, enabled with the profile_rpc config key"""
+        profiler = self.network_manager.profiler
+        return {
+            "enabled": profiler is not None,
+            "methods": profiler.report() if profiler else {},
+        }
+
+    def reset_rpc_profile(self):
+        profiler = self.network_manager.profiler
+        if profiler:
+            profiler.reset()
+        return self.get_rpc_profile()
+
+    def get_logs(self, level: str = "debug", limit: int = None):
+        """Recent log records at or above level, oldest first"""
+        if not self.__log_buffer:
+            return []
+        return self.__log_buffer.records(logging.levelFromName(level), limit)
+
+    def clear_logs(self):
+        if self.__log_buffer:
+            self.__log_buffer.clear()
+        return []
+
+    def get_boot_profile(self):
+        """Time spent in each boot phase in microseconds"""
+        return boot_profiler.report()
+
+    def set_joints(self, joints: dict):
+        """Move several joints together, joints maps joint names to angles.
+        Angles are limited to the joint range, the limited angles are returned."""
+        self.robot.apply_pose(joints)
+        applied = {}
+        for name, angle in joints.items():
+            applied[name] = self.robot.joints[name].clamp(angle)
+        return applied
+
+    def get_joints(self, names: list = None):
+        """Current angle of the named joints, or of every joint"""
+        if names is None:
+            names = self.robot.joint_names
+        angles = {}
+        for name in names:
+            joint = self.robot.joints.get(name, None)
+            if not joint:
+                raise ValueError(f"unknown joint {name}")
+            angles[name] = joint.angle
+        return angles
+
+    def subscribe(self, topic: str, rate_hz: float = 10, ack: bool = True, client=None):
+        """Push topic to the client at rate_hz, see core.telemetry.Subscription.
+        With ack the client confirms frames with ack_telemetry and the deltas
+        are relative to the last confirmed frame."""
+        subscription = self.telemetry.subscribe(client, topic, rate_hz, ack)
+        stats = subscription.stats()
+        stats["topic"] = topic
+        return stats
+
+    def unsubscribe(self, topic: str = None, client=None):
+        """Stop pushing topic to the client, or every topic"""
+        return {"unsubscribed": self.telemetry.unsubscribe(client, topic)}
+
+    def ack_telemetry(self, topic: str, sequence: int, client=None):
+        return {"acknowledged": self.telemetry.acknowledge(client, topic, sequence)}
+
+    def get_subscriptions(self, client=None):
+        return {
+            "topics": self.telemetry.topics,
+            "subscriptions": self.telemetry.stats(client),
+        }
+
+    def play_motion(self, keyframes: list, mode: str = "queue", blend_ms: int = 0):
+        """Play a keyframe trajectory, see core.motion.Trajectory for the format"""
+        if self.__animation:
+            self.__animation.stop()
+        if self.__ik:
+            self.__ik.cancel()
+        return self.motion.play(keyframes, mode, blend_ms)
+
+    def cancel_motion(self):
+        self.motion.cancel()
+        return self.motion.status()
+
+    def get_motion_status(self):
+        return self.motion.status()
+
+    def play_animation(self, name: str):
+        """Stream animations/<name>.anim, made with tools/anim_convert.py"""
+        self.motion.cancel()
+        if self.__ik:
+            self.__ik.cancel()
+        self.animation.play(f"animations/{name}.anim", name)
+        return self.animation.status()
+
+    def stop_animation(self):
+        self.animation.stop()
+        return self.animation.status()
+
+    def get_animation_status(self):
+        return self.animation.status()
+
+    def get_joint_positions(self, names: list = None):
+        """World position in millimetres of the named joints, or of every joint"""
+        self.kinematics.update()
+        if names is None:
+            names = self.robot.joint_names
+        positions = {}
+        for name in names:
+            positions[name] = list(
+                self.kinematics.position(self.robot.joint_index(name))
+            )
+        return positions
+
+    def get_centre_of_mass(self):
+        """World centre of mass in millimetres and the total mass in grams"""
+        self.kinematics.update()
+        position, mass = self.kinematics.centre_of_mass()
+        return {"position": list(position), "mass": mass}
+
+    def solve_ik(self, targets: dict, apply: bool = True, max_iterations: int = 50):
+        """Solve the joint angles that bring each effector to its target, see
+        core.ik.limbs_from_targets for the format. The solution is written to
+        the servos unless apply is false."""
+        from core.ik import limbs_from_targets
+
+        limbs = self.ik.solve(limbs_from_targets(self.robot, targets), max_iterations)
+        if apply:
+            self.motion.cancel()
+            if self.__animation:
+                self.__animation.stop()
+            self.ik.cancel()
+            self.ik.stage(limbs)
+            self.robot.flush()
+        return self.ik.result(limbs)
+
+    def track_ik(self, targets: dict):
+        """Move the effectors towards their targets from the control loop,
+        a few solver iterations every tick, until cancelled"""
+        from core.ik import limbs_from_targets
+
+        limbs = limbs_from_targets(self.robot, targets)
+        self.motion.cancel()
+        if self.__animation:
+            self.__animation.stop()
+        self.ik.track(limbs)
+        return self.ik.status()
+
+    def cancel_ik(self):
+        if self.__ik:
+            self.__ik.cancel()
+        return self.get_ik_status()
+
+    def get_ik_status(self):
+        if self.__ik is None:
+            return {"tracking": False}
+        return self.__ik.status()
+
+    def get_joint_names(self):
+        """Joint names in the order used as joint index by binary messages"""
+        return self.robot.joint_names
+
+    def binary_set_joints(self, indices, angles, count: int):
+        """Binary set joints, angles are in tenths of a degree.
+        The whole frame is checked before any joint is staged, a rejected frame
+        leaves nothing for the next flush."""
+        joints = self.robot.joint_list
+        for i in range(count):
+            if indices[i] >= len(joints):
+                raise ValueError("joint index out of range")
+            if angles[i] != BINARY_ANGLE_NONE:
+                joints[indices[i]].check_tenths(angles[i])
+        for i in range(count):
+            angle = angles[i]
+            if angle == BINARY_ANGLE_NONE:
+                joints[indices[i]].stage_angle(None)
+            else:
+                joints[indices[i]].stage_tenths(angle)
+        self.robot.flush()
+        return 0
+
+    def binary_get_joints(self, indices, angles, count: int):
+        """Binary get joints, a count of 0 reads every joint"""
+        joints = self.robot.joint_list
+        if count == 0:
+            count = min(len(joints), len(indices))
+            for i in range(count):
+                indices[i] = i
+        for i in range(count):
+            if indices[i] >= len(joints):
+                raise ValueError("joint index out of range")
+            angle = joints[indices[i]].angle
+            angles[i] = BINARY_ANGLE_NONE if angle is None else int(angle * 10)
+        return count
 
     def register_rpc_commands(self):
         self.network_manager.register_command("ping", self.ping)
         self.network_manager.register_command("get_config", self.get_config)
         self.network_manager.register_command("get_robot_config", self.get_robot_config)
+        self.network_manager.register_command(
+            "set_config", self.set_config, control=True
+        )
+        self.network_manager.register_command(
+            "patch_config", self.patch_config, control=True
+        )
+        self.network_manager.register_command(
+            "get_scheduler_stats", self.get_scheduler_stats
+        )
+        self.network_manager.register_command("get_connections", self.get_connections)
+        self.network_manager.register_command(
+            "acquire_control", self.acquire_control, True
+        )
+        self.network_manager.register_command(
+            "release_control", self.release_control, True
+        )
+        self.network_manager.register_command("get_control", self.get_control, True)
+        self.network_manager.register_command("get_metrics", self.get_metrics)
+        self.network_manager.register_command("get_rpc_profile", self.get_rpc_profile)
+        self.network_manager.register_command(
+            "reset_rpc_profile", self.reset_rpc_profile
+        )
+        self.network_manager.register_command("get_boot_profile", self.get_boot_profile)
+        self.network_manager.register_command("get_logs", self.get_logs)
+        self.network_manager.register_command("clear_logs", self.clear_logs)
+        self.network_manager.register_command("subscribe", self.subscribe, True)
+        self.network_manager.register_command("unsubscribe", self.unsubscribe, True)
+        self.network_manager.register_command(
+            "ack_telemetry", self.ack_telemetry, True
+        )
+        self.network_manager.register_command(
+            "get_subscriptions", self.get_subscriptions, True
+        )
+        self.network_manager.register_command(
+            "set_joints", self.set_joints, control=True
+        )
+        self.network_manager.register_command("get_joints", self.get_joints)
+        self.network_manager.register_command("get_joint_names", self.get_joint_names)
+        self.network_manager.register_command(
+            "get_joint_positions", self.get_joint_positions
+        )
+        self.network_manager.register_command(
+            "get_centre_of_mass", self.get_centre_of_mass
+        )
+        self.network_manager.register_command("solve_ik", self.solve_ik, control=True)
+        self.network_manager.register_command("track_ik", self.track_ik, control=True)
+        self.network_manager.register_command("cancel_ik", self.cancel_ik, control=True)
+        self.network_manager.register_command("get_ik_status", self.get_ik_status)
+        self.network_manager.register_command(
+            "play_motion", self.play_motion, control=True
+        )
+        self.network_manager.register_command(
+            "cancel_motion", self.cancel_motion, control=True
+        )
+        self.network_manager.register_command(
+            "get_motion_status", self.get_motion_status
+        )
+        self.network_manager.register_command(
+            "play_animation", self.play_animation, control=True
+        )
+        self.network_manager.register_command(
+            "stop_animation", self.stop_animation, control=True
+        )
+        self.network_manager.register_command(
+            "get_animation_status", self.get_animation_status
+        )
+
+        self.network_manager.register_binary_command(
+            BINARY_SET_JOINTS, self.binary_set_joints, control=True
+        )
+        self.network_manager.register_binary_command(
+            BINARY_GET_JOINTS, self.binary_get_joints
+        )
@@ -0,0 +1,324 @@
+import math
+from array import array
+from .kinematics import Kinematics
+from .model import NO_PARENT
+from .robot import Robot
+
+# Defaults of IKSolver, in millimetres
+DEFAULT_DAMPING = 20.0
+DEFAULT_TOLERANCE = 1.0
+DEFAULT_MAX_STEP = 50.0
+
+
+class Limb:
+    """
+    A chain of joints from base to effector with a target position for the
+    effector, or for a point given in the frame of the effector.
+    Without a base the chain runs up to the joint below the root of the tree,
+    so reaching with an arm does not turn the body.
+    """
+
+    def __init__(
+        self, robot: Robot, effector: str, target, base: str = None, point=None
+    ):
+        if len(target) != 3:
+            raise ValueError(f"the target of {effector} must be [x, y, z]")
+        self.name = effector
+        self.effector = robot.joint_index(effector)
+        self.target = (float(target[0]), float(target[1]), float(target[2]))
+        self.point = point
+
+        base_index = robot.joint_index(base) if base else None
+        chain = []
+        index = self.effector
+        parents = robot.parents
+        while True:
+            chain.append(index)
+            if index == base_index:
+                break
+            parent = parents[index]
+            if parent == NO_PARENT:
+                if base_index is not None:
+                    raise ValueError(f"{base} is not above {effector}")
+                break
+            if base_index is None and parents[parent] == NO_PARENT:
+                break
+            index = parent
+        chain.reverse()
+        self.chain = bytearray(chain)
+        self.jacobian = array("f", [0.0] * (3 * len(chain)))
+        self.error = None
+        self.iterations = 0
+
+
+def limbs_from_targets(robot: Robot, targets: dict):
+    """
+    Limbs from the targets of an RPC, keyed by effector joint name. A target is
+    a position [x, y, z] or a dict with a position and optionally the base
+    joint and the point of the effector to reach.
+    """
+    limbs = []
+    for effector, target in targets.items():
+        if isinstance(target, dict):
+            position = target.get("position", None)
+            if position is None:
+                raise ValueError(f"the target of {effector} has no position")
+            limbs.append(
+                Limb(
+                    robot,
+                    effector,
+                    position,
+                    target.get("base", None),
+                    target.get("point", None),
+                )
+            )
+        else:
+            limbs.append(Limb(robot, effector, target))
+    return limbs
+
+
+def _solve3(m, rhs):
+    """Solve the symmetric 3x3 system m x = rhs, m is (a, b, c, d, e, f) of
+    [[a, b, c], [b, d, e], [c, e, f]]"""
+    a, b, c, d, e, f = m
+    ca = d * f - e * e
+    cb = c * e - b * f
+    cc = b * e - c * d
+    det = a * ca + b * cb + c * cc
+    if not det:
+        return (0.0, 0.0, 0.0)
+    cd = a * f - c * c
+    ce = b * c - a * e
+    cf = a * d - b * b
+    return (
+        (ca * rhs[0] + cb * rhs[1] + cc * rhs[2]) / det,
+        (cb * rhs[0] + cd * rhs[1] + ce * rhs[2]) / det,
+        (cc * rhs[0] + ce * rhs[1] + cf * rhs[2]) / det,
+    )
+
+
+class IKSolver:
+    """
+    Damped least squares inverse kinematics for the limbs of a robot.
+    The solver works on its own copy of the joint angles and its own
+    Kinematics, warm started from the current angles, and respects the
+    min_angle and max_angle of every joint and the range of its servo.
+    Several limbs are solved together, one iteration steps every limb once.
+    solve() runs to convergence within max_iterations. track() keeps solving
+    in the control loop with iterations_per_tick iterations a tick, staging the
+    angles each tick so the limbs move towards the targets.
+    Args:
+        damping (float): Damping in millimetres, higher is slower but stable
+            near singular poses.
+        tolerance (float): Distance in millimetres at which a limb is reached.
+        max_step (float): Largest distance an effector is moved a iteration.
+    """
+
+    def __init__(
+        self,
+        robot: Robot,
+        iterations_per_tick: int = 2,
+        damping: float = DEFAULT_DAMPING,
+        tolerance: float = DEFAULT_TOLERANCE,
+        max_step: float = DEFAULT_MAX_STEP,
+    ):
+        self.robot = robot
+        self.kinematics = Kinematics(robot)
+        self.iterations_per_tick = iterations_per_tick
+        self.damping = damping
+        self.tolerance = tolerance
+        self.max_step = max_step
+        self.angles = [0.0] * len(robot.joint_list)
+        self._limbs = None  # limbs being tracked
+
+    @property
+    def active(self):
+        return self._limbs is not None
+
+    def warm_start(self):
+        """Start from the current joint angles"""
+        joints = self.robot.joint_list
+        zero_angles = self.kinematics.zero_angles
+        for index in range(len(joints)):
+            angle = joints[index].angle
+            if angle is None:
+                angle = joints[index].clamp_to_range(zero_angles[index])
+            self.angles[index] = angle
+
+    def _step(self, limb: Limb):
+        """One damped least squares step of a limb, returns its error"""
+        kinematics = self.kinematics
+        kinematics.compute(self.angles)
+        effector = kinematics.position(limb.effector, limb.point)
+        ex = limb.target[0] - effector[0]
+        ey = limb.target[1] - effector[1]
+        ez = limb.target[2] - effector[2]
+        error = math.sqrt(ex * ex + ey * ey + ez * ez)
+        limb.error = error
+        if error <= self.tolerance:
+            return error
+        if error > self.max_step:
+            scale = self.max_step / error
+            ex *= scale
+            ey *= scale
+            ez *= scale
+
+        # Jacobian column of joint j: its world axis x (effector - joint)
+        rotations = kinematics.rotations
+        positions = kinematics.positions
+        axes = kinematics.axes
+        jacobian = limb.jacobian
+        for i in range(len(limb.chain)):
+            joint = limb.chain[i]
+            r = 9 * joint
+            p = 3 * joint
+            ax = (
+                rotations[r] * axes[p]
+                + rotations[r + 1] * axes[p + 1]
+                + rotations[r + 2] * axes[p + 2]
+            )
+            ay = (
+                rotations[r + 3] * axes[p]
+                + rotations[r + 4] * axes[p + 1]
+                + rotations[r + 5] * axes[p + 2]
+            )
+            az = (
+                rotations[r + 6] * axes[p]
+                + rotations[r + 7] * axes[p + 1]
+                + rotations[r + 8] * axes[p + 2]
+            )
+            rx = effector[0] - positions[p]
+            ry = effector[1] - positions[p + 1]
+            rz = effector[2] - positions[p + 2]
+            jacobian[3 * i] = ay * rz - az * ry
+            jacobian[3 * i + 1] = az * rx - ax * rz
+            jacobian[3 * i + 2] = ax * ry - ay * rx
+
+        # A joint stepping past its limit is held there and the step solved
+        # again without it, so the other joints take up the motion
+        joints = self.robot.joint_list
+        angles = self.angles
+        for _ in range(len(limb.chain)):
+            y = self._damped(jacobian, len(limb.chain), ex, ey, ez)
+            held = False
+            for i in range(len(limb.chain)):
+                joint = limb.chain[i]
+                delta = math.degrees(
+                    jacobian[3 * i] * y[0]
+                    + jacobian[3 * i + 1] * y[1]
+                    + jacobian[3 * i + 2] * y[2]
+                )
+                if delta and joints[joint].clamp_to_range(angles[joint] + delta) != (
+                    angles[joint] + delta
+                ):
+                    jacobian[3 * i] = 0.0
+                    jacobian[3 * i + 1] = 0.0
+                    jacobian[3 * i + 2] = 0.0
+                    held = True
+            if not held:
+                break
+        for i in range(len(limb.chain)):
+            joint = limb.chain[i]
+            delta = (
+                jacobian[3 * i] * y[0]
+                + jacobian[3 * i + 1] * y[1]
+                + jacobian[3 * i + 2] * y[2]
+            )
+            angles[joint] = joints[joint].clamp_to_range(
+                angles[joint] + math.degrees(delta)
+            )
+        return error
+
+    def _damped(self, jacobian, columns: int, ex: float, ey: float, ez: float):
+        """y of (J J^T + damping^2 I) y = e, the joint steps are J^T y"""
+        a = d = f = self.damping * self.damping
+        b = c = e = 0.0
+        for i in range(columns):
+            jx = jacobian[3 * i]
+            jy = jacobian[3 * i + 1]
+            jz = jacobian[3 * i + 2]
+            a += jx * jx
+            b += jx * jy
+            c += jx * jz
+            d += jy * jy
+            e += jy * jz
+            f += jz * jz
+        return _solve3((a, b, c, d, e, f), (ex, ey, ez))
+
+    def iterate(self, limbs: list):
+        """Step every limb that has not reached its target once, returns True
+        when all limbs are within tolerance"""
+        reached = True
+        for limb in limbs:
+            if limb.error is not None and limb.error <= self.tolerance:
+                continue
+            limb.iterations += 1
+            if self._step(limb) > self.tolerance:
+                reached = False
+        return reached
+
+    def _measure(self, limbs: list):
+        """Update the error of every limb for the current angles"""
+        self.kinematics.compute(self.angles)
+        for limb in limbs:
+            effector = self.kinematics.position(limb.effector, limb.point)
+            limb.error = math.sqrt(
+                (limb.target[0] - effector[0]) ** 2
+                + (limb.target[1] - effector[1]) ** 2
+                + (limb.target[2] - effector[2]) ** 2
+            )
+
+    def solve(self, limbs: list, max_iterations: int = 50):
+        """Solve the limbs starting from the current joint angles, the solution
+        is left in angles"""
+        self.warm_start()
+        for _ in range(max_iterations):
+            if self.iterate(limbs):
+                break
+        self._measure(limbs)
+        return limbs
+
+    def stage(self, limbs: list):
+        """Stage the solved angles of the limbs on their joints"""
+        joints = self.robot.joint_list
+        for limb in limbs:
+            for joint in limb.chain:
+                joints[joint].stage_angle(self.angles[joint])
+
+    def track(self, limbs: list):
+        self.warm_start()
+        self._limbs = limbs
+
+    def cancel(self):
+        self._limbs = None
+
+    def tick(self):
+        limbs = self._limbs
+        if limbs is None:
+            return
+        for _ in range(self.iterations_per_tick):
+            if self.iterate(limbs):
+                break
+        self.stage(limbs)
+
+    def result(self, limbs: list):
+        result = {}
+        joints = self.robot.joint_list
+        for limb in limbs:
+            angles = {}
+            for joint in limb.chain:
+                angles[joints[joint].name] = self.angles[joint]
+            result[limb.name] = {
+                "angles": angles,
+                "error": limb.error,
+                "reached": limb.error is not None
+                and limb.error <= self.tolerance,
+                "iterations": limb.iterations,
+            }
+        return result
+
+    def status(self):
+        status = {"tracking": self.active}
+        if self._limbs:
+            status["limbs"] = self.result(self._limbs)
+        return status
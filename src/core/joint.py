@@ -1,15 +1,28 @@
 from .servo import Servo
 
 
-class Joint:
-    __name: str
-    __parent: None  # type Joint
-    __servo: Servo = None
+def _limit(angle):
+    """A limit in degrees, whole degrees are kept as int so clamping to them
+    stays in integers"""
+    if angle is not None and angle == int(angle):
+        return int(angle)
+    return angle
+
 
-    children = []  # The decedents
-    min_angle: int = None  # min angle the joint can move
-    max_angle: int = None  # max angle the joint can move
-    home_angle: int = 0  # the starting angle
+class Joint:
+    # Fixed attributes keep a joint small, a robot has one per servo
+    __slots__ = (
+        "__name",
+        "__parent",
+        "__servo",
+        "__min_angle",
+        "__max_angle",
+        "__min_tenths",
+        "__max_tenths",
+        "children",  # The decedents
+        "index",  # position in the robot joint table
+        "home_angle",  # the starting angle
+    )
 
     def __init__(
         self,
@@ -19,10 +32,13 @@ class Joint:
         min_angle: int = None,
         max_angle: int = None,
         home_angle: int = 0,
+        index: int = None,
     ):
         self.__name = name
         self.__parent = parent
         self.__servo = servo
+        self.children = []
+        self.index = index
 
         self.min_angle = min_angle
         self.max_angle = max_angle
@@ -46,6 +62,26 @@ class Joint:
     def servo(self):
         return self.__servo
 
+    @property
+    def min_angle(self):
+        """min angle the joint can move"""
+        return self.__min_angle
+
+    @min_angle.setter
+    def min_angle(self, value):
+        self.__min_angle = _limit(value)
+        self.__min_tenths = None if value is None else int(round(value * 10))
+
+    @property
+    def max_angle(self):
+        """max angle the joint can move"""
+        return self.__max_angle
+
+    @max_angle.setter
+    def max_angle(self, value):
+        self.__max_angle = _limit(value)
+        self.__max_tenths = None if value is None else int(round(value * 10))
+
     @property
     def angle(self):
         """The servo angle in degrees. Must be in the range ``0`` to ``actuation_range``.
@@ -54,12 +90,72 @@ class Joint:
 
     @angle.setter
     def angle(self, new_angle: int = None):
-        if self.min_angle and new_angle < self.min_angle:
-            new_angle = self.min_angle
-        if self.max_angle and new_angle > self.max_angle:
-            new_angle = self.max_angle
+        self.servo.angle = self.clamp(new_angle)
+
+    def clamp(self, new_angle: int = None):
+        """Limit an angle to the joints min and max angle"""
+        if new_angle is None:
+            return None
+        if self.__min_angle is not None and new_angle < self.__min_angle:
+            new_angle = self.__min_angle
+        if self.__max_angle is not None and new_angle > self.__max_angle:
+            new_angle = self.__max_angle
+        return new_angle
+
+    def clamp_to_range(self, new_angle: float = None):
+        """Limit an angle to the joints min and max angle and to the range of
+        its servo, the angle returned can always be staged"""
+        new_angle = self.clamp(new_angle)
+        if new_angle is None:
+            return None
+        if new_angle < 0:
+            return 0
+        if new_angle > self.__servo.actuation_range:
+            return self.__servo.actuation_range
+        return new_angle
+
+    def check_angle(self, angle):
+        """Raise ValueError unless the joint can be moved to angle, within its
+        limits and the range of its servo. None disables the servo."""
+        if angle is None:
+            return
+        if not isinstance(angle, (int, float)):
+            raise ValueError(f"the angle of {self.__name} must be a number")
+        if self.__min_angle is not None and angle < self.__min_angle:
+            raise ValueError(
+                f"{angle} is below the min_angle {self.__min_angle} of {self.__name}"
+            )
+        if self.__max_angle is not None and angle > self.__max_angle:
+            raise ValueError(
+                f"{angle} is above the max_angle {self.__max_angle} of {self.__name}"
+            )
+        if angle < 0 or angle > self.__servo.actuation_range:
+            raise ValueError(
+                f"{angle} is outside the 0 to {self.__servo.actuation_range} "
+                f"range of the servo of {self.__name}"
+            )
+
+    def stage_angle(self, new_angle: int = None):
+        """Stage a new angle, it is written when the robot flushes its attachments."""
+        self.servo.stage_angle(self.clamp(new_angle))
+
+    def clamp_tenths(self, tenths: int):
+        """Limit an angle in tenths of a degree to the joints min and max angle"""
+        if self.__min_tenths is not None and tenths < self.__min_tenths:
+            return self.__min_tenths
+        if self.__max_tenths is not None and tenths > self.__max_tenths:
+            return self.__max_tenths
+        return tenths
+
+    def check_tenths(self, tenths: int):
+        """Raise ValueError when stage_tenths() would fail, the angle is clamped
+        to the joint limits first like stage_tenths() does"""
+        self.__servo.check_tenths(self.clamp_tenths(tenths))
 
-        self.servo.angle = new_angle
+    def stage_tenths(self, tenths: int):
+        """Stage a new angle in tenths of a degree, like stage_angle() but the
+        angle stays an int from the binary RPC to the duty."""
+        self.__servo.stage_tenths(self.clamp_tenths(tenths))
 
     def home(self):
         self.servo.angle = self.home_angle
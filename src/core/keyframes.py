@@ -0,0 +1,103 @@
+"""
+Keyframe helpers shared by the motion engine, the animation player and the
+host side animation converter, so this module must not import device modules.
+"""
+
+# Easing of the segment leading up to a keyframe
+LINEAR = 0
+EASE_IN = 1
+EASE_OUT = 2
+EASE_IN_OUT = 3
+STEP = 4
+
+EASINGS = {
+    "linear": LINEAR,
+    "ease_in": EASE_IN,
+    "ease_out": EASE_OUT,
+    "ease_in_out": EASE_IN_OUT,
+    "step": STEP,
+}
+
+# Interpolation only uses small integers so a tick does not allocate floats,
+# angles are in tenths of a degree and progress is a fraction of ONE
+ONE = 1024
+HOLD = -32768  # the joint has no target in the keyframe
+
+
+def ease(easing: int, progress: int):
+    """Ease a progress, both progress and result are in the range 0 to ONE"""
+    if easing == LINEAR:
+        return progress
+    if easing == EASE_IN:
+        return progress * progress // ONE
+    if easing == EASE_OUT:
+        return progress * (2 * ONE - progress) // ONE
+    if easing == EASE_IN_OUT:
+        if progress < ONE // 2:
+            return 2 * progress * progress // ONE
+        progress = ONE - progress
+        return ONE - 2 * progress * progress // ONE
+    # STEP
+    return ONE if progress >= ONE else 0
+
+
+# Animation files, all values are little endian:
+# header: magic, version u8, joint count u8, frames per second u16, frame count u32
+# joints: joint count * (name length u8, utf-8 name)
+# frames: frame count * joint count * angle i16 in tenths of a degree, HOLD
+#         leaves the joint where it is
+ANIMATION_MAGIC = b"RFAN"
+ANIMATION_VERSION = 1
+ANIMATION_HEADER = "<4sBBHI"
+ANIMATION_HEADER_SIZE = 12
+
+
+def sample_keyframes(keyframes: list, fps: int, joint_names: list):
+    """
+    Sample keyframes at a fixed rate, yields one list of angles per frame in
+    tenths of a degree ordered like joint_names.
+    Keyframes use the motion engine format, a joint is HOLD until the first
+    keyframe giving it a target and eases between its targets after that.
+    """
+    if not keyframes:
+        raise ValueError("at least one keyframe is required")
+    for index in range(1, len(keyframes)):
+        if keyframes[index].get("time", 0) < keyframes[index - 1].get("time", 0):
+            raise ValueError("keyframe times must not decrease")
+
+    # Per joint list of (time, target, easing) in keyframe order
+    tracks = []
+    for name in joint_names:
+        track = []
+        for keyframe in keyframes:
+            angle = keyframe.get("joints", {}).get(name, None)
+            if angle is None:
+                continue
+            easing_name = keyframe.get("easing", "linear")
+            if easing_name not in EASINGS:
+                raise ValueError(f"unknown easing {easing_name}")
+            track.append(
+                (int(keyframe.get("time", 0)), int(angle * 10), EASINGS[easing_name])
+            )
+        tracks.append(track)
+
+    duration = int(keyframes[-1].get("time", 0))
+    frame_count = duration * fps // 1000 + 1
+    for frame in range(frame_count):
+        now = frame * 1000 // fps
+        angles = []
+        for track in tracks:
+            angles.append(_sample_track(track, now))
+        yield angles
+
+
+def _sample_track(track: list, now: int):
+    if not track or now < track[0][0]:
+        return HOLD
+    for index in range(1, len(track)):
+        end, target, easing = track[index]
+        if now < end:
+            start, origin, _ = track[index - 1]
+            eased = ease(easing, (now - start) * ONE // (end - start))
+            return origin + (target - origin) * eased // ONE
+    return track[-1][1]
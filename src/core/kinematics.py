@@ -0,0 +1,155 @@
+import math
+from array import array
+from .model import NO_PARENT
+from .robot import Robot
+
+
+class Kinematics:
+    """
+    Forward kinematics over the joint tree of a robot built from a model.
+    The world pose of joint i is kept in flat arrays: rotations[9i:9i+9] is its
+    rotation matrix in row major order, positions[3i:3i+3] its position in
+    millimetres. The base frame has x forward, y left and z up.
+    update() only recomputes the joints whose angle changed since the last
+    pass and the joints below them, the model stores parents before their
+    children so one pass in index order is enough.
+    """
+
+    def __init__(self, robot: Robot):
+        model = robot.model
+        if model is None:
+            raise ValueError("kinematics needs a robot built from a model")
+
+        joint_count = len(robot.joint_list)
+        self.robot = robot
+        self.joint_count = joint_count
+        self.parents = model.parents
+        self.zero_angles = model.zero_angles
+        self.offsets = model.offsets
+        self.axes = model.axes
+        self.masses = model.masses
+        self.coms = model.coms
+
+        self.rotations = array("f", [0.0] * (9 * joint_count))
+        self.positions = array("f", [0.0] * (3 * joint_count))
+        self.recomputed = 0  # joints recomputed by the last pass
+        # Angles of the last pass, None until a joint is computed
+        self._angles = [None] * joint_count
+        self._input = [0.0] * joint_count
+        self._dirty = bytearray(joint_count)
+
+    def update(self):
+        """Recompute the poses from the current joint angles, a disabled servo
+        counts as being at its zero angle. Returns the number of joints
+        recomputed."""
+        angles = self._input
+        joints = self.robot.joint_list
+        for index in range(self.joint_count):
+            angle = joints[index].angle
+            angles[index] = self.zero_angles[index] if angle is None else angle
+        return self.compute(angles)
+
+    def compute(self, angles):
+        """Recompute the poses for the given joint angles in degrees"""
+        parents = self.parents
+        dirty = self._dirty
+        last = self._angles
+        count = 0
+        for index in range(self.joint_count):
+            parent = parents[index]
+            angle = angles[index]
+            if angle != last[index] or (parent != NO_PARENT and dirty[parent]):
+                dirty[index] = 1
+                last[index] = angle
+                self._transform(index, parent, angle)
+                count += 1
+            else:
+                dirty[index] = 0
+        self.recomputed = count
+        return count
+
+    def _transform(self, index: int, parent: int, angle: float):
+        theta = math.radians(angle - self.zero_angles[index])
+        c = math.cos(theta)
+        s = math.sin(theta)
+        t = 1 - c
+        a = 3 * index
+        x = self.axes[a]
+        y = self.axes[a + 1]
+        z = self.axes[a + 2]
+        # Rotation around the joint axis, Rodrigues' formula
+        local = (
+            t * x * x + c,
+            t * x * y - s * z,
+            t * x * z + s * y,
+            t * x * y + s * z,
+            t * y * y + c,
+            t * y * z - s * x,
+            t * x * z - s * y,
+            t * y * z + s * x,
+            t * z * z + c,
+        )
+
+        rotations = self.rotations
+        positions = self.positions
+        offsets = self.offsets
+        r = 9 * index
+        if parent == NO_PARENT:
+            for i in range(9):
+                rotations[r + i] = local[i]
+            for i in range(3):
+                positions[a + i] = offsets[a + i]
+            return
+
+        pr = 9 * parent
+        pa = 3 * parent
+        for row in range(3):
+            p0 = rotations[pr + 3 * row]
+            p1 = rotations[pr + 3 * row + 1]
+            p2 = rotations[pr + 3 * row + 2]
+            positions[a + row] = (
+                positions[pa + row]
+                + p0 * offsets[a]
+                + p1 * offsets[a + 1]
+                + p2 * offsets[a + 2]
+            )
+            for column in range(3):
+                rotations[r + 3 * row + column] = (
+                    p0 * local[column]
+                    + p1 * local[3 + column]
+                    + p2 * local[6 + column]
+                )
+
+    def position(self, index: int, point=None):
+        """World position of a joint, or of a point given in its frame"""
+        a = 3 * index
+        positions = self.positions
+        if point is None:
+            return (positions[a], positions[a + 1], positions[a + 2])
+        r = 9 * index
+        rotations = self.rotations
+        return tuple(
+            positions[a + row]
+            + rotations[r + 3 * row] * point[0]
+            + rotations[r + 3 * row + 1] * point[1]
+            + rotations[r + 3 * row + 2] * point[2]
+            for row in range(3)
+        )
+
+    def centre_of_mass(self):
+        """Returns the world centre of mass and the total mass of the links"""
+        total = 0.0
+        x = y = z = 0.0
+        for index in range(self.joint_count):
+            mass = self.masses[index]
+            if not mass:
+                continue
+            a = 3 * index
+            com = self.position(index, self.coms[a : a + 3])
+            x += mass * com[0]
+            y += mass * com[1]
+            z += mass * com[2]
+            total += mass
+        if not total:
+            return (0.0, 0.0, 0.0), 0.0
+        return (x / total, y / total, z / total), total
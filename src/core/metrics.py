@@ -0,0 +1,156 @@
+import gc
+import time
+from array import array
+
+# Histogram buckets: values below 8 have their own bucket, above that every
+# power of two is split into 4 buckets, so a bucket is at most 25% wide.
+# 96 buckets reach 32 seconds in microseconds.
+HISTOGRAM_BUCKETS = 96
+_BUCKET_MAX_COUNT = 0xFFFF
+
+
+def _bucket(value: int):
+    shift = 0
+    while (value >> shift) >= 8:
+        shift += 1
+    index = 4 * shift + (value >> shift)
+    if index >= HISTOGRAM_BUCKETS:
+        return HISTOGRAM_BUCKETS - 1
+    return index
+
+
+def _bucket_upper(index: int):
+    """Largest value counted in a bucket"""
+    if index < 8:
+        return index
+    shift = index // 4 - 1
+    return ((index % 4 + 5) << shift) - 1
+
+
+class Histogram:
+    """
+    Fixed size integer histogram of the values recorded over a window.
+    record() only updates preallocated counters so it can be called from the
+    control loop without allocating. rotate() closes the window, the summary
+    describes the last closed window.
+    Args:
+        budget (int): Values above the budget are counted as over budget.
+    """
+
+    def __init__(self, budget: int = None):
+        self.budget = budget
+        self._counts = array("H", bytearray(2 * HISTOGRAM_BUCKETS))
+        self._last_counts = array("H", bytearray(2 * HISTOGRAM_BUCKETS))
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.over_budget = 0
+        self.last_count = 0
+        self.last_total = 0
+        self.last_max = 0
+        self.last_over_budget = 0
+        self.over_budget_total = 0
+
+    def record(self, value: int):
+        if value < 0:
+            value = 0
+        index = _bucket(value)
+        if self._counts[index] < _BUCKET_MAX_COUNT:
+            self._counts[index] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        if self.budget is not None and value > self.budget:
+            self.over_budget += 1
+            self.over_budget_total += 1
+
+    def rotate(self):
+        """Close the window and start an empty one"""
+        self._counts, self._last_counts = self._last_counts, self._counts
+        counts = self._counts
+        for index in range(HISTOGRAM_BUCKETS):
+            counts[index] = 0
+        self.last_count = self.count
+        self.last_total = self.total
+        self.last_max = self.max
+        self.last_over_budget = self.over_budget
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.over_budget = 0
+
+    def percentile(self, fraction: float):
+        """Upper bound of the value below which fraction of the last window lies"""
+        if not self.last_count:
+            return 0
+        target = fraction * self.last_count
+        seen = 0
+        counts = self._last_counts
+        for index in range(HISTOGRAM_BUCKETS):
+            seen += counts[index]
+            if seen >= target:
+                return min(_bucket_upper(index), self.last_max)
+        return self.last_max
+
+    def summary(self):
+        summary = {
+            "count": self.last_count,
+            "mean": self.last_total // self.last_count if self.last_count else 0,
+            "p50": self.percentile(0.5),
+            "p99": self.percentile(0.99),
+            "max": self.last_max,
+        }
+        if self.budget is not None:
+            summary["budget"] = self.budget
+            summary["over_budget"] = self.last_over_budget
+            summary["over_budget_total"] = self.over_budget_total
+        return summary
+
+
+class Metrics:
+    """
+    Named histograms of the control loop, in microseconds, collected over
+    windows of window_ms. tick() closes the window once it has passed and
+    samples the free heap, the framework runs it from the scheduler.
+    """
+
+    def __init__(self, window_ms: int = 5000):
+        self.window_ms = window_ms
+        self._histograms = {}
+        self._window_start = time.ticks_ms()
+        self._last_window_ms = 0
+        self.free_heap = None
+        self.windows = 0
+
+    def histogram(self, name: str, budget: int = None):
+        """The histogram called name, created on first use"""
+        histogram = self._histograms.get(name, None)
+        if histogram is None:
+            histogram = Histogram(budget)
+            self._histograms[name] = histogram
+        return histogram
+
+    def tick(self):
+        now = time.ticks_ms()
+        elapsed = time.ticks_diff(now, self._window_start)
+        if elapsed < self.window_ms:
+            return
+        self._window_start = now
+        self._last_window_ms = elapsed
+        for histogram in self._histograms.values():
+            histogram.rotate()
+        self.windows += 1
+        if hasattr(gc, "mem_free"):
+            self.free_heap = gc.mem_free()
+
+    def report(self):
+        histograms = {}
+        for name, histogram in self._histograms.items():
+            histograms[name] = histogram.summary()
+        return {
+            "window_ms": self._last_window_ms,
+            "windows": self.windows,
+            "free_heap": self.free_heap,
+            "histograms": histograms,
+        }
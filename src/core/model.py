@@ -0,0 +1,172 @@
+import ustruct
+from array import array
+
+# Compiled robot models, all values are little endian:
+# header:      magic, version u8, crc32 of the source json u32
+# robot:       name, attachments value
+# joints:      count u8, then per joint: name, servo_index,
+#              parent u8, min_angle f32, max_angle f32, home_angle f32,
+#              zero_angle f32, offset 3 * f32, axis 3 * f32, mass f32, com 3 * f32,
+#              options value
+# Strings are a length u16 followed by utf-8, missing angles are stored as NaN.
+# Values are tagged with one byte, see _decode_value.
+MODEL_MAGIC = b"RFMD"
+MODEL_VERSION = 2
+MODEL_HEADER = "<4sBI"
+MODEL_HEADER_SIZE = 9
+MODEL_JOINT = "<Bffff3f3ff3f"
+MODEL_JOINT_SIZE = 57
+
+NO_PARENT = 255
+
+
+class RobotModel:
+    """
+    Flat, index based description of a robot.
+    Joints are stored depth first so a parent always comes before its
+    children, parents[i] is the index of the parent of joint i or NO_PARENT.
+    options[i] holds the remaining keys of the joint config, such as the
+    servo options, or None.
+    The geometry of joint i, used by core.kinematics, is stored in flat arrays
+    in millimetres, grams and degrees: offsets[3i:3i+3] is its position in the
+    frame of its parent, axes[3i:3i+3] the unit axis it turns around, masses[i]
+    the mass of its link centred on coms[3i:3i+3] in its own frame. The link is
+    in the offset pose when the joint is at zero_angles[i].
+    """
+
+    def __init__(self, name: str, attachments: list = None):
+        self.name = name
+        self.attachments = attachments or []
+        self.names = []
+        self.parents = bytearray()
+        self.servo_indexes = []
+        self.min_angles = []
+        self.max_angles = []
+        self.home_angles = []
+        self.zero_angles = []
+        self.offsets = array("f")
+        self.axes = array("f")
+        self.masses = array("f")
+        self.coms = array("f")
+        self.options = []
+
+    def add_joint(
+        self,
+        name: str,
+        parent: int,
+        servo_index: str,
+        min_angle=None,
+        max_angle=None,
+        home_angle=0,
+        options: dict = None,
+        zero_angle=None,
+        offset=(0, 0, 0),
+        axis=(0, 0, 1),
+        mass=0,
+        com=(0, 0, 0),
+    ):
+        self.names.append(name)
+        self.parents.append(parent)
+        self.servo_indexes.append(servo_index)
+        self.min_angles.append(min_angle)
+        self.max_angles.append(max_angle)
+        self.home_angles.append(home_angle)
+        if zero_angle is None:
+            zero_angle = home_angle or 0
+        self.zero_angles.append(zero_angle)
+        for i in range(3):
+            self.offsets.append(offset[i])
+            self.axes.append(axis[i])
+            self.coms.append(com[i])
+        self.masses.append(mass)
+        self.options.append(options)
+        return len(self.names) - 1
+
+
+def _decode_str(data, offset: int):
+    length = ustruct.unpack_from("<H", data, offset)[0]
+    offset += 2
+    return str(data[offset : offset + length], "utf-8"), offset + length
+
+
+def _decode_value(data, offset: int):
+    """Decode a tagged value: i int, f float, s str, l list, d dict, n None"""
+    tag = data[offset]
+    offset += 1
+    if tag == 0x69:  # i
+        return ustruct.unpack_from("<i", data, offset)[0], offset + 4
+    if tag == 0x66:  # f
+        return ustruct.unpack_from("<f", data, offset)[0], offset + 4
+    if tag == 0x73:  # s
+        return _decode_str(data, offset)
+    if tag == 0x6C:  # l
+        count = ustruct.unpack_from("<H", data, offset)[0]
+        offset += 2
+        items = []
+        for _ in range(count):
+            item, offset = _decode_value(data, offset)
+            items.append(item)
+        return items, offset
+    if tag == 0x64:  # d
+        count = ustruct.unpack_from("<H", data, offset)[0]
+        offset += 2
+        items = {}
+        for _ in range(count):
+            key, offset = _decode_str(data, offset)
+            items[key], offset = _decode_value(data, offset)
+        return items, offset
+    if tag == 0x6E:  # n
+        return None, offset
+    raise ValueError(f"invalid model value tag {tag}")
+
+
+def _angle(value: float):
+    return None if value != value else value  # NaN marks a missing angle
+
+
+def load_model(path: str, source_crc: int):
+    """Load a compiled model, returns None when it is missing or does not match
+    the version or the crc of its source"""
+    try:
+        with open(path, "rb") as model_file:
+            data = model_file.read()
+    except OSError:
+        return None
+
+    if len(data) < MODEL_HEADER_SIZE:
+        return None
+    magic, version, crc = ustruct.unpack_from(MODEL_HEADER, data, 0)
+    if magic != MODEL_MAGIC or version != MODEL_VERSION or crc != source_crc:
+        return None
+
+    try:
+        name, offset = _decode_str(data, MODEL_HEADER_SIZE)
+        attachments, offset = _decode_value(data, offset)
+        model = RobotModel(name, attachments)
+        joint_count = data[offset]
+        offset += 1
+        for _ in range(joint_count):
+            joint_name, offset = _decode_str(data, offset)
+            servo_index, offset = _decode_str(data, offset)
+            values = ustruct.unpack_from(MODEL_JOINT, data, offset)
+            offset += MODEL_JOINT_SIZE
+            options, offset = _decode_value(data, offset)
+            model.add_joint(
+                joint_name,
+                values[0],
+                servo_index,
+                _angle(values[1]),
+                _angle(values[2]),
+                _angle(values[3]),
+                options,
+                zero_angle=values[4],
+                offset=values[5:8],
+                axis=values[8:11],
+                mass=values[11],
+                com=values[12:15],
+            )
+    except Exception:
+        # Truncated or corrupt, recompile. A short read raises IndexError or
+        # ValueError on MicroPython but struct.error on CPython
+        return None
+    return model
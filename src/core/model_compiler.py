@@ -0,0 +1,142 @@
+import math
+import ustruct
+from .model import (
+    RobotModel,
+    MODEL_MAGIC,
+    MODEL_VERSION,
+    MODEL_HEADER,
+    MODEL_JOINT,
+    NO_PARENT,
+)
+
+# Joint config keys stored in the fixed part of a compiled joint
+JOINT_KEYS = (
+    "name",
+    "servo_index",
+    "min_angle",
+    "max_angle",
+    "home_angle",
+    "children",
+    "zero_angle",
+    "offset",
+    "axis",
+    "mass",
+    "com",
+)
+
+
+def _vector(joint_name: str, key: str, value, default):
+    if value is None:
+        return default
+    if not isinstance(value, (list, tuple)) or len(value) != 3:
+        raise Exception(f"{key} of joint {joint_name} must be a list of 3 numbers")
+    return (float(value[0]), float(value[1]), float(value[2]))
+
+
+def _unit(joint_name: str, value):
+    length = math.sqrt(value[0] ** 2 + value[1] ** 2 + value[2] ** 2)
+    if not length:
+        raise Exception(f"axis of joint {joint_name} must not be zero")
+    return (value[0] / length, value[1] / length, value[2] / length)
+
+
+def _flatten_joint(model: RobotModel, joint_config: dict, parent: int):
+    name = joint_config.get("name", None)
+    if not name:
+        raise Exception("every joint config must have a name")
+    if name in model.names:
+        raise Exception(f"joint name {name} is used more than once")
+
+    options = {}
+    for key, value in joint_config.items():
+        if key not in JOINT_KEYS:
+            options[key] = value
+
+    index = model.add_joint(
+        name,
+        parent,
+        joint_config.get("servo_index", ""),
+        joint_config.get("min_angle", None),
+        joint_config.get("max_angle", None),
+        joint_config.get("home_angle", 0),
+        options or None,
+        zero_angle=joint_config.get("zero_angle", None),
+        offset=_vector(name, "offset", joint_config.get("offset"), (0, 0, 0)),
+        axis=_unit(name, _vector(name, "axis", joint_config.get("axis"), (0, 0, 1))),
+        mass=float(joint_config.get("mass", 0)),
+        com=_vector(name, "com", joint_config.get("com"), (0, 0, 0)),
+    )
+    for child_config in joint_config.get("children", []):
+        _flatten_joint(model, child_config, index)
+
+
+def compile_model(robot_config: dict):
+    """Flatten the nested joint tree of a robot config into a RobotModel"""
+    model = RobotModel(robot_config["name"], robot_config.get("attachments", []))
+    for joint_config in robot_config.get("joints", []):
+        _flatten_joint(model, joint_config, NO_PARENT)
+    if len(model.names) >= NO_PARENT:
+        raise Exception(f"a robot is limited to {NO_PARENT} joints")
+    return model
+
+
+def _encode_str(out: list, value: str):
+    encoded = value.encode("utf-8")
+    out.append(ustruct.pack("<H", len(encoded)))
+    out.append(encoded)
+
+
+def _encode_value(out: list, value):
+    if value is None:
+        out.append(b"n")
+    elif isinstance(value, bool) or isinstance(value, int):
+        out.append(b"i" + ustruct.pack("<i", int(value)))
+    elif isinstance(value, float):
+        out.append(b"f" + ustruct.pack("<f", value))
+    elif isinstance(value, str):
+        out.append(b"s")
+        _encode_str(out, value)
+    elif isinstance(value, (list, tuple)):
+        out.append(b"l" + ustruct.pack("<H", len(value)))
+        for item in value:
+            _encode_value(out, item)
+    elif isinstance(value, dict):
+        out.append(b"d" + ustruct.pack("<H", len(value)))
+        for key, item in value.items():
+            _encode_str(out, key)
+            _encode_value(out, item)
+    else:
+        raise ValueError(f"can not compile value {value}")
+
+
+def _angle(value):
+    return float("nan") if value is None else float(value)
+
+
+def dump_model(model: RobotModel, source_crc: int):
+    """Serialise a model to the format read by core.model.load_model"""
+    out = [ustruct.pack(MODEL_HEADER, MODEL_MAGIC, MODEL_VERSION, source_crc)]
+    _encode_str(out, model.name)
+    _encode_value(out, model.attachments)
+    out.append(bytes([len(model.names)]))
+    for index in range(len(model.names)):
+        _encode_str(out, model.names[index])
+        _encode_str(out, model.servo_indexes[index])
+        start = 3 * index
+        end = start + 3
+        out.append(
+            ustruct.pack(
+                MODEL_JOINT,
+                model.parents[index],
+                _angle(model.min_angles[index]),
+                _angle(model.max_angles[index]),
+                _angle(model.home_angles[index]),
+                model.zero_angles[index],
+                *model.offsets[start:end],
+                *model.axes[start:end],
+                model.masses[index],
+                *model.coms[start:end],
+            )
+        )
+        _encode_value(out, model.options[index])
+    return b"".join(out)
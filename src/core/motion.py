@@ -0,0 +1,272 @@
+import time
+from array import array
+from .keyframes import EASINGS, ONE, HOLD, ease
+from .robot import Robot
+
+
+class Trajectory:
+    """
+    Keyframes compiled to flat arrays for on device interpolation.
+    Each keyframe is a dict with a ``time`` in milliseconds from the start of
+    the trajectory, the ``joints`` to move as a name to angle map and the
+    ``easing`` of the segment leading up to it. Joints without a target in a
+    keyframe hold their previous target, the first segment starts from the
+    angles the joints have when the trajectory begins.
+    Every target is checked against the joint limits and the servo range when
+    the trajectory is made, a bad keyframe raises ValueError before anything
+    plays.
+    The target of joint j in keyframe k is ``targets[k * joint_count + j]``.
+    """
+
+    def __init__(self, robot: Robot, keyframes: list, trajectory_id: int = 0):
+        if not keyframes:
+            raise ValueError("a trajectory needs at least one keyframe")
+
+        joint_count = len(robot.joint_list)
+        self.id = trajectory_id
+        self.joint_count = joint_count
+        self.times = array("I", [0] * len(keyframes))
+        self.easing = bytearray(len(keyframes))
+        self.targets = array("h", [HOLD] * (len(keyframes) * joint_count))
+        self.used = bytearray(joint_count)  # joints driven by the trajectory
+
+        last_time = 0
+        for index, keyframe in enumerate(keyframes):
+            if not isinstance(keyframe, dict):
+                raise ValueError(f"keyframe {index} must be an object")
+            keyframe_time = int(keyframe.get("time", 0))
+            if keyframe_time < last_time:
+                raise ValueError("keyframe times must not decrease")
+            last_time = keyframe_time
+            self.times[index] = keyframe_time
+
+            easing_name = keyframe.get("easing", "linear")
+            easing = EASINGS.get(easing_name, None)
+            if easing is None:
+                raise ValueError(f"unknown easing {easing_name}")
+            self.easing[index] = easing
+
+            base = index * joint_count
+            targets = keyframe.get("joints", {})
+            if not isinstance(targets, dict):
+                raise ValueError(f"the joints of keyframe {index} must be an object")
+            for name, angle in targets.items():
+                joint_index = robot.joint_index(name)
+                if angle is None:
+                    raise ValueError(f"keyframe {index} has no angle for {name}")
+                robot.joint_list[joint_index].check_angle(angle)
+                self.targets[base + joint_index] = int(angle * 10)
+                self.used[joint_index] = 1
+
+        # Carry targets forward into the keyframes that do not set them
+        for index in range(1, len(keyframes)):
+            base = index * joint_count
+            for joint_index in range(joint_count):
+                if self.targets[base + joint_index] == HOLD:
+                    self.targets[base + joint_index] = self.targets[
+                        base - joint_count + joint_index
+                    ]
+
+        # Playback state
+        self.start_ms = 0
+        self.segment = 0
+        self.origin = array("h", [0] * joint_count)
+        self.output = array("h", [0] * joint_count)
+
+    @property
+    def duration_ms(self):
+        return self.times[len(self.times) - 1]
+
+    def begin(self, now: int, positions):
+        """Start playback, positions holds the current angles in tenths of a degree"""
+        self.start_ms = now
+        self.segment = 0
+        joint_count = self.joint_count
+        for joint_index in range(joint_count):
+            if not self.used[joint_index]:
+                continue
+            position = positions[joint_index]
+            self.origin[joint_index] = position
+            self.output[joint_index] = position
+            # Leading keyframes without a target hold the starting angle
+            offset = joint_index
+            while offset < len(self.targets) and self.targets[offset] == HOLD:
+                self.targets[offset] = position
+                offset += joint_count
+
+    def evaluate(self, now: int):
+        """Interpolate all used joints into output in a single pass.
+        Returns False once the last keyframe has been reached."""
+        elapsed = time.ticks_diff(now, self.start_ms)
+        times = self.times
+        targets = self.targets
+        origin = self.origin
+        used = self.used
+        joint_count = self.joint_count
+        keyframe_count = len(times)
+
+        segment = self.segment
+        while segment < keyframe_count and elapsed >= times[segment]:
+            # The segment is done, the next one starts from its target
+            base = segment * joint_count
+            for joint_index in range(joint_count):
+                if used[joint_index]:
+                    origin[joint_index] = targets[base + joint_index]
+            segment += 1
+        self.segment = segment
+
+        output = self.output
+        if segment >= keyframe_count:
+            for joint_index in range(joint_count):
+                output[joint_index] = origin[joint_index]
+            return False
+
+        start = times[segment - 1] if segment else 0
+        eased = ease(
+            self.easing[segment], (elapsed - start) * ONE // (times[segment] - start)
+        )
+        base = segment * joint_count
+        for joint_index in range(joint_count):
+            if used[joint_index]:
+                position = origin[joint_index]
+                output[joint_index] = (
+                    position + (targets[base + joint_index] - position) * eased // ONE
+                )
+        return True
+
+    def progress(self, now: int):
+        elapsed = time.ticks_diff(now, self.start_ms)
+        duration = self.duration_ms
+        return {
+            "id": self.id,
+            "keyframe": self.segment,
+            "keyframes": len(self.times),
+            "elapsed_ms": min(elapsed, duration),
+            "duration_ms": duration,
+            "progress": min(elapsed / duration, 1.0) if duration else 1.0,
+        }
+
+
+class MotionEngine:
+    """
+    Plays keyframe trajectories on the robot at the control rate.
+    tick() interpolates the active trajectory and stages the angles on the
+    joints, the caller flushes the robot afterwards.
+    Trajectories can be queued behind the active one, replace it, or blend
+    into it by cross fading from the active trajectory over blend_ms.
+    """
+
+    def __init__(self, robot: Robot):
+        self.robot = robot
+        self._joint_count = len(robot.joint_list)
+        self._positions = array("h", [0] * self._joint_count)
+        self._active = None  # Trajectory
+        self._fading = None  # Trajectory being blended out
+        self._blend_start = 0
+        self._blend_ms = 0
+        self._queue = []
+        self._next_id = 1
+        self._completed = 0
+
+    @property
+    def active(self):
+        return self._active
+
+    def play(self, keyframes: list, mode: str = "queue", blend_ms: int = 0):
+        """Add a trajectory, mode is queue, replace or blend. Returns its id"""
+        if mode not in ("queue", "replace", "blend"):
+            raise ValueError(f"unknown motion mode {mode}")
+        trajectory = Trajectory(self.robot, keyframes, self._next_id)
+        self._next_id += 1
+
+        if mode == "queue":
+            self._queue.append(trajectory)
+            return trajectory.id
+
+        self._queue = []
+        now = time.ticks_ms()
+        if mode == "blend" and self._active and blend_ms > 0:
+            self._fading = self._active
+            self._blend_start = now
+            self._blend_ms = blend_ms
+        else:
+            self._fading = None
+        self._begin(trajectory, now)
+        return trajectory.id
+
+    def cancel(self):
+        """Stop all motion, the joints hold their current angles"""
+        self._active = None
+        self._fading = None
+        self._queue = []
+
+    def _begin(self, trajectory: Trajectory, now: int):
+        positions = self._positions
+        joints = self.robot.joint_list
+        for joint_index in range(self._joint_count):
+            if not trajectory.used[joint_index]:
+                continue
+            angle = joints[joint_index].angle
+            if angle is None:
+                # Disabled servos start at their first target
+                offset = joint_index
+                while trajectory.targets[offset] == HOLD:
+                    offset += self._joint_count
+                positions[joint_index] = trajectory.targets[offset]
+            else:
+                positions[joint_index] = int(angle * 10)
+        trajectory.begin(now, positions)
+        self._active = trajectory
+
+    def tick(self):
+        active = self._active
+        if active is None:
+            if not self._queue:
+                return
+            active = self._queue.pop(0)
+            self._begin(active, time.ticks_ms())
+
+        now = time.ticks_ms()
+        running = active.evaluate(now)
+        output = active.output
+        used = active.used
+        joints = self.robot.joint_list
+
+        fading = self._fading
+        weight = ONE
+        if fading:
+            fading.evaluate(now)
+            weight = time.ticks_diff(now, self._blend_start) * ONE // self._blend_ms
+            if weight >= ONE:
+                self._fading = None
+                fading = None
+                weight = ONE
+
+        for joint_index in range(self._joint_count):
+            if fading and fading.used[joint_index]:
+                position = fading.output[joint_index]
+                if used[joint_index]:
+                    position += (output[joint_index] - position) * weight // ONE
+            elif used[joint_index]:
+                position = output[joint_index]
+            else:
+                continue
+            joints[joint_index].stage_angle(position / 10)
+
+        if not running and not fading:
+            self._active = None
+            self._completed += 1
+            if self._queue:
+                self._begin(self._queue.pop(0), now)
+
+    def status(self):
+        now = time.ticks_ms()
+        status = {
+            "playing": self._active is not None,
+            "blending": self._fading is not None,
+            "queued": len(self._queue),
+            "completed": self._completed,
+        }
+        if self._active:
+            status.update(self._active.progress(now))
+        return status
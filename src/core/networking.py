@@ -1,83 +1,440 @@
+import time
 import network
 import json
+import ustruct
+from array import array
 from libs import logging
 from libs.websockets.ws_server import (
     WebSocketServer,
     WebSocketClient,
     ClientClosedError,
 )
+from libs.websockets.ws_connection import (
+    OP_BINARY,
+    DEFAULT_QUEUE_SIZE,
+    DEFAULT_QUEUE_BYTES,
+    OVERFLOW_DROP_OLDEST,
+    OVERFLOW_DISCONNECT,
+)
+from .metrics import Histogram
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+# Binary RPC messages carry the hot control commands, JSON text messages are
+# used for everything else. All values are little endian.
+# request: method id u8, sequence u16, count u8, count * (joint index u8, angle i16)
+# ack:     method id | 0x80 u8, sequence u16, status u8, count u8, count * (joint index u8, angle i16)
+# Angles are in tenths of a degree, a disabled servo reads as BINARY_ANGLE_NONE.
+BINARY_HEADER = "<BHB"
+BINARY_HEADER_SIZE = 4
+BINARY_ACK_HEADER = "<BHBB"
+BINARY_ACK_HEADER_SIZE = 5
+BINARY_JOINT = "<Bh"
+BINARY_JOINT_SIZE = 3
+BINARY_MAX_JOINTS = 32
+BINARY_ANGLE_NONE = -32768
+
+# Most requests accepted in a single batch message
+MAX_BATCH_SIZE = 32
+
+# Seconds between checks of the wifi connection
+WIFI_POLL_INTERVAL = 0.05
+
+# Binary method ids
+BINARY_SET_JOINTS = 0x01
+BINARY_GET_JOINTS = 0x02
+
+# Binary ack status
+BINARY_OK = 0
+BINARY_UNKNOWN_METHOD = 1
+BINARY_MALFORMED = 2
+BINARY_ERROR = 3
+BINARY_NOT_CONTROLLER = 4
+
+# Messages and microseconds a client is handled for before the next client,
+# the client holding the control lease gets the larger budget
+READ_BUDGET = (2, 2000)
+CONTROLLER_READ_BUDGET = (8, 10000)
+
+# How long the control lease lasts unless it is renewed, in milliseconds
+DEFAULT_LEASE_MS = 5000
+
+_logger = logging.getLogger(name="robot-server")
+
+
+class RawJson:
+    """An RPC result that is already serialised, it is copied into the
+    response instead of being encoded again"""
+
+    def __init__(self, text: str):
+        self.text = text
+
+
+def encode_response(response: dict):
+    """The JSON text of a response dict"""
+    payload = response.get("payload", None)
+    if not isinstance(payload, RawJson):
+        return json.dumps(response)
+    rest = {}
+    for key, value in response.items():
+        if key != "payload":
+            rest[key] = value
+    # rest always has the method so the text ends with the closing brace
+    return json.dumps(rest)[:-1] + ', "payload": ' + payload.text + "}"
+
+
+class ControlLease:
+    """
+    The client allowed to run control commands. While a client holds the lease
+    the other clients are read only, without a holder every client may control
+    the robot. The lease ends after its duration unless the holder acquires it
+    again, when the holder releases it or disconnects.
+    """
+
+    def __init__(self):
+        self._holder = None
+        self._expires = 0
+
+    @property
+    def holder(self):
+        holder = self._holder
+        if holder is not None and (
+            holder.connection.is_closed()
+            or time.ticks_diff(self._expires, time.ticks_ms()) <= 0
+        ):
+            self._holder = None
+            holder = None
+        return holder
+
+    def allows(self, client):
+        holder = self.holder
+        return holder is None or holder is client
+
+    def acquire(self, client, duration_ms: int = DEFAULT_LEASE_MS):
+        """Take or renew the lease, returns False when another client holds it"""
+        if not self.allows(client):
+            return False
+        if self._holder is not client:
+            _logger.info("control lease taken by %s", client.connection.address)
+        self._holder = client
+        self._expires = time.ticks_add(time.ticks_ms(), duration_ms)
+        return True
+
+    def release(self, client):
+        if self.holder is not client:
+            return False
+        self._holder = None
+        _logger.info("control lease released by %s", client.connection.address)
+        return True
+
+    def status(self, client=None):
+        holder = self.holder
+        status = {"held": holder is not None, "holder": holder is client}
+        if holder is not None:
+            status["expires_in_ms"] = time.ticks_diff(self._expires, time.ticks_ms())
+        return status
 
 
 class RobotServerClient(WebSocketClient):
     __commands: dict = {}
+    __binary_commands: dict = {}
+    __client_commands: set = None
+    __control_commands: set = None
+    __lease: ControlLease = None
 
-    def __init__(self, conn, commands: dict = None):
+    def __init__(
+        self,
+        conn,
+        commands: dict = None,
+        binary_commands: dict = None,
+        histogram: Histogram = None,
+        client_commands: set = None,
+        control_commands: set = None,
+        lease: ControlLease = None,
+    ):
         super().__init__(conn)
         self.__commands = commands
+        self.__binary_commands = binary_commands or {}
+        # Commands called with this client as the client keyword argument
+        self.__client_commands = client_commands or set()
+        # Names and binary ids of the commands limited to the lease holder
+        self.__control_commands = control_commands or set()
+        self.__lease = lease
+        self.histogram = histogram  # time spent handling each message
 
-    def process(self):
+        # Preallocated buffers for the binary messages
+        self._indices = bytearray(BINARY_MAX_JOINTS)
+        self._angles = array("h", bytearray(2 * BINARY_MAX_JOINTS))
+        self._ack = bytearray(
+            BINARY_ACK_HEADER_SIZE + BINARY_JOINT_SIZE * BINARY_MAX_JOINTS
+        )
+
+    async def process(self):
         try:
-            msg = self.connection.read()
+            msg = await self.connection.read()
             if not msg:
                 return
+            start = time.ticks_us()
+            if self.connection.opcode == OP_BINARY:
+                await self.process_binary(msg)
+            else:
+                await self.process_json(msg)
+            if self.histogram:
+                self.histogram.record(time.ticks_diff(time.ticks_us(), start))
+        except ClientClosedError:
+            self.connection.close()
+
+    async def process_json(self, msg):
+        try:
+            size = len(msg)
             msg = msg.decode("utf-8")
-            print(f"WebSocket RPC request text: {msg}")
+            if __debug__:
+                _logger.debug("WebSocket RPC request text: %s", msg)
             data = json.loads(msg)
-            
-            rpc_method_name = data.get("method", None)
-            if not rpc_method_name:
-                response = {"type": "error", "msg": "rpc request must have a method name"}
-                self.connection.write(json.dumps(response))
-                return
 
-            rpc_method = self.__commands.get(rpc_method_name, None)
-            if not rpc_method:
-                response = {"type": "error", "msg": "method not found"}
-                self.connection.write(json.dumps(response))
-                return
-            params = data.get("params", None)
-            if params and len(params) > 0:
-                method_response = rpc_method(**params)
+            if isinstance(data, list):
+                # Batch request, run every call in order and answer once
+                if len(data) > MAX_BATCH_SIZE:
+                    raise ValueError(f"batch is limited to {MAX_BATCH_SIZE} requests")
+                response = []
+                for request in data:
+                    request_response = await self.dispatch(request)
+                    response.append(request_response)
+                    profile = self._profile(request)
+                    if profile:
+                        profile.record_sizes(
+                            len(json.dumps(request)),
+                            len(encode_response(request_response)),
+                        )
+                response_json = (
+                    "[" + ", ".join(encode_response(r) for r in response) + "]"
+                )
             else:
-                method_response = rpc_method()
+                response = await self.dispatch(data)
+                response_json = encode_response(response)
+
+            if __debug__:
+                _logger.debug("WebSocket RPC response text: %s", response_json)
+            if not isinstance(data, list):
+                profile = self._profile(data)
+                if profile:
+                    profile.record_sizes(size, len(response_json))
+            await self.connection.write(response_json)
+        except Exception as e:
+            if not isinstance(e, ValueError):
+                _logger.exc(e, "failed to answer a request")
+            response = {"type": "error", "msg": str(e)}
+            await self.connection.write(json.dumps(response))
+
+    def _profile(self, request):
+        """The MethodProfile of a request when its method is profiled"""
+        if not isinstance(request, dict):
+            return None
+        command = self.__commands.get(request.get("method", None), None)
+        return getattr(command, "profile", None)
+
+    async def dispatch(self, data: dict):
+        """Run a single rpc request and return the response dict"""
+        if not isinstance(data, dict):
+            return {"type": "error", "msg": "rpc request must be an object"}
 
-            response = {
+        rpc_method_name = data.get("method", None)
+        if not rpc_method_name:
+            response = {"type": "error", "msg": "rpc request must have a method name"}
+        else:
+            response = await self.call(rpc_method_name, data.get("params", None))
+
+        if "id" in data:
+            response["id"] = data["id"]
+        return response
+
+    async def call(self, rpc_method_name: str, params: dict = None):
+        rpc_method = self.__commands.get(rpc_method_name, None)
+        if not rpc_method:
+            return {"type": "error", "msg": "method not found"}
+        if not self.may_control(rpc_method_name):
+            return {
+                "type": "error",
                 "method": rpc_method_name,
-                "params": params,
-                "payload": method_response
+                "msg": "another client holds the control lease",
             }
 
-            response_json = json.dumps(response)
-            print(f"WebSocket RPC response text: {response_json}")
-            self.connection.write(response_json)
-        except ValueError as e:
-            response = {"type": "error", "msg": str(e)}
-            self.connection.write(json.dumps(response))
-        except ClientClosedError:
-            self.connection.close()
+        try:
+            if rpc_method_name in self.__client_commands:
+                kwargs = dict(params) if params else {}
+                kwargs["client"] = self
+                method_response = rpc_method(**kwargs)
+            elif params and len(params) > 0:
+                method_response = rpc_method(**params)
+            else:
+                method_response = rpc_method()
+            if hasattr(method_response, "send"):
+                # Coroutine handler, let it run without blocking the framework
+                method_response = await method_response
+        except (ValueError, TypeError) as e:
+            return {"type": "error", "method": rpc_method_name, "msg": str(e)}
+        except Exception as e:
+            # A bug in a handler is answered like a bad request, the client
+            # and its connection stay up
+            _logger.exc(e, "rpc %s failed", rpc_method_name)
+            return {"type": "error", "method": rpc_method_name, "msg": str(e)}
+
+        return {
+            "method": rpc_method_name,
+            "params": params,
+            "payload": method_response,
+        }
+
+    def may_control(self, command):
+        """False when command is a control command and another client holds
+        the lease"""
+        if self.__lease is None or command not in self.__control_commands:
+            return True
+        return self.__lease.allows(self)
+
+    async def process_binary(self, msg):
+        """Decode a binary request into the preallocated buffers, run the binary
+        command and answer with a binary ack.
+        Binary commands are called with (indices, angles, count) and return the
+        number of joint values they left in the buffers for the ack."""
+        method_id = 0
+        sequence = 0
+        count = 0
+        status = BINARY_OK
+        if len(msg) < BINARY_HEADER_SIZE:
+            status = BINARY_MALFORMED
+        else:
+            method_id, sequence, count = ustruct.unpack_from(BINARY_HEADER, msg, 0)
+            if (
+                count > BINARY_MAX_JOINTS
+                or len(msg) < BINARY_HEADER_SIZE + BINARY_JOINT_SIZE * count
+            ):
+                status = BINARY_MALFORMED
+
+        binary_method = None
+        if status == BINARY_OK:
+            binary_method = self.__binary_commands.get(method_id, None)
+            if not binary_method:
+                status = BINARY_UNKNOWN_METHOD
+            elif not self.may_control(method_id):
+                binary_method = None
+                status = BINARY_NOT_CONTROLLER
+
+        if binary_method:
+            indices = self._indices
+            angles = self._angles
+            offset = BINARY_HEADER_SIZE
+            for i in range(count):
+                # Read the bytes of BINARY_JOINT directly, unpack_from would
+                # make a tuple for every joint
+                indices[i] = msg[offset]
+                angle = msg[offset + 1] | msg[offset + 2] << 8
+                angles[i] = angle - 0x10000 if angle & 0x8000 else angle
+                offset += BINARY_JOINT_SIZE
+            try:
+                count = binary_method(indices, angles, count)
+            except ValueError:
+                status = BINARY_ERROR
+            except Exception as e:
+                _logger.exc(e, "binary method %d failed", method_id)
+                status = BINARY_ERROR
+
+        if status != BINARY_OK:
+            count = 0
+        ack = self._ack
+        ustruct.pack_into(
+            BINARY_ACK_HEADER, ack, 0, method_id | 0x80, sequence, status, count
+        )
+        offset = BINARY_ACK_HEADER_SIZE
+        for i in range(count):
+            ustruct.pack_into(
+                BINARY_JOINT, ack, offset, self._indices[i], self._angles[i]
+            )
+            offset += BINARY_JOINT_SIZE
+        profile = getattr(binary_method, "profile", None)
+        if profile:
+            profile.record_sizes(len(msg), offset)
+        # The send queue keeps the message until it is drained, the next
+        # request reuses the ack buffer so the queued ack is a copy
+        await self.connection.write(bytes(memoryview(ack)[:offset]))
 
 
 class RobotServer(WebSocketServer):
     __socket_commands: dict = {}
+    __binary_commands: dict = {}
 
-    def __init__(self):
-        super().__init__("index.html", 8)
+    def __init__(
+        self,
+        static_dir: str,
+        queue_size: int,
+        queue_bytes: int,
+        overflow: str,
+        read_budget: tuple = READ_BUDGET,
+        controller_read_budget: tuple = CONTROLLER_READ_BUDGET,
+    ):
+        super().__init__(static_dir, 8, queue_size, queue_bytes, overflow)
+        self.__binary_commands = {}
+        self.__client_commands = set()
+        self.__control_commands = set()
+        self.lease = ControlLease()
+        self.read_budget = read_budget
+        self.controller_read_budget = controller_read_budget
+        self.rpc_histogram = None
 
     def _make_client(self, conn):
-        return RobotServerClient(conn, self.socket_commands)
+        return RobotServerClient(
+            conn,
+            self.socket_commands,
+            self.binary_commands,
+            self.rpc_histogram,
+            self.client_commands,
+            self.control_commands,
+            self.lease,
+        )
+
+    def _read_budget(self, client):
+        if self.lease.holder is client:
+            return self.controller_read_budget
+        return self.read_budget
 
     @property
     def socket_commands(self):
         return self.__socket_commands
 
+    @property
+    def binary_commands(self):
+        return self.__binary_commands
+
+    @property
+    def client_commands(self):
+        return self.__client_commands
+
+    @property
+    def control_commands(self):
+        return self.__control_commands
+
 
 class NetworkManager:
+    """
+    Joins the wifi network and serves the RPC commands over websockets.
+    With a profiler every command is wrapped when it is registered, so its
+    calls, time, errors and message sizes are counted. The profiler is a
+    core.rpc_profiler.RpcProfiler, that module is only imported when profiling
+    is enabled.
+    """
+
     __logger: logging.Logger = None
     __ws_server: RobotServer = None
+    __profiler = None  # RpcProfiler
+    __ssid: str = None
 
-    def __init__(self, network_config: dict):
+    def __init__(self, network_config: dict, profiler=None):
 
         self.__logger = logging.getLogger(name="network-manager")
+        self.__profiler = profiler
         ssid = network_config.get("ssid", None)
         if not ssid:
             raise Exception("network_config dict must contain a ssid key")
@@ -86,21 +443,81 @@ class NetworkManager:
         if not password:
             raise Exception("network_config dict must contain a password key")
 
+        self.port = network_config.get("port", 80)
         self.station = network.WLAN(network.STA_IF)
         self.init_wifi(ssid, password)
 
-        self.__ws_server = RobotServer()
+        # Outbound queue of every client, see WebSocketConnection
+        overflow = network_config.get("send_queue_overflow", OVERFLOW_DROP_OLDEST)
+        if overflow not in (OVERFLOW_DROP_OLDEST, OVERFLOW_DISCONNECT):
+            raise Exception(
+                f"send_queue_overflow must be {OVERFLOW_DROP_OLDEST} or {OVERFLOW_DISCONNECT}"
+            )
+        self.__ws_server = RobotServer(
+            network_config.get("static_dir", "www"),
+            network_config.get("send_queue_size", DEFAULT_QUEUE_SIZE),
+            network_config.get("send_queue_bytes", DEFAULT_QUEUE_BYTES),
+            overflow,
+            tuple(network_config.get("read_budget", READ_BUDGET)),
+            tuple(
+                network_config.get("controller_read_budget", CONTROLLER_READ_BUDGET)
+            ),
+        )
 
     @property
     def logger(self):
         return self.__logger
 
-    def register_command(self, name: str, function):
-        self.logger.debug(f"registering {name} command")
+    @property
+    def rpc_histogram(self):
+        return self.__ws_server.rpc_histogram
+
+    @rpc_histogram.setter
+    def rpc_histogram(self, histogram: Histogram):
+        self.__ws_server.rpc_histogram = histogram
+
+    @property
+    def profiler(self):
+        return self.__profiler
+
+    @property
+    def lease(self):
+        return self.__ws_server.lease
+
+    def register_command(
+        self, name: str, function, pass_client: bool = False, control: bool = False
+    ):
+        """Serve function as the name RPC, with pass_client it is called with
+        the RobotServerClient that sent the request as client. A control
+        command is refused while another client holds the control lease."""
+        self.logger.debug("registering %s command", name)
+        if self.profiler:
+            function = self.profiler.wrap(name, function)
         self.__ws_server.socket_commands[name] = function
+        if pass_client:
+            self.__ws_server.client_commands.add(name)
+        else:
+            self.__ws_server.client_commands.discard(name)
+        self._set_control(name, control)
+
+    def register_binary_command(self, method_id: int, function, control: bool = False):
+        self.logger.debug("registering binary command %d", method_id)
+        if self.profiler:
+            function = self.profiler.wrap(f"binary_{method_id}", function)
+        self.__ws_server.binary_commands[method_id] = function
+        self._set_control(method_id, control)
+
+    def _set_control(self, command, control: bool):
+        if control:
+            self.__ws_server.control_commands.add(command)
+        else:
+            self.__ws_server.control_commands.discard(command)
 
     def init_wifi(self, ssid: str, password: str):
+        """Start joining the wifi network, wait_for_wifi waits for the connection
+        so the robot can be driven while the network comes up"""
         self.logger.info("connecting to wifi")
+        self.__ssid = ssid
         if self.station.isconnected():
             self.logger.debug("wifi already connected")
             return
@@ -109,22 +526,30 @@ class NetworkManager:
         self.logger.debug("activating wifi interface")
         self.station.active(True)
         self.station.connect(ssid, password)
+
+    async def wait_for_wifi(self):
         while not self.station.isconnected():
-            pass
+            await asyncio.sleep(WIFI_POLL_INTERVAL)
         self.logger.info(
-            f"connected to {ssid} network and was given IP: {self.station.ifconfig()[0]}"
+            "connected to %s network and was given IP: %s",
+            self.__ssid,
+            self.station.ifconfig()[0],
         )
-        self.logger.debug(f"{ssid} if config: {self.station.ifconfig()}")
+        self.logger.debug("%s if config: %s", self.__ssid, self.station.ifconfig())
+
+    async def start_ws_server(self):
+        await self.__ws_server.start(self.port)
 
-    def start_ws_server(self):
-        self.__ws_server.start()
+    async def broadcast(self, msg, key=None):
+        await self.__ws_server.broadcast(msg, key)
+
+    def connection_stats(self):
+        """Outbound queue counters of every connected client"""
+        return [client.connection.stats() for client in self.__ws_server.clients]
 
     def stop_ws_server(self):
         self.__ws_server.stop()
 
-    def tick(self):
-        self.__ws_server.process_all()
-
     # Stop server destructor
     def __del__(self):
         self.stop_ws_server()
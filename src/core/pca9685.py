@@ -1,39 +1,121 @@
 import ustruct
 import time
 
+# Registers
+_MODE1 = 0x00
+_LED0_ON_L = 0x06
+_ALL_LED_ON_L = 0xFA
+_PRESCALE = 0xFE
+
+_MODE1_AI = 0x20  # register auto-increment
+_CHANNELS = 16
+
+# ON_L, ON_H, OFF_L, OFF_H with the full off bit set
+_ALL_LED_OFF = b"\x00\x00\x00\x10"
+
 
 class PCA9685:
+    """Driver for the PCA9685 16 channel PWM controller.
+    The driver keeps a shadow copy of the channel, MODE1 and prescale registers.
+    Reads are answered from the shadow copy and writes only reach the bus when a
+    value changes, call sync() to refresh the copy from the chip.
+    The buffers are made once by the constructor, stage() and flush() do not
+    allocate."""
+
     def __init__(self, i2c, address=0x40):
         self.i2c = i2c
         self.address = address
+        # Shadow of the LED0..LED15 ON/OFF registers, frames are built in place
+        # and written to the chip in a single auto-increment burst by flush()
+        self._frame = bytearray(4 * _CHANNELS)
+        self._frame_view = memoryview(self._frame)
+        # Views of the frame by (first << 4 | last) channel, a burst reuses the
+        # view of the last burst over the same channels instead of slicing again
+        self._views = {}
+        self._byte = bytearray(1)  # buffer of single register reads and writes
+        self._dirty = 0  # bit mask of channels changed since the last flush
+        self._mode1 = 0
+        self._prescale = 0
         self.reset()
 
     def _write(self, address, value):
-        self.i2c.writeto_mem(self.address, address, bytearray([value]))
+        self._byte[0] = value
+        self.i2c.writeto_mem(self.address, address, self._byte)
+        if address == _MODE1:
+            self._mode1 = value
+        elif address == _PRESCALE:
+            self._prescale = value
 
     def _read(self, address):
-        return self.i2c.readfrom_mem(self.address, address, 1)[0]
+        self.i2c.readfrom_mem_into(self.address, address, self._byte)
+        return self._byte[0]
 
     def reset(self):
-        self._write(0x00, 0x00)  # Mode1
+        self._write(_MODE1, _MODE1_AI)  # Mode1
+        self.sync()
+
+    def sync(self):
+        """Refresh the shadow registers from the chip, dropping unflushed changes."""
+        self._mode1 = self._read(_MODE1)
+        self._prescale = self._read(_PRESCALE)
+        self.i2c.readfrom_mem_into(self.address, _LED0_ON_L, self._frame)
+        self._dirty = 0
 
     def freq(self, freq=None):
         if freq is None:
-            return int(25000000.0 / 4096 / (self._read(0xFE) - 0.5))
+            return int(25000000.0 / 4096 / (self._prescale - 0.5))
         prescale = int(25000000.0 / 4096.0 / freq + 0.5)
-        old_mode = self._read(0x00)  # Mode 1
-        self._write(0x00, (old_mode & 0x7F) | 0x10)  # Mode 1, sleep
-        self._write(0xFE, prescale)  # Prescale
-        self._write(0x00, old_mode)  # Mode 1
+        if prescale == self._prescale:
+            return
+        old_mode = self._mode1  # Mode 1
+        self._write(_MODE1, (old_mode & 0x7F) | 0x10)  # Mode 1, sleep
+        self._write(_PRESCALE, prescale)  # Prescale
+        self._write(_MODE1, old_mode)  # Mode 1
         time.sleep_us(5)
-        self._write(0x00, old_mode | 0xA1)  # Mode 1, autoincrement on
+        self._write(_MODE1, old_mode | 0xA1)  # Mode 1, autoincrement on
 
     def pwm(self, index, on=None, off=None):
         if on is None or off is None:
-            data = self.i2c.readfrom_mem(self.address, 0x06 + 4 * index, 4)
-            return ustruct.unpack("<HH", data)
-        data = ustruct.pack("<HH", on, off)
-        self.i2c.writeto_mem(self.address, 0x06 + 4 * index, data)
+            return ustruct.unpack_from("<HH", self._frame, 4 * index)
+        if self._holds(index, on, off):
+            if not self._dirty & (1 << index):
+                return
+        else:
+            ustruct.pack_into("<HH", self._frame, 4 * index, on, off)
+        self.i2c.writeto_mem(
+            self.address, _LED0_ON_L + 4 * index, self._view(index, index)
+        )
+        self._dirty &= ~(1 << index)
+
+    def _holds(self, index, on, off):
+        """True when the frame has on and off for the channel, compares the
+        bytes so no tuple is unpacked"""
+        frame = self._frame
+        offset = 4 * index
+        return (
+            frame[offset] | frame[offset + 1] << 8 == on
+            and frame[offset + 2] | frame[offset + 3] << 8 == off
+        )
+
+    def _view(self, first, last):
+        """The frame of channels first to last, the views are kept for reuse"""
+        key = first << 4 | last
+        view = self._views.get(key, None)
+        if view is None:
+            view = self._frame_view[4 * first : 4 * (last + 1)]
+            self._views[key] = view
+        return view
+
+    def _duty_pwm(self, value, invert=False):
+        if not 0 <= value <= 4095:
+            raise ValueError("Out of range")
+        if invert:
+            value = 4095 - value
+        if value == 0:
+            return 0, 4096
+        if value == 4095:
+            return 4096, 0
+        return 0, value
 
     def duty(self, index, value=None, invert=False):
         if value is None:
@@ -42,17 +124,63 @@ class PCA9685:
                 value = 0
             elif pwm == (4096, 0):
                 value = 4095
-            value = pwm[1]
+            else:
+                value = pwm[1]
             if invert:
                 value = 4095 - value
             return value
+        on, off = self._duty_pwm(value, invert)
+        self.pwm(index, on, off)
+
+    def stage(self, index, on, off):
+        """Stage the ON/OFF counts of a channel, they are written by the next flush().
+        Staging the value a channel already has does not mark it dirty."""
+        if not self._holds(index, on, off):
+            ustruct.pack_into("<HH", self._frame, 4 * index, on, off)
+            self._dirty |= 1 << index
+
+    def stage_duty(self, index, value, invert=False):
+        """Stage a duty cycle for a channel, see duty() and flush().
+        Same mapping as _duty_pwm() without building a tuple."""
         if not 0 <= value <= 4095:
             raise ValueError("Out of range")
         if invert:
             value = 4095 - value
         if value == 0:
-            self.pwm(index, 0, 4096)
+            self.stage(index, 0, 4096)
         elif value == 4095:
-            self.pwm(index, 4096, 0)
+            self.stage(index, 4096, 0)
         else:
-            self.pwm(index, 0, value)
+            self.stage(index, 0, value)
+
+    @property
+    def dirty(self):
+        """Bit mask of the channels with changes waiting for flush()"""
+        return self._dirty
+
+    def flush(self):
+        """Write all dirty channels in a single auto-increment burst.
+        The burst runs from the lowest to the highest dirty channel, clean channels
+        in between are rewritten with their current value.
+        Returns the number of channels written."""
+        dirty = self._dirty
+        if not dirty:
+            return 0
+        first = 0
+        while not dirty & (1 << first):
+            first += 1
+        last = _CHANNELS - 1
+        while not dirty & (1 << last):
+            last -= 1
+        self.i2c.writeto_mem(
+            self.address, _LED0_ON_L + 4 * first, self._view(first, last)
+        )
+        self._dirty = 0
+        return last - first + 1
+
+    def release_all(self):
+        """Switch every channel fully off with one write to the ALL_LED registers."""
+        self.i2c.writeto_mem(self.address, _ALL_LED_ON_L, _ALL_LED_OFF)
+        for index in range(_CHANNELS):
+            ustruct.pack_into("<HH", self._frame, 4 * index, 0, 4096)
+        self._dirty = 0
@@ -1,94 +1,208 @@
+import json
+import binascii
 from machine import Pin, I2C
 from .pca9685 import PCA9685
 from .servo import DirectServo, PCAServo
 from .joint import Joint
+from .model import RobotModel, NO_PARENT, load_model
+from .boot_profiler import boot_profiler
 from .util import load_json_config
+from libs import logging
 
-# Global joint cache
-# TODO: Figure out a better way of doing this
-robot_joints = {}
+_logger = logging.getLogger(name="robot")
 
+# Joint config keys passed on to the servo
+SERVO_OPTIONS = (
+    "min_pulse_us",
+    "max_pulse_us",
+    "actuation_range",
+    "angle_resolution",
+    "calibration",
+)
 
-def joint_from_config_dict(joint_config: dict, attachments: dict):
-    joint_servo_index = joint_config.get("servo_index", "")
-    parts = joint_servo_index.split("/")
+# I2C address of a PCA9685 with none of its address pins set
+PCA9685_DEFAULT_ADDRESS = 0x40
+
+
+def parse_address(address):
+    """An I2C address from a config, a number or a string such as "0x41" """
+    if isinstance(address, str):
+        return int(address, 0)
+    return int(address)
+
+
+def pca9685_id(address: int):
+    """Default attachment id of the PCA9685 at address, e.g. pca9685@0x41"""
+    return "pca9685@0x%02x" % address
+
+
+def find_pca9685(board: str, attachments: dict):
+    """The PCA9685 attachment called board, the attachment id of a servo_index"""
+    pca9685 = attachments.get(board, None)
+    if pca9685 is None and board.startswith("pca9685@"):
+        pca9685 = attachments.get(pca9685_id(parse_address(board[8:])), None)
+    if pca9685 is None and board == "pca9685":
+        # servo_index of a single board robot, pca9685/<channel>
+        pca9685 = attachments.get(pca9685_id(PCA9685_DEFAULT_ADDRESS), None)
+        if pca9685 is None:
+            boards = [a for a in attachments.values() if isinstance(a, PCA9685)]
+            if len(boards) == 1:
+                pca9685 = boards[0]
+    if not isinstance(pca9685, PCA9685):
+        return None
+    return pca9685
+
+
+def servo_from_config(
+    joint_name: str, servo_index: str, servo_options: dict, attachments: dict
+):
+    """The servo of a joint. servo_index is gpio/<pin> or
+    <attachment id>/<channel>, e.g. pca9685@0x41/3"""
+    parts = servo_index.split("/")
     if len(parts) < 2:
-        raise Exception(
-            f"invalid servo_index for joint {joint_config['name']} too few parts"
-        )
+        raise Exception(f"invalid servo_index for joint {joint_name} too few parts")
 
-    servo = None
     if (parts[0]) == "gpio":
         servo_pin = str(parts[1])
         if not servo_pin:
             raise Exception(
-                f"invalid servo_index for joint {joint_config['name']}, gpio/pin is not valid"
+                f"invalid servo_index for joint {joint_name}, gpio/pin is not valid"
             )
-        servo = DirectServo(Pin(int(servo_pin)))
-        print(f"created a DirectServo on gpio pin {servo_pin}")
-    elif (parts[0]) == "pca9685":
-        pca9685 = attachments.get("pca9685", None)
+        _logger.debug("created a DirectServo on gpio pin %s", servo_pin)
+        return DirectServo(Pin(int(servo_pin)), **servo_options)
+
+    if parts[0]:
+        pca9685 = find_pca9685(parts[0], attachments)
         if not pca9685:
             raise Exception(
-                f"invalid servo_index for joint {joint_config['name']}, pca9685 attachment not found"
+                f"invalid servo_index for joint {joint_name}, {parts[0]} attachment not found"
             )
 
         servo_channel = str(parts[1])
         if not servo_channel:
             raise Exception(
-                f"invalid servo_index for joint {joint_config['name']}, pca9685/channel is not valid"
+                f"invalid servo_index for joint {joint_name}, {parts[0]}/channel is not valid"
             )
 
-        servo = PCAServo(pca9685, channel=int(servo_channel))
-        print(f"created a PCAServo on pca9685 channel {servo_channel}")
-    else:
-        raise Exception(
-            f"invalid joint config for joint {joint_config['name']} servo_index is required"
-        )
-
-    joint_children_config = joint_config.get("children", [])
-    children = []
-    for joint_child_config in joint_children_config:
-        print(
-            f"{joint_config['name']} child count {len(joint_child_config.get('children',[]))}"
-        )
-        print(
-            f"adding joint child {joint_child_config['name']} to parent {joint_config['name']}"
-        )
-        children.append(joint_from_config_dict(joint_child_config, attachments))
-        print(
-            f"{joint_config['name']} child count {len(joint_child_config.get('children',[]))}"
-        )
-
-    new_joint = Joint(
-        name=joint_config["name"],
-        servo=servo,
-        min_angle=joint_config.get("min_angle", None),
-        max_angle=joint_config.get("max_angle", None),
-        home_angle=joint_config.get("home_angle", 0),
+        _logger.debug("created a PCAServo on %s channel %s", parts[0], servo_channel)
+        return PCAServo(pca9685, channel=int(servo_channel), **servo_options)
+
+    raise Exception(
+        f"invalid joint config for joint {joint_name} servo_index is required"
     )
 
-    for child in children:
-        child.parent = new_joint
 
-    new_joint.children = children
+def i2c_from_config(attachment_config: dict, sda_pin: int, scl_pin: int):
+    options = {}
+    if "freq" in attachment_config:
+        options["freq"] = int(attachment_config["freq"])
+    bus = attachment_config.get("bus", None)
+    if bus is None:
+        return I2C(sda=Pin(sda_pin), scl=Pin(scl_pin), **options)
+    # A hardware I2C peripheral, ESP32 has buses 0 and 1
+    return I2C(int(bus), sda=Pin(sda_pin), scl=Pin(scl_pin), **options)
+
+
+def attachments_from_config(attachments_config: list):
+    """The attachments of a robot config by id.
+    A pca9685 attachment is on the I2C bus of its sda_pin and scl_pin, every
+    board on the same pins shares one bus. Its address defaults to 0x40 and its
+    id to pca9685@<address>, boards with the same address on different buses
+    need an id of their own."""
+    attachments = {}
+    buses = {}
+    for attachment_config in attachments_config:
+        if attachment_config.get("type", None) == "pca9685":
+            sda_pin = attachment_config.get("sda_pin", None)
+            if not sda_pin:
+                raise Exception(
+                    "attachment config type: pca9685 must specify an sda_pin"
+                )
+
+            scl_pin = attachment_config.get("scl_pin", None)
+            if not scl_pin:
+                raise Exception(
+                    "attachment config type: pca9685 must specify an scl_pin"
+                )
+
+            pins = (int(sda_pin), int(scl_pin))
+            i2c = buses.get(pins, None)
+            if i2c is None:
+                i2c = i2c_from_config(attachment_config, pins[0], pins[1])
+                buses[pins] = i2c
+
+            address = parse_address(
+                attachment_config.get("address", PCA9685_DEFAULT_ADDRESS)
+            )
+            attachment_id = attachment_config.get("id", None) or pca9685_id(address)
+            if attachment_id in attachments:
+                raise Exception(
+                    f"attachment id {attachment_id} is used more than once, give the attachments an id"
+                )
 
-    robot_joints[new_joint.name] = new_joint
+            _logger.info(
+                "created an i2c pca9685 attachment %s on sda_pin: %s, scl_pin: %s",
+                attachment_id,
+                sda_pin,
+                scl_pin,
+            )
 
-    return new_joint
+            attachments[attachment_id] = PCA9685(i2c, address)
+    return attachments
 
 
 class Robot:
     __name: str
     __joints: dict = None  # Dict[str, Joint]
+    __joint_names: list = None  # List[str]
+    __joint_list: list = None  # List[Joint]
+    __parents: bytearray = None
     __attachments: dict = None
+    __boards: list = None  # List[PCA9685] in flush order
+    __model: RobotModel = None
 
-    def __init__(self, name: str, joints: dict, attachments: dict = None):
+    def __init__(
+        self,
+        name: str,
+        joints: dict,
+        attachments: dict = None,
+        joint_names: list = None,
+        model: RobotModel = None,
+    ):
         self.__name = name
+        self.__model = model
         self.__joints = joints
 
+        # Joints are addressed by their position in joint_names by
+        # the binary RPC messages
+        if joint_names is None:
+            joint_names = sorted(joints)
+        self.__joint_names = joint_names
+        self.__joint_list = [joints[name] for name in joint_names]
+
+        # parents[i] is the index of the parent of joint i or NO_PARENT
+        self.__parents = bytearray(len(joint_names))
+        for index, joint in enumerate(self.__joint_list):
+            joint.index = index
+        for index, joint in enumerate(self.__joint_list):
+            if joint.parent is not None:
+                self.__parents[index] = joint.parent.index
+            else:
+                self.__parents[index] = NO_PARENT
+
+        self.__boards = []
         if attachments is not None:
             self.__attachments = attachments
+            # Boards are flushed bus by bus so each bus is written back to back
+            boards = [a for a in attachments.values() if isinstance(a, PCA9685)]
+            buses = []
+            for board in boards:
+                if not any(board.i2c is bus for bus in buses):
+                    buses.append(board.i2c)
+            for bus in buses:
+                on_bus = [board for board in boards if board.i2c is bus]
+                on_bus.sort(key=lambda board: board.address)
+                self.__boards.extend(on_bus)
 
     @property
     def name(self):
@@ -98,55 +212,142 @@ class Robot:
     def joints(self):
         return self.__joints
 
+    @property
+    def joint_names(self):
+        return self.__joint_names
+
+    @property
+    def joint_list(self):
+        return self.__joint_list
+
+    @property
+    def parents(self):
+        return self.__parents
+
+    @property
+    def model(self):
+        """The RobotModel the robot was built from, holds the link geometry"""
+        return self.__model
+
     @property
     def attachments(self):
         return self.__attachments
 
+    @property
+    def boards(self):
+        """The PCA9685 attachments grouped by I2C bus"""
+        return self.__boards
+
+    def joint_index(self, name: str):
+        """Position of a joint in joint_names"""
+        for index, joint_name in enumerate(self.joint_names):
+            if joint_name == name:
+                return index
+        raise ValueError(f"unknown joint {name}")
+
+    def apply_pose(self, pose: dict):
+        """Move several joints together.
+        pose maps joint names to angles. The new angles are staged on every joint
+        and then flushed, so the servos on each PCA9685 are written in one burst
+        and start moving in the same PWM period.
+        Angles are clamped to the joint limits, an unknown joint or an angle
+        outside the servo range rejects the whole pose before anything is
+        staged, so a later flush never writes half of it."""
+        joints = self.joints
+        for name in pose:
+            joint = joints.get(name, None)
+            if joint is None:
+                raise ValueError(f"unknown joint {name}")
+            joint.check_angle(joint.clamp(pose[name]))
+
+        # Looking the angle up by name instead of iterating items() does not
+        # make a tuple for every joint
+        for name in pose:
+            joints[name].stage_angle(pose[name])
+        self.flush()
+
+    def flush(self):
+        """Write all staged servo values, one burst per board with changes"""
+        for board in self.__boards:
+            board.flush()
+
+    def release(self):
+        """Switch off every servo driven by an attachment"""
+        for board in self.__boards:
+            board.release_all()
+
     @staticmethod
     def get_config(name: str):
         return load_json_config(f"config/robots/{name}.json")
 
     @staticmethod
-    def from_config(name: str):
-        robo_config = Robot.get_config(name)
-
-        # Attachments
-        attachments = {}
-        for attachment_config in robo_config.get("attachments", []):
-            if attachment_config.get("type", None) == "pca9685":
-                sda_pin = attachment_config.get("sda_pin", None)
-                if not sda_pin:
-                    raise Exception(
-                        "attachment config type: pca9685 must specify an sda_pin"
-                    )
-
-                scl_pin = attachment_config.get("scl_pin", None)
-                if not scl_pin:
-                    raise Exception(
-                        "attachment config type: pca9685 must specify an scl_pin"
-                    )
-
-                i2c = I2C(sda=Pin(int(sda_pin)), scl=Pin(int(scl_pin)))
-
-                print(
-                    f"created an i2c pca9685 attachment on sda_pin: {sda_pin}, scl_pin: {scl_pin}"
-                )
+    def from_model(model: RobotModel):
+        attachments = attachments_from_config(model.attachments)
+        boot_profiler.mark("attachments")
 
-                attachments["pca9685"] = PCA9685(i2c)
+        joints = {}
+        joint_list = []
+        for index in range(len(model.names)):
+            name = model.names[index]
+            options = model.options[index] or {}
+            servo_options = {}
+            for option in SERVO_OPTIONS:
+                if option in options:
+                    servo_options[option] = options[option]
 
-        # Joints Dict[str, Joint]
+            joint = Joint(
+                name=name,
+                servo=servo_from_config(
+                    name, model.servo_indexes[index], servo_options, attachments
+                ),
+                min_angle=model.min_angles[index],
+                max_angle=model.max_angles[index],
+                home_angle=model.home_angles[index],
+                index=index,
+            )
 
-        joints_config = robo_config.get("joints", [])
+            # Parents always come before their children in a model
+            parent = model.parents[index]
+            if parent != NO_PARENT:
+                joint.parent = joint_list[parent]
+                joint.parent.children.append(joint)
 
-        # Initialise the joints for the robot
-        # In the first pass initialise the joints
-        # In the second pass link up the parent relations
+            joints[name] = joint
+            joint_list.append(joint)
 
-        for joint_config in joints_config:
-            print(f"joint config len: {len(joints_config)}")
-            if joint_config["name"] not in robot_joints:
-                robot_joints[joint_config["name"]] = joint_from_config_dict(
-                    joint_config, attachments
-                )
+        robot = Robot(model.name, joints, attachments, model.names, model)
+        boot_profiler.mark("joints")
+        return robot
+
+    @staticmethod
+    def load_model(name: str):
+        """Load the compiled model of config/robots/<name>.json.
+        The model is cached in config/robots/<name>.model and compiled again
+        when the crc32 of the json no longer matches the cache."""
+        source_path = f"config/robots/{name}.json"
+        model_path = f"config/robots/{name}.model"
+        with open(source_path, "rb") as source_file:
+            source = source_file.read()
+        source_crc = binascii.crc32(source)
+
+        model = load_model(model_path, source_crc)
+        if model is not None:
+            boot_profiler.mark("robot_config")
+            return model
+
+        # The compiler is only needed when the cache is stale
+        from .model_compiler import compile_model, dump_model
 
-        return Robot(robo_config["name"], robot_joints, attachments)
+        _logger.info("compiling robot model %s", model_path)
+        model = compile_model(json.loads(source))
+        try:
+            with open(model_path, "wb") as model_file:
+                model_file.write(dump_model(model, source_crc))
+        except OSError:
+            _logger.warning("unable to write the robot model %s", model_path)
+        boot_profiler.mark("robot_config")
+        return model
+
+    @staticmethod
+    def from_config(name: str):
+        return Robot.from_model(Robot.load_model(name))
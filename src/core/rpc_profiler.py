@@ -0,0 +1,99 @@
+import time
+
+
+class MethodProfile:
+    """Counters of a single RPC method, times are in microseconds"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.calls = 0
+        self.errors = 0
+        self.total_us = 0
+        self.max_us = 0
+        self.request_bytes = 0
+        self.response_bytes = 0
+
+    def record(self, duration: int, error: bool):
+        self.calls += 1
+        self.total_us += duration
+        if duration > self.max_us:
+            self.max_us = duration
+        if error:
+            self.errors += 1
+
+    def record_sizes(self, request_bytes: int, response_bytes: int):
+        self.request_bytes += request_bytes
+        self.response_bytes += response_bytes
+
+    def stats(self):
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "total_us": self.total_us,
+            "mean_us": self.total_us // self.calls if self.calls else 0,
+            "max_us": self.max_us,
+            "request_bytes": self.request_bytes,
+            "response_bytes": self.response_bytes,
+        }
+
+
+class ProfiledCommand:
+    """Wraps an RPC handler and records its calls in profile.
+    Coroutine handlers are timed until they complete."""
+
+    def __init__(self, function, profile: MethodProfile):
+        self.function = function
+        self.profile = profile
+
+    def __call__(self, *args, **kwargs):
+        start = time.ticks_us()
+        try:
+            result = self.function(*args, **kwargs)
+        except Exception:
+            self.profile.record(time.ticks_diff(time.ticks_us(), start), True)
+            raise
+        if hasattr(result, "send"):
+            return self._finish(result, start)
+        self.profile.record(time.ticks_diff(time.ticks_us(), start), False)
+        return result
+
+    async def _finish(self, coroutine, start: int):
+        try:
+            result = await coroutine
+        except Exception:
+            self.profile.record(time.ticks_diff(time.ticks_us(), start), True)
+            raise
+        self.profile.record(time.ticks_diff(time.ticks_us(), start), False)
+        return result
+
+
+class RpcProfiler:
+    """
+    Opt-in per method accounting of the RPC handlers. NetworkManager wraps
+    every command in a ProfiledCommand when it is registered, the message sizes
+    are added by RobotServerClient.
+    """
+
+    def __init__(self):
+        self._profiles = {}
+
+    def wrap(self, name: str, function):
+        profile = self._profiles.get(name, None)
+        if profile is None:
+            profile = MethodProfile()
+            self._profiles[name] = profile
+        return ProfiledCommand(function, profile)
+
+    def reset(self):
+        for profile in self._profiles.values():
+            profile.reset()
+
+    def report(self):
+        """Stats of every method called since the last reset"""
+        report = {}
+        for name, profile in self._profiles.items():
+            if profile.calls:
+                report[name] = profile.stats()
+        return report
@@ -0,0 +1,220 @@
+import time
+from libs import logging
+from .metrics import Metrics
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+# Failed runs in a row after which a task backs off
+MAX_TASK_ERRORS = 10
+# Longest extra wait between the runs of a failing task
+MAX_BACKOFF_US = 1000000
+
+
+class Task:
+    """A callback the Scheduler runs at a fixed rate"""
+
+    def __init__(self, name: str, callback, rate_hz: float, priority: int = 0):
+        self.name = name
+        self.callback = callback
+        self.period_us = int(1000000 / rate_hz)
+        self.priority = priority
+        self.deadline = time.ticks_us()
+
+        self.runs = 0
+        self.overruns = 0
+        self.reported_overruns = 0
+        self.last_us = 0
+        self.max_us = 0
+        self.errors = 0
+        self.errors_in_row = 0
+        self.backoff_us = 0  # Extra wait between runs while the task keeps failing
+        self.durations = None  # Histogram
+        self.lateness = None  # Histogram
+
+    def stats(self):
+        return {
+            "rate_hz": 1000000 / self.period_us,
+            "priority": self.priority,
+            "runs": self.runs,
+            "overruns": self.overruns,
+            "last_us": self.last_us,
+            "max_us": self.max_us,
+            "errors": self.errors,
+            "backoff_us": self.backoff_us,
+        }
+
+
+class Scheduler:
+    """
+    Cooperative scheduler running each registered task at its own rate.
+    When several tasks are due the one with the highest priority runs first,
+    between deadlines the scheduler sleeps instead of polling, either with
+    run() or inside an asyncio event loop with run_async().
+    A task overruns when it takes longer than its period or starts more than a
+    period late, overruns are counted per task and reported in the log.
+    With metrics the duration of every run and how late it started are
+    recorded in the <name>_us and <name>_late_us histograms, a task starts
+    late when the event loop or another task held on to the CPU.
+    An exception raised by a task is logged and the other tasks keep running,
+    a task failing MAX_TASK_ERRORS times in a row keeps being retried with a
+    wait doubling up to MAX_BACKOFF_US, it runs at its rate again after the
+    first run that succeeds.
+    Args:
+        report_interval_ms (int): Minimum time between two overrun reports.
+        metrics (Metrics): Where to record the task timings.
+    """
+
+    __logger: logging.Logger = None
+
+    def __init__(self, report_interval_ms: int = 5000, metrics: Metrics = None):
+        self.__logger = logging.getLogger(name="scheduler")
+        self._metrics = metrics
+        self._tasks = []
+        self._running = False
+        self._report_interval_ms = report_interval_ms
+        self._last_report = time.ticks_ms()
+
+    @property
+    def logger(self):
+        return self.__logger
+
+    @property
+    def tasks(self):
+        return self._tasks
+
+    def add(self, name: str, callback, rate_hz: float, priority: int = 0):
+        """Run callback rate_hz times a second, returns the new Task"""
+        self.remove(name)
+        task = Task(name, callback, rate_hz, priority)
+        if self._metrics:
+            task.durations = self._metrics.histogram(f"{name}_us", task.period_us)
+            task.lateness = self._metrics.histogram(
+                f"{name}_late_us", task.period_us
+            )
+        self._tasks.append(task)
+        self._tasks.sort(key=lambda t: -t.priority)
+        self.logger.debug("added task %s at %sHz priority %d", name, rate_hz, priority)
+        return task
+
+    def remove(self, name: str):
+        for task in self._tasks:
+            if task.name == name:
+                self._tasks.remove(task)
+                return
+
+    def run_pending(self):
+        """Run every task that is due, returns the microseconds until the next deadline"""
+        for task in self._tasks:
+            start = time.ticks_us()
+            late = time.ticks_diff(start, task.deadline)
+            if late < 0:
+                continue
+
+            try:
+                task.callback()
+                if task.errors_in_row:
+                    self._recovered(task)
+            except Exception as e:
+                self._failed(task, e)
+
+            end = time.ticks_us()
+            duration = time.ticks_diff(end, start)
+            task.runs += 1
+            task.last_us = duration
+            if duration > task.max_us:
+                task.max_us = duration
+            if duration > task.period_us or late > task.period_us:
+                task.overruns += 1
+            if task.durations:
+                task.durations.record(duration)
+                task.lateness.record(late)
+
+            task.deadline = time.ticks_add(task.deadline, task.period_us)
+            if time.ticks_diff(task.deadline, end) < 0:
+                # Fell behind, skip the missed periods instead of bursting
+                task.deadline = time.ticks_add(end, task.period_us)
+            if task.backoff_us:
+                task.deadline = time.ticks_add(task.deadline, task.backoff_us)
+
+        self._report_overruns()
+
+        now = time.ticks_us()
+        wait = None
+        for task in self._tasks:
+            until = time.ticks_diff(task.deadline, now)
+            if wait is None or until < wait:
+                wait = until
+        if wait is None or wait < 0:
+            return 0
+        return wait
+
+    def _failed(self, task: Task, e: Exception):
+        task.errors += 1
+        task.errors_in_row += 1
+        self.logger.exc(e, "task %s failed", task.name)
+        if task.errors_in_row >= MAX_TASK_ERRORS:
+            task.backoff_us = min(
+                2 * task.backoff_us or task.period_us, MAX_BACKOFF_US
+            )
+            self.logger.error(
+                "task %s failed %d times in a row, retrying in %dus",
+                task.name,
+                task.errors_in_row,
+                task.period_us + task.backoff_us,
+            )
+
+    def _recovered(self, task: Task):
+        if task.backoff_us:
+            self.logger.info(
+                "task %s recovered after %d failures in a row",
+                task.name,
+                task.errors_in_row,
+            )
+        task.errors_in_row = 0
+        task.backoff_us = 0
+
+    def _report_overruns(self):
+        now = time.ticks_ms()
+        if time.ticks_diff(now, self._last_report) < self._report_interval_ms:
+            return
+        self._last_report = now
+        for task in self._tasks:
+            if task.overruns != task.reported_overruns:
+                self.logger.warning(
+                    "task %s overran %d times, max %dus for a %dus period",
+                    task.name,
+                    task.overruns - task.reported_overruns,
+                    task.max_us,
+                    task.period_us,
+                )
+                task.reported_overruns = task.overruns
+
+    def run(self):
+        """Run the tasks until stop() is called"""
+        self._running = True
+        while self._running:
+            wait = self.run_pending()
+            if wait >= 1000:
+                time.sleep_ms(wait // 1000)
+            elif wait > 0:
+                time.sleep_us(wait)
+
+    async def run_async(self):
+        """Run the tasks until stop() is called, other coroutines such as the
+        websocket server run while the scheduler waits for the next deadline"""
+        self._running = True
+        while self._running:
+            wait = self.run_pending()
+            await asyncio.sleep(wait / 1000000)
+
+    def stop(self):
+        self._running = False
+
+    def stats(self):
+        stats = {}
+        for task in self._tasks:
+            stats[task.name] = task.stats()
+        return stats
@@ -1,50 +1,158 @@
-import math
+from array import array
 from machine import PWM, Pin
 from .pca9685 import PCA9685
+from libs import logging
+
+_logger = logging.getLogger(name="servo")
 
 
 def map_angle(x, in_min, in_max, out_min, out_max):
     return int((x - in_min) * (out_max - out_min) / (in_max - in_min) + out_min)
 
 
+# Lookup tables of servos without calibration points are shared,
+# keyed by (type, freq, min_pulse, max_pulse, actuation_range, resolution)
+_lut_cache = {}
+
+
 class Servo:
     """
     A abstract base class for controlling hobby servos.
     Parent classes must implement the duty methos
+    Angles are converted to duty cycles with a lookup table built once at
+    construction, so setting an angle costs a single table index.
     Args:
         freq (int): The frequency of the signal, in hertz.
         min_pulse_us (int microseconds): The minimum signal length supported by the servo.
         max_pulse_us (int microseconds): The maximum signal length supported by the servo.
         actuation_range (int): The range between the minimum and maximum positions.
+        angle_resolution (float): The angle step in degrees of the lookup table.
+        calibration (list): Optional ``[angle, pulse_us]`` points, sorted by angle,
+            the pulse width is interpolated linearly between them. Replaces the
+            linear ``min_pulse_us`` to ``max_pulse_us`` mapping.
     """
 
+    __slots__ = (
+        "freq",
+        "actuation_range",
+        "angle_resolution",
+        "calibration",
+        "_min_duty",
+        "_duty_range",
+        "_lut_scale",
+        "_lut",
+    )
+
     def __init__(
         self,
         freq=50,
         min_pulse_us: int = 500,
         max_pulse_us: int = 2000,
         actuation_range: int = 180,
+        angle_resolution: float = 0.5,
+        calibration: list = None,
     ):
         self.freq = freq
-        self.set_pulse_width_range(min_pulse_us, max_pulse_us)
         """The physical range of motion of the servo in degrees."""
         self.actuation_range = actuation_range
+        self.angle_resolution = angle_resolution
+        self.calibration = calibration
+        self.set_pulse_width_range(min_pulse_us, max_pulse_us)
 
     def _us2duty(self, value):
         period = 1000000 / self.freq
-        print(f"period: {period}")
         return int(1024 * value / period)
 
     def set_pulse_width_range(self, min_pulse: int = 750, max_pulse: int = 2250):
         """Change min and max pulse widths."""
         # self._min_duty = int((min_pulse * self.freq) / 1000000 * 0xFFFF)
         self._min_duty = self._us2duty(min_pulse)
-        print(f"min duty: {self._min_duty}")
         # max_duty = (max_pulse * self.freq) / 1000000 * 0xFFFF
         max_duty = self._us2duty(max_pulse)
-        print(f"max duty: {max_duty}")
         self._duty_range = int(max_duty - self._min_duty)
-        print(f"duty range: {self._duty_range}")
+        _logger.debug(
+            "min duty: %d max duty: %d duty range: %d",
+            self._min_duty,
+            max_duty,
+            self._duty_range,
+        )
+        self._build_lut(min_pulse, max_pulse)
+
+    def _build_lut(self, min_pulse: int, max_pulse: int):
+        scale = 1 / self.angle_resolution
+        if scale == int(scale):
+            scale = int(scale)  # keep the index calculation in integers
+        self._lut_scale = scale
+        size = int(self.actuation_range * scale) + 1
+
+        key = None
+        if not self.calibration:
+            key = (
+                type(self),
+                self.freq,
+                min_pulse,
+                max_pulse,
+                self.actuation_range,
+                self.angle_resolution,
+            )
+            lut = _lut_cache.get(key, None)
+            if lut:
+                self._lut = lut
+                return
+
+        lut = array("H", bytearray(2 * size))
+        for index in range(size):
+            angle = index / scale
+            if self.calibration:
+                lut[index] = self._us2duty(self._calibrated_pulse(angle))
+            else:
+                lut[index] = self._fraction_to_duty(angle / self.actuation_range)
+        self._lut = lut
+        if key:
+            _lut_cache[key] = lut
+
+    def _calibrated_pulse(self, angle: float):
+        points = self.calibration
+        if len(points) < 2:
+            raise ValueError("calibration needs at least two points")
+        # Pick the segment containing the angle, the end segments extrapolate
+        segment = 1
+        while segment < len(points) - 1 and angle > points[segment][0]:
+            segment += 1
+        angle0, pulse0 = points[segment - 1]
+        angle1, pulse1 = points[segment]
+        return pulse0 + (angle - angle0) * (pulse1 - pulse0) / (angle1 - angle0)
+
+    def _lut_search(self, duty: int, past: bool):
+        # First index whose duty is past (or reaches when past is False) the
+        # given duty, the table may rise or fall with the angle
+        lut = self._lut
+        rising = lut[len(lut) - 1] >= lut[0]
+        low = 0
+        high = len(lut)
+        while low < high:
+            mid = (low + high) // 2
+            value = lut[mid]
+            if rising:
+                before = value <= duty if past else value < duty
+            else:
+                before = value >= duty if past else value > duty
+            if before:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def _duty_to_angle(self, duty: int):
+        first = self._lut_search(duty, False)
+        end = self._lut_search(duty, True)
+        last = len(self._lut) - 1
+        if first > last:
+            return last / self._lut_scale
+        if end <= first:
+            return first / self._lut_scale
+        # Several table entries share the duty, report the centre of the run
+        return (first + end - 1) / 2 / self._lut_scale
 
     @property
     def fraction(self):
@@ -52,43 +160,87 @@ class Servo:
         For conventional servos, corresponds to the servo position as a fraction
         of the actuation range. Is None when servo is diabled (pulsewidth of 0ms).
         """
-        if self.duty() == 0:  # Special case for disabled servos
+        duty = self.duty()
+        if duty == 0:  # Special case for disabled servos
             return None
-        return (self.duty() - self._min_duty) / self._duty_range
+        return (duty - self._min_duty) / self._duty_range
 
     @fraction.setter
     def fraction(self, value: float = None):
+        self.duty(self._fraction_to_duty(value))
+
+    def _fraction_to_duty(self, value: float = None):
         if value is None:
-            self.duty(0)  # disable the motor
-            return
+            return 0  # disable the motor
         if not 0.0 <= value <= 1.0:
             raise ValueError("Must be 0.0 to 1.0")
-        duty_cycle = self._min_duty + int(value * self._duty_range)
-        # print(f"duty: {duty_cycle}")
-        self.duty(duty_cycle)
+        return self._min_duty + int(value * self._duty_range)
 
     @property
     def angle(self):
         """The servo angle in degrees. Must be in the range ``0`` to ``actuation_range``.
         Is None when servo is disabled."""
-        if self.fraction is None:  # special case for disabled servos
+        duty = self.duty()
+        if duty == 0:  # special case for disabled servos
             return None
-        return self.actuation_range * self.fraction
+        return self._duty_to_angle(duty)
 
     @angle.setter
     def angle(self, new_angle: int = None):
+        self.duty(self._angle_to_duty(new_angle))
+
+    def _angle_to_duty(self, new_angle: int = None):
         if new_angle is None:  # disable the servo by sending 0 signal
-            self.fraction = None
-            return
+            return 0
         if new_angle < 0 or new_angle > self.actuation_range:
             raise ValueError("Angle out of range")
-        self.fraction = new_angle / self.actuation_range
+        lut = self._lut
+        index = new_angle * self._lut_scale
+        if type(index) is not int:
+            index = int(index + 0.5)
+        if index >= len(lut):
+            index = len(lut) - 1
+        return lut[index]
+
+    def check_tenths(self, tenths: int):
+        """Raise ValueError when an angle in tenths of a degree is outside the
+        range of the servo"""
+        if tenths < 0 or tenths > 10 * self.actuation_range:
+            raise ValueError("Angle out of range")
+
+    def _tenths_to_duty(self, tenths: int):
+        scale = self._lut_scale
+        if type(scale) is not int:
+            return self._angle_to_duty(tenths / 10)
+        self.check_tenths(tenths)
+        lut = self._lut
+        index = (tenths * scale + 5) // 10
+        if index >= len(lut):
+            index = len(lut) - 1
+        return lut[index]
+
+    def stage_angle(self, new_angle: int = None):
+        """Like setting ``angle`` but the duty is only staged, see ``stage``."""
+        self.stage(self._angle_to_duty(new_angle))
+
+    def stage_tenths(self, tenths: int):
+        """Stage an angle in tenths of a degree. With a whole number of table
+        entries per degree the index is found without floats, which MicroPython
+        would allocate on the heap."""
+        self.stage(self._tenths_to_duty(tenths))
 
     def duty(self, duty: int = None):
         raise Exception("duty function must be implemented in parent")
 
+    def stage(self, duty: int):
+        """Stage a duty cycle to be written by the next flush of the servo controller.
+        Servos without a frame buffer write it straight away."""
+        self.duty(duty)
+
 
 class DirectServo(Servo):
+    __slots__ = ("pin", "pwm")
+
     def __init__(
         self,
         pin: Pin,
@@ -96,19 +248,30 @@ class DirectServo(Servo):
         min_pulse_us=400,
         max_pulse_us=2400,
         actuation_range=180,
+        angle_resolution=0.5,
+        calibration=None,
     ):
         self.pin = pin
         self.pwm = PWM(pin, freq=freq, duty=0)
 
-        super().__init__(freq, min_pulse_us, max_pulse_us, actuation_range)
+        super().__init__(
+            freq,
+            min_pulse_us,
+            max_pulse_us,
+            actuation_range,
+            angle_resolution,
+            calibration,
+        )
 
     def duty(self, duty: int = None):
-        if not duty:
+        if duty is None:
             return self.pwm.duty()
         return self.pwm.duty(duty)
 
 
 class PCAServo(Servo):
+    __slots__ = ("pca9685", "channel")
+
     def __init__(
         self,
         pca9685: PCA9685,
@@ -117,23 +280,34 @@ class PCAServo(Servo):
         min_pulse_us=600,
         max_pulse_us=2700,
         actuation_range=180,
+        angle_resolution=0.5,
+        calibration=None,
     ):
         self.pca9685 = pca9685
         self.pca9685.freq(freq)
         self.channel = channel
 
-        super().__init__(freq, min_pulse_us, max_pulse_us, actuation_range)
+        super().__init__(
+            freq,
+            min_pulse_us,
+            max_pulse_us,
+            actuation_range,
+            angle_resolution,
+            calibration,
+        )
 
     def _us2duty(self, value):
         period = 1000000 / self.freq
-        print(f"period: {period}")
         # TODO: Work out why servos on the pca need 4095
         return int(4095 * value / period)
 
     def duty(self, duty: int = None):
-        if not duty:
+        if duty is None:
             return self.pca9685.duty(self.channel)
         return self.pca9685.duty(self.channel, duty)
 
+    def stage(self, duty: int):
+        self.pca9685.stage_duty(self.channel, duty)
+
     def release(self):
         self.pca9685.duty(self.channel, 0)
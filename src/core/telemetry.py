@@ -0,0 +1,178 @@
+import json
+import time
+from libs import logging
+
+# Frames kept per subscription until the client acknowledges one of them
+MAX_UNACKED_FRAMES = 4
+
+_logger = logging.getLogger(name="telemetry")
+
+
+class Subscription:
+    """
+    A client subscribed to a topic. Frames carry the values that changed since
+    the base frame: the last frame the client acknowledged, or without acks the
+    last frame sent. Sequences start at 1, a base of 0 is a full frame.
+    With acks a frame still waiting in the send queue is replaced by the next
+    one, which holds all its changes. Without acks every frame is needed, no
+    frame is made while the last one is queued.
+    """
+
+    def __init__(self, client, topic: str, period_ms: int, ack: bool):
+        self.client = client
+        self.topic = topic
+        self.key = f"telemetry/{topic}"  # send queue key of the frames
+        self.period_ms = period_ms
+        self.ack = ack
+        self.sequence = 0
+        self.base = 0
+        self.baseline = {}  # values of the base frame
+        self.last_values = None  # values of the last frame sent
+        self.unacked = []  # (sequence, values) of the frames sent since the base
+        self.last_ms = time.ticks_add(time.ticks_ms(), -period_ms)
+        self.frames = 0
+        self.skipped = 0
+
+    def due(self, now: int):
+        return time.ticks_diff(now, self.last_ms) >= self.period_ms
+
+    def delta(self, values: dict):
+        """The values that changed since the base frame"""
+        baseline = self.baseline
+        changed = {}
+        for key, value in values.items():
+            if key not in baseline or baseline[key] != value:
+                changed[key] = value
+        return changed
+
+    def sent(self, values: dict):
+        self.last_values = values
+        if not self.ack:
+            self.base = self.sequence
+            self.baseline = values
+            return
+        self.unacked.append((self.sequence, values))
+        if len(self.unacked) > MAX_UNACKED_FRAMES:
+            # The client is behind on acks, the deltas grow from the old base
+            self.unacked.pop(0)
+
+    def acknowledge(self, sequence: int):
+        for i in range(len(self.unacked)):
+            if self.unacked[i][0] == sequence:
+                self.base = sequence
+                self.baseline = self.unacked[i][1]
+                del self.unacked[: i + 1]
+                return True
+        return False
+
+    def stats(self):
+        return {
+            "rate_hz": 1000 / self.period_ms,
+            "ack": self.ack,
+            "sequence": self.sequence,
+            "base": self.base,
+            "frames": self.frames,
+            "skipped": self.skipped,
+        }
+
+
+class Telemetry:
+    """
+    Pushes topics to the clients subscribed to them instead of having them
+    poll. A topic is a function returning a new dict of values every call,
+    tick() runs from the scheduler and sends a frame to every subscription
+    that is due, with only the values that changed.
+    Every client is limited to max_rate_hz per topic and a topic has at most
+    one frame in the send queue of a client, a client that cannot keep up
+    gets the accumulated changes in a later frame.
+    """
+
+    def __init__(self, max_rate_hz: float = 20):
+        self.max_rate_hz = max_rate_hz
+        self._topics = {}
+        self._subscriptions = []
+
+    @property
+    def topics(self):
+        return list(self._topics.keys())
+
+    def add_topic(self, name: str, source):
+        self._topics[name] = source
+
+    def subscribe(self, client, topic: str, rate_hz: float = 10, ack: bool = True):
+        if topic not in self._topics:
+            raise ValueError(f"unknown topic {topic}, topics are {self.topics}")
+        if not rate_hz or rate_hz <= 0:
+            raise ValueError("rate_hz must be positive")
+        rate_hz = min(rate_hz, self.max_rate_hz)
+        self.unsubscribe(client, topic)
+        subscription = Subscription(client, topic, int(1000 / rate_hz), ack)
+        self._subscriptions.append(subscription)
+        _logger.debug("client subscribed to %s at %sHz", topic, rate_hz)
+        return subscription
+
+    def unsubscribe(self, client, topic: str = None):
+        """Remove the subscription of a client to topic, or all of them"""
+        removed = 0
+        for subscription in list(self._subscriptions):
+            if subscription.client is client and topic in (None, subscription.topic):
+                self._subscriptions.remove(subscription)
+                removed += 1
+        return removed
+
+    def subscription(self, client, topic: str):
+        for subscription in self._subscriptions:
+            if subscription.client is client and subscription.topic == topic:
+                return subscription
+        return None
+
+    def acknowledge(self, client, topic: str, sequence: int):
+        subscription = self.subscription(client, topic)
+        if subscription is None:
+            raise ValueError(f"not subscribed to {topic}")
+        return subscription.acknowledge(sequence)
+
+    def tick(self):
+        if not self._subscriptions:
+            return
+        now = time.ticks_ms()
+        values = {}  # values of each topic, read once per tick
+        for subscription in list(self._subscriptions):
+            client = subscription.client
+            if client.connection.is_closed():
+                self._subscriptions.remove(subscription)
+                continue
+            if not subscription.due(now):
+                continue
+            if not subscription.ack and client.connection.queued(subscription.key):
+                subscription.skipped += 1
+                continue
+            subscription.last_ms = now
+
+            topic = subscription.topic
+            if topic not in values:
+                values[topic] = self._topics[topic]()
+            if values[topic] == subscription.last_values:
+                continue
+            # Can be empty when the values went back to those of the base
+            changed = subscription.delta(values[topic])
+            subscription.sequence += 1
+            frame = json.dumps(
+                {
+                    "type": "telemetry",
+                    "topic": topic,
+                    "sequence": subscription.sequence,
+                    "base": subscription.base,
+                    "payload": changed,
+                }
+            )
+            if client.connection.send(frame, key=subscription.key):
+                subscription.sent(values[topic])
+                subscription.frames += 1
+
+    def stats(self, client=None):
+        stats = {}
+        for subscription in self._subscriptions:
+            if client is None or subscription.client is client:
+                stats[subscription.topic] = subscription.stats()
+        return stats
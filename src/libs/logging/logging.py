@@ -1,4 +1,6 @@
 import sys
+import time
+from array import array
 
 CRITICAL = 50
 ERROR = 40
@@ -27,14 +29,118 @@ class LogRecord:
 
 
 class Handler:
-    def __init__(self):
-        pass
+    def __init__(self, level=NOTSET):
+        self.level = level
+
+    def setLevel(self, level):
+        self.level = level
 
     def setFormatter(self, fmtr):
         pass
 
+    def emit(self, record):
+        pass
+
+
+class StreamHandler(Handler):
+    """Writes records to a stream in the format used without handlers"""
+
+    def __init__(self, stream=None, level=NOTSET):
+        super().__init__(level)
+        self.stream = stream
+
+    def emit(self, record):
+        print(
+            record.levelname,
+            ":",
+            record.name,
+            ":",
+            record.message,
+            sep="",
+            file=self.stream or _stream,
+        )
+
+
+class RingBufferHandler(Handler):
+    """
+    Keeps the last capacity records in memory allocated up front, so logging
+    to it does not grow the heap. Messages are stored as utf-8 and cut to
+    message_size bytes.
+    """
+
+    def __init__(self, capacity=32, message_size=96, level=NOTSET):
+        super().__init__(level)
+        self.capacity = capacity
+        self.message_size = message_size
+        self._messages = bytearray(capacity * message_size)
+        self._view = memoryview(self._messages)
+        self._lengths = array("H", bytearray(2 * capacity))
+        self._levels = bytearray(capacity)
+        self._times = array("I", bytearray(4 * capacity))  # ticks_ms
+        self._names = [None] * capacity
+        self._next = 0
+        self._count = 0
+        self.total = 0  # records emitted since the last clear
+
+    def emit(self, record):
+        message = record.message
+        if not isinstance(message, str):
+            message = str(message)
+        message = message.encode()
+        length = len(message)
+        if length > self.message_size:
+            length = self.message_size
+            # Do not cut a utf-8 sequence in half
+            while length and message[length] & 0xC0 == 0x80:
+                length -= 1
+
+        slot = self._next
+        start = slot * self.message_size
+        self._view[start : start + length] = memoryview(message)[:length]
+        self._lengths[slot] = length
+        self._levels[slot] = record.levelno
+        self._times[slot] = time.ticks_ms() & 0xFFFFFFFF
+        self._names[slot] = record.name
+
+        self._next = (slot + 1) % self.capacity
+        if self._count < self.capacity:
+            self._count += 1
+        self.total += 1
+
+    def records(self, level=NOTSET, limit=None):
+        """The stored records at or above level, oldest first"""
+        records = []
+        slot = (self._next - self._count) % self.capacity
+        for _ in range(self._count):
+            levelno = self._levels[slot]
+            if levelno >= level:
+                start = slot * self.message_size
+                end = start + self._lengths[slot]
+                records.append(
+                    {
+                        "time_ms": self._times[slot],
+                        "level": _level_dict.get(levelno, "LVL%s" % levelno),
+                        "name": self._names[slot],
+                        "msg": str(self._view[start:end], "utf-8"),
+                    }
+                )
+            slot = (slot + 1) % self.capacity
+        if limit is not None and len(records) > limit:
+            records = records[len(records) - limit :]
+        return records
+
+    def clear(self):
+        self._next = 0
+        self._count = 0
+        self.total = 0
+
 
 class Logger:
+    """
+    Messages are formatted with the % operator only when the level is enabled,
+    so pass the values as arguments instead of formatting them at the call
+    site. The handlers are shared by all loggers.
+    """
 
     level = NOTSET
     handlers = []
@@ -57,34 +163,45 @@ class Logger:
 
     def log(self, level, msg, *args):
         if self.isEnabledFor(level):
-            levelname = self._level_str(level)
-            if args:
-                msg = msg % args
-            if self.handlers:
-                d = self.record.__dict__
-                d["levelname"] = levelname
-                d["levelno"] = level
-                d["message"] = msg
-                d["name"] = self.name
-                for h in self.handlers:
+            self._log(level, msg, args)
+
+    def _log(self, level, msg, args):
+        levelname = self._level_str(level)
+        if args:
+            msg = msg % args
+        if self.handlers:
+            d = self.record.__dict__
+            d["levelname"] = levelname
+            d["levelno"] = level
+            d["message"] = msg
+            d["name"] = self.name
+            for h in self.handlers:
+                if level >= h.level:
                     h.emit(self.record)
-            else:
-                print(levelname, ":", self.name, ":", msg, sep="", file=_stream)
+        else:
+            print(levelname, ":", self.name, ":", msg, sep="", file=_stream)
+
+    # The level is checked before anything else so disabled calls are cheap
 
     def debug(self, msg, *args):
-        self.log(DEBUG, msg, *args)
+        if self.isEnabledFor(DEBUG):
+            self._log(DEBUG, msg, args)
 
     def info(self, msg, *args):
-        self.log(INFO, msg, *args)
+        if self.isEnabledFor(INFO):
+            self._log(INFO, msg, args)
 
     def warning(self, msg, *args):
-        self.log(WARNING, msg, *args)
+        if self.isEnabledFor(WARNING):
+            self._log(WARNING, msg, args)
 
     def error(self, msg, *args):
-        self.log(ERROR, msg, *args)
+        if self.isEnabledFor(ERROR):
+            self._log(ERROR, msg, args)
 
     def critical(self, msg, *args):
-        self.log(CRITICAL, msg, *args)
+        if self.isEnabledFor(CRITICAL):
+            self._log(CRITICAL, msg, args)
 
     def exc(self, e, msg, *args):
         self.log(ERROR, msg, *args)
@@ -117,15 +234,23 @@ def debug(msg, *args):
     getLogger().debug(msg, *args)
 
 
-def leveledConfig(level_str: str = "info"):
-    level = None
+def setHandlers(handlers: list):
+    """Replace the handlers shared by all loggers"""
+    Logger.handlers[:] = handlers
+
+
+def levelFromName(level_str: str):
+    level_str = level_str.upper()
+    if level_str in ("WARNING", "CRITICAL"):
+        level_str = level_str[:4]
     for (k, v) in _level_dict.items():
-        if v==level_str.upper():
-            level=k
-    if not level:
-        raise ValueError(f"invalid log level {level_str}")
+        if v == level_str:
+            return k
+    raise ValueError("invalid log level %s" % level_str)
+
 
-    basicConfig(level)
+def leveledConfig(level_str: str = "info"):
+    basicConfig(levelFromName(level_str))
 
 
 def basicConfig(level=INFO, filename=None, stream=None, format=None):
@@ -137,3 +262,13 @@ def basicConfig(level=INFO, filename=None, stream=None, format=None):
         print("logging.basicConfig: filename arg is not supported")
     if format is not None:
         print("logging.basicConfig: format arg is not supported")
+
+
+if not __debug__:
+    # Compiled with optimisations, micropython.opt_level(1) or mpy-cross -O1.
+    # Debug calls inside an ``if __debug__:`` block are left out of the
+    # bytecode, the remaining ones return straight away.
+    def _stripped(self, msg, *args):
+        pass
+
+    Logger.debug = _stripped
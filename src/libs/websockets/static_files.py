@@ -0,0 +1,142 @@
+import os
+from libs import logging
+
+_logger = logging.getLogger(name="websocket")
+
+_CONTENT_TYPES = {
+    "html": "text/html",
+    "js": "application/javascript",
+    "css": "text/css",
+    "json": "application/json",
+    "svg": "image/svg+xml",
+    "png": "image/png",
+    "ico": "image/x-icon",
+}
+
+# Assets other than html are kept by the browser for a year, pages are checked
+# every time with their ETag so renamed assets are picked up
+ASSET_MAX_AGE = 31536000
+
+_STAT_MODE_DIR = 0x4000
+
+
+class StaticFiles:
+    """
+    Serves the files of a directory over HTTP/1.1. A file is sent in chunks of
+    the reusable buffer, waiting for the socket between chunks so a download
+    never holds up the event loop.
+    When the browser accepts gzip and <file>.gz exists the compressed file is
+    sent instead, see tools/compress_assets.py. Responses carry an ETag made
+    from the size and modification time, a request with a matching
+    If-None-Match is answered with 304 Not Modified.
+    """
+
+    def __init__(self, root: str, index: str = "index.html", buffer_size=1024):
+        self.root = root
+        self.index = index
+        self._buffer = bytearray(buffer_size)
+        self._buffer_busy = False
+        self.requests = 0
+        self.not_modified = 0
+
+    def _stat(self, path: str):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        if stat[0] & _STAT_MODE_DIR:
+            return None
+        return stat
+
+    def _resolve(self, target: str):
+        """The file of a request target or None"""
+        path = target.split("?", 1)[0]
+        if path.endswith("/"):
+            path += self.index
+        parts = path.split("/")
+        for part in parts:
+            if part in ("..", "."):
+                return None
+        return self.root + "/" + "/".join(part for part in parts if part)
+
+    async def serve(self, writer, request: list, headers: dict):
+        """Answer a HTTP request, request is the split request line"""
+        self.requests += 1
+        method = request[0]
+        if method not in ("GET", "HEAD") or len(request) < 2:
+            await self._status(writer, "405 Method Not Allowed")
+            return
+        path = self._resolve(request[1])
+        stat = self._stat(path) if path else None
+        if stat is None:
+            await self._status(writer, "404 Not Found")
+            return
+
+        extension = path.rsplit(".", 1)[-1]
+        content_type = _CONTENT_TYPES.get(extension, "application/octet-stream")
+        encoding = None
+        if "gzip" in headers.get("accept-encoding", ""):
+            gzip_stat = self._stat(path + ".gz")
+            if gzip_stat is not None:
+                path += ".gz"
+                stat = gzip_stat
+                encoding = "gzip"
+
+        size = stat[6]
+        etag = '"%x-%x%s"' % (size, stat[8], "-gz" if encoding else "")
+        if extension == "html":
+            cache_control = "no-cache"
+        else:
+            cache_control = "max-age=%d" % ASSET_MAX_AGE
+        response = [
+            "ETag: " + etag,
+            "Cache-Control: " + cache_control,
+            "Vary: Accept-Encoding",
+        ]
+
+        if etag in headers.get("if-none-match", ""):
+            self.not_modified += 1
+            await self._status(writer, "304 Not Modified", response)
+            return
+
+        response.append("Content-Type: " + content_type)
+        response.append("Content-Length: %d" % size)
+        if encoding:
+            response.append("Content-Encoding: " + encoding)
+        await self._status(writer, "200 OK", response, close=False)
+        if method == "GET":
+            await self._send_file(writer, path)
+        writer.close()
+
+    async def _status(self, writer, status: str, headers=None, close=True):
+        lines = ["HTTP/1.1 " + status, "Connection: close"]
+        if headers:
+            lines.extend(headers)
+        if status[0] != "2" and status[0] != "3":
+            lines.append("Content-Length: 0")
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode())
+        await writer.drain()
+        if close:
+            writer.close()
+
+    async def _send_file(self, writer, path: str):
+        # The shared buffer is in use by another download, use one of our own
+        if self._buffer_busy:
+            buffer = bytearray(len(self._buffer))
+        else:
+            buffer = self._buffer
+            self._buffer_busy = True
+        view = memoryview(buffer)
+        try:
+            with open(path, "rb") as f:
+                while True:
+                    count = f.readinto(buffer)
+                    if not count:
+                        break
+                    writer.write(view[:count])
+                    await writer.drain()
+        except OSError as e:
+            _logger.warning("failed to send %s: %s", path, e)
+        finally:
+            if buffer is self._buffer:
+                self._buffer_busy = False
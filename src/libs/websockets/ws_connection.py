@@ -1,6 +1,35 @@
-import socket
-from websocket import websocket
-import uselect
+import time
+import ustruct
+from libs import logging
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+# Frame opcodes
+OP_CONT = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xA
+
+# Largest message accepted from a client
+MAX_MESSAGE_SIZE = 16384
+
+# What send() does when the outbound queue is full
+OVERFLOW_DROP_OLDEST = "drop_oldest"
+OVERFLOW_DISCONNECT = "disconnect"
+
+# Outbound queue limits of a connection
+DEFAULT_QUEUE_SIZE = 8
+DEFAULT_QUEUE_BYTES = 8192
+
+# Longest wait for the close frame to be sent, in milliseconds
+CLOSE_TIMEOUT_MS = 500
+
+_logger = logging.getLogger(name="websocket")
 
 
 class ClientClosedError(Exception):
@@ -8,56 +37,250 @@ class ClientClosedError(Exception):
 
 
 class WebSocketConnection:
-    def __init__(self, addr, s, close_callback):
+    """
+    A websocket connection with a bounded outbound queue. send() queues a
+    message without waiting, a drain task writes the queue out whenever the
+    socket can take more so a slow client never holds up the caller.
+    A message sent with a key replaces the message with the same key that is
+    still queued, the latest wins. When the queue is full the oldest message is
+    dropped, keyed messages first, or with OVERFLOW_DISCONNECT the connection
+    is closed.
+    """
+
+    def __init__(
+        self,
+        addr,
+        reader,
+        writer,
+        close_callback,
+        queue_size: int = DEFAULT_QUEUE_SIZE,
+        queue_bytes: int = DEFAULT_QUEUE_BYTES,
+        overflow: str = OVERFLOW_DROP_OLDEST,
+    ):
+        if overflow not in (OVERFLOW_DROP_OLDEST, OVERFLOW_DISCONNECT):
+            raise ValueError(f"unknown overflow behaviour {overflow}")
         self.client_close = False
-        self._need_check = False
 
         self.address = addr
-        self.socket = s
-        self.ws = websocket(s, True)
-        self.poll = uselect.poll()
+        self.reader = reader
+        self.writer = writer
         self.close_callback = close_callback
+        # Opcode (OP_TEXT or OP_BINARY) of the last message returned by read()
+        self.opcode = None
+        self._fragments = None
 
-        self.socket.setblocking(False)
-        self.poll.register(self.socket, uselect.POLLIN)
+        self.queue_size = queue_size
+        self.queue_bytes = queue_bytes
+        self.overflow = overflow
+        self._queue = []  # [key, header, payload, size] of the queued messages
+        self._queued_bytes = 0
+        self._draining = False
+        self.messages_queued = 0
+        self.bytes_queued = 0
+        self.messages_sent = 0
+        self.bytes_sent = 0
+        self.messages_coalesced = 0
+        self.messages_dropped = 0
+        self.bytes_dropped = 0
 
-    def read(self):
-        poll_events = self.poll.poll(0)
-
-        if not poll_events:
-            return
-
-        # Check the flag for connection hung up
-        if poll_events[0][1] & uselect.POLLHUP:
-            self.client_close = True
-
-        msg_bytes = None
+    async def _read_exactly(self, n):
         try:
-            msg_bytes = self.ws.read()
-        except OSError:
-            self.client_close = True
-
+            data = await self.reader.readexactly(n)
+        except (OSError, EOFError):
+            data = None
         # If no bytes => connection closed. See the link below.
         # http://stefan.buettcher.org/cs/conn_closed.html
-        if not msg_bytes or self.client_close:
+        if data is None or len(data) < n:
+            self.client_close = True
             raise ClientClosedError()
+        return data
 
-        return msg_bytes
+    async def _read_frame(self):
+        b0, b1 = await self._read_exactly(2)
+        length = b1 & 0x7F
+        if length == 126:
+            length = ustruct.unpack(">H", await self._read_exactly(2))[0]
+        elif length == 127:
+            length = ustruct.unpack(">Q", await self._read_exactly(8))[0]
+        if length > MAX_MESSAGE_SIZE:
+            self.client_close = True
+            raise ClientClosedError()
 
-    def write(self, msg):
+        mask = None
+        if b1 & 0x80:
+            mask = await self._read_exactly(4)
+        payload = b""
+        if length:
+            payload = await self._read_exactly(length)
+        if mask:
+            payload = bytearray(payload)
+            for i in range(length):
+                payload[i] ^= mask[i & 3]
+        return b0 & 0x80, b0 & 0x0F, payload
+
+    async def read(self):
+        """Wait for the next text or binary message and return its payload.
+        Control frames are answered here, the message type is left in opcode."""
+        while True:
+            fin, opcode, payload = await self._read_frame()
+
+            if opcode == OP_CLOSE:
+                self.send(payload[:2], OP_CLOSE)
+                await self.flush(CLOSE_TIMEOUT_MS)
+                self.client_close = True
+                raise ClientClosedError()
+            if opcode == OP_PING:
+                self.send(payload, OP_PONG)
+                continue
+            if opcode == OP_PONG:
+                continue
+
+            if opcode != OP_CONT:
+                self.opcode = opcode
+                self._fragments = None
+            if not fin:
+                # Collect fragmented messages until the final frame
+                if self._fragments is None:
+                    self._fragments = bytearray()
+                self._fragments.extend(payload)
+                if len(self._fragments) > MAX_MESSAGE_SIZE:
+                    self.client_close = True
+                    raise ClientClosedError()
+                continue
+            if self._fragments is not None:
+                self._fragments.extend(payload)
+                payload = self._fragments
+                self._fragments = None
+            return payload
+
+    async def write(self, msg, opcode=None):
+        """Queue a message, see send()"""
+        self.send(msg, opcode)
+
+    def send(self, msg, opcode=None, key=None):
+        """Queue a message, str is sent as a text and bytes as a binary message.
+        Returns False when the message was not queued."""
+        if self.writer is None:
+            return False
+        if isinstance(msg, str):
+            msg = msg.encode("utf-8")
+            if opcode is None:
+                opcode = OP_TEXT
+        elif opcode is None:
+            opcode = OP_BINARY
+
+        length = len(msg)
+        if length < 126:
+            header = ustruct.pack(">BB", 0x80 | opcode, length)
+        elif length < 65536:
+            header = ustruct.pack(">BBH", 0x80 | opcode, 126, length)
+        else:
+            header = ustruct.pack(">BBQ", 0x80 | opcode, 127, length)
+        size = len(header) + length
+
+        if key is not None:
+            for entry in self._queue:
+                if entry[0] == key:
+                    self._queued_bytes += size - entry[3]
+                    entry[1] = header
+                    entry[2] = msg
+                    entry[3] = size
+                    self.messages_coalesced += 1
+                    return True
+
+        while self._queue and (
+            len(self._queue) >= self.queue_size
+            or self._queued_bytes + size > self.queue_bytes
+        ):
+            if self.overflow == OVERFLOW_DISCONNECT:
+                _logger.warning("Send queue of %s is full, closing.", self.address)
+                self.client_close = True
+                self.close()
+                return False
+            self._drop_oldest()
+
+        self._queue.append([key, header, msg, size])
+        self._queued_bytes += size
+        self.messages_queued += 1
+        self.bytes_queued += size
+        if not self._draining:
+            self._draining = True
+            asyncio.create_task(self._drain())
+        return True
+
+    def queued(self, key):
+        """True when a message with key is waiting to be sent"""
+        for entry in self._queue:
+            if entry[0] == key:
+                return True
+        return False
+
+    def _drop_oldest(self):
+        index = 0
+        for i in range(len(self._queue)):
+            if self._queue[i][0] is not None:
+                index = i
+                break
+        entry = self._queue.pop(index)
+        self._queued_bytes -= entry[3]
+        self.messages_dropped += 1
+        self.bytes_dropped += entry[3]
+
+    async def _drain(self):
         try:
-            self.ws.write(msg)
+            while self._queue and self.writer is not None:
+                entry = self._queue.pop(0)
+                self._queued_bytes -= entry[3]
+                self.writer.write(entry[1])
+                self.writer.write(entry[2])
+                await self.writer.drain()
+                self.messages_sent += 1
+                self.bytes_sent += entry[3]
         except OSError:
             self.client_close = True
+            self._clear_queue()
+        finally:
+            self._draining = False
+
+    async def flush(self, timeout_ms: int):
+        """Wait until the queue is sent, for at most timeout_ms"""
+        start = time.ticks_ms()
+        while self._draining:
+            if time.ticks_diff(time.ticks_ms(), start) >= timeout_ms:
+                return
+            await asyncio.sleep(0.01)
+
+    def _clear_queue(self):
+        self._queue = []
+        self._queued_bytes = 0
+
+    def stats(self):
+        return {
+            "address": str(self.address),
+            "queue": len(self._queue),
+            "queue_bytes": self._queued_bytes,
+            "messages_queued": self.messages_queued,
+            "bytes_queued": self.bytes_queued,
+            "messages_sent": self.messages_sent,
+            "bytes_sent": self.bytes_sent,
+            "messages_coalesced": self.messages_coalesced,
+            "messages_dropped": self.messages_dropped,
+            "bytes_dropped": self.bytes_dropped,
+        }
 
     def is_closed(self):
-        return self.socket is None
+        return self.writer is None
 
     def close(self):
-        print("Closing connection.")
-        self.poll.unregister(self.socket)
-        self.socket.close()
-        self.socket = None
-        self.ws = None
+        if self.writer is None:
+            return
+        _logger.debug("Closing connection.")
+        self._clear_queue()
+        try:
+            self.writer.close()
+        except OSError:
+            pass
+        self.reader = None
+        self.writer = None
         if self.close_callback:
             self.close_callback(self)
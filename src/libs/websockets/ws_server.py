@@ -1,121 +1,215 @@
-import os
-import socket
+import time
 import network
-import websocket_helper
-import uselect
-from time import sleep
-from .ws_connection import WebSocketConnection, ClientClosedError
+import hashlib
+import binascii
+from libs import logging
+from .ws_connection import (
+    WebSocketConnection,
+    ClientClosedError,
+    DEFAULT_QUEUE_SIZE,
+    DEFAULT_QUEUE_BYTES,
+    OVERFLOW_DROP_OLDEST,
+)
+
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+_WS_GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+_MAX_HEADERS = 32
+
+# Messages and microseconds a client is handled for before the other
+# clients get their turn
+DEFAULT_READ_BUDGET = (1, 0)
+
+_logger = logging.getLogger(name="websocket")
 
 
 class WebSocketClient:
     def __init__(self, conn):
         self.connection = conn
 
-    def process(self):
-        pass
+    async def process(self):
+        """Wait for and handle the next message of the connection"""
+        await self.connection.read()
 
 
 class WebSocketServer:
-    def __init__(self, page, max_connections=1):
-        self._listen_s = None
-        self._listen_poll = None
+    def __init__(
+        self,
+        static_dir,
+        max_connections=1,
+        queue_size=DEFAULT_QUEUE_SIZE,
+        queue_bytes=DEFAULT_QUEUE_BYTES,
+        overflow=OVERFLOW_DROP_OLDEST,
+    ):
+        self._server = None
         self._clients = []
         self._max_connections = max_connections
-        self._page = page
-
-    def _setup_conn(self, port):
-        self._listen_s = socket.socket()
-        self._listen_s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self._listen_poll = uselect.poll()
-
-        ai = socket.getaddrinfo("0.0.0.0", port)
-        addr = ai[0][4]
-
-        self._listen_s.bind(addr)
-        self._listen_s.listen(1)
-        self._listen_poll.register(self._listen_s)
+        # Plain HTTP requests are answered from the files in static_dir, or
+        # with 404 without one. StaticFiles is imported on the first request.
+        self._static_dir = static_dir
+        self._static = None
+        # Outbound queue of every connection, see WebSocketConnection
+        self._queue_size = queue_size
+        self._queue_bytes = queue_bytes
+        self._overflow = overflow
+
+    @property
+    def clients(self):
+        return self._clients
+
+    async def _setup_conn(self, port):
+        self._server = await asyncio.start_server(
+            self._accept_conn, "0.0.0.0", port, backlog=self._max_connections
+        )
         for i in (network.AP_IF, network.STA_IF):
             iface = network.WLAN(i)
             if iface.active():
-                print("WebSocket started on ws://%s:%d" % (iface.ifconfig()[0], port))
-
-    def _check_new_connections(self, accept_handler):
-        poll_events = self._listen_poll.poll(0)
-        if not poll_events:
-            return
+                _logger.info(
+                    "WebSocket started on ws://%s:%d", iface.ifconfig()[0], port
+                )
+
+    async def _read_request(self, reader):
+        """Read the HTTP request line and headers, header names are lower cased"""
+        request_line = await reader.readline()
+        if not request_line:
+            return None, None
+        headers = {}
+        for _ in range(_MAX_HEADERS):
+            line = await reader.readline()
+            if not line or line in (b"\r\n", b"\n"):
+                break
+            name, sep, value = line.decode().partition(":")
+            if sep:
+                headers[name.strip().lower()] = value.strip()
+        return request_line.decode().split(), headers
+
+    async def _handshake(self, writer, headers):
+        key = headers.get("sec-websocket-key", None)
+        if not key:
+            raise OSError("missing Sec-WebSocket-Key")
+        digest = hashlib.sha1(key.encode() + _WS_GUID).digest()
+        accept = binascii.b2a_base64(digest)[:-1]
+        writer.write(
+            b"HTTP/1.1 101 Switching Protocols\r\n"
+            b"Upgrade: websocket\r\n"
+            b"Connection: Upgrade\r\n"
+            b"Sec-WebSocket-Accept: " + accept + b"\r\n\r\n"
+        )
+        await writer.drain()
 
-        if poll_events[0][1] & uselect.POLLIN:
-            accept_handler()
-
-    def _accept_conn(self):
-        cl, remote_addr = self._listen_s.accept()
-        print("Client connection from:", remote_addr)
-
-        if len(self._clients) >= self._max_connections:
-            # Maximum connections limit reached
-            cl.setblocking(True)
-            cl.sendall("HTTP/1.1 503 Too many connections\n\n")
-            cl.sendall("\n")
-            # TODO: Make sure the data is sent before closing
-            sleep(0.1)
-            cl.close()
-            return
+    async def _accept_conn(self, reader, writer):
+        remote_addr = writer.get_extra_info("peername")
+        _logger.debug("Client connection from: %s", remote_addr)
 
         try:
-            websocket_helper.server_handshake(cl)
-        except OSError:
-            # Not a websocket connection, serve webpage
-            self._serve_page(cl)
+            request, headers = await self._read_request(reader)
+            if not request:
+                writer.close()
+                return
+
+            if headers.get("upgrade", "").lower() != "websocket":
+                # Not a websocket connection, serve the static files
+                await self._serve_static(writer, request, headers)
+                return
+
+            if len(self._clients) >= self._max_connections:
+                # Maximum connections limit reached
+                writer.write(b"HTTP/1.1 503 Too many connections\r\n\r\n")
+                await writer.drain()
+                writer.close()
+                return
+
+            await self._handshake(writer, headers)
+        except (OSError, ValueError):
+            writer.close()
             return
 
-        self._clients.append(
-            self._make_client(
-                WebSocketConnection(remote_addr, cl, self.remove_connection)
+        client = self._make_client(
+            WebSocketConnection(
+                remote_addr,
+                reader,
+                writer,
+                self.remove_connection,
+                self._queue_size,
+                self._queue_bytes,
+                self._overflow,
             )
         )
+        self._clients.append(client)
+        await self._run_client(client)
+
+    async def _run_client(self, client):
+        """Handle the messages of a client until it disconnects. After its read
+        budget the client yields, so the other clients and the send queues
+        get their turn in order."""
+        connection = client.connection
+        try:
+            count = 0
+            start = time.ticks_us()
+            while not connection.is_closed() and not connection.client_close:
+                await client.process()
+                count += 1
+                messages, budget_us = self._read_budget(client)
+                if (
+                    count >= messages
+                    or time.ticks_diff(time.ticks_us(), start) >= budget_us
+                ):
+                    await asyncio.sleep(0)
+                    count = 0
+                    start = time.ticks_us()
+        except ClientClosedError:
+            pass
+        except Exception as e:
+            _logger.exc(e, "client %s failed", connection.address)
+        finally:
+            connection.close()
+            self.remove_connection(connection)
+
+    async def _serve_static(self, writer, request: list, headers: dict):
+        if self._static_dir:
+            if self._static is None:
+                from .static_files import StaticFiles
+
+                self._static = StaticFiles(self._static_dir)
+            await self._static.serve(writer, request, headers)
+            return
+        writer.write(
+            b"HTTP/1.1 404 Not Found\r\nConnection: close\r\n"
+            b"Content-Length: 0\r\n\r\n"
+        )
+        await writer.drain()
+        writer.close()
+
+    def _read_budget(self, client):
+        """The (messages, microseconds) a client is handled for at a time"""
+        return DEFAULT_READ_BUDGET
 
     def _make_client(self, conn):
         return WebSocketClient(conn)
 
-    def _serve_page(self, sock):
-        try:
-            sock.sendall(
-                "HTTP/1.1 200 OK\nConnection: close\nServer: WebSocket Server\nContent-Type: text/html\n"
-            )
-            length = os.stat(self._page)[6]
-            sock.sendall("Content-Length: {}\n\n".format(length))
-            # Process page by lines to avoid large strings
-            with open(self._page, "r") as f:
-                for line in f:
-                    sock.sendall(line)
-        except OSError:
-            # Error while serving webpage
-            pass
-        sock.close()
-
     def stop(self):
-        if self._listen_poll:
-            self._listen_poll.unregister(self._listen_s)
-        self._listen_poll = None
-        if self._listen_s:
-            self._listen_s.close()
-        self._listen_s = None
+        if self._server:
+            self._server.close()
+        self._server = None
 
-        for client in self._clients:
+        for client in list(self._clients):
             client.connection.close()
-        print("Stopped WebSocket server.")
+        _logger.info("Stopped WebSocket server.")
 
-    def start(self, port=80):
-        if self._listen_s:
+    async def start(self, port=80):
+        if self._server:
             self.stop()
-        self._setup_conn(port)
-        print("Started WebSocket server.")
-
-    def process_all(self):
-        self._check_new_connections(self._accept_conn)
-
-        for client in self._clients:
-            client.process()
+        await self._setup_conn(port)
+        _logger.info("Started WebSocket server.")
+
+    async def broadcast(self, msg, key=None):
+        """Queue a message for every connected client, see
+        WebSocketConnection.send()"""
+        for client in list(self._clients):
+            client.connection.send(msg, key=key)
 
     def remove_connection(self, conn):
         for client in self._clients:
@@ -1,7 +1,9 @@
+from core.boot_profiler import boot_profiler
 from core.framework import RobotFramework
-from core.pca9685 import PCA9685
 from core.robot import Robot
 
+boot_profiler.mark("imports")
+
 # min_pos = 70
 # max_pos = 100
 
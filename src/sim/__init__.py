@@ -0,0 +1,61 @@
+"""
+Simulated hardware so the framework runs unchanged under CPython.
+
+install() registers stand-ins for the MicroPython only modules before any
+core module is imported:
+
+- machine: Pin, a PWM that remembers its duty and an I2C bus with a virtual
+  PCA9685 register file that counts transactions and bytes
+- network: a WLAN that connects straight away on the loopback address
+- ustruct, and the ticks/sleep functions of MicroPython's time module
+
+Under the MicroPython unix port only machine and network are replaced, its
+time module already has the ticks functions.
+
+uasyncio falls back to asyncio and the websocket server runs on asyncio
+streams, so real localhost sockets are served without a shim.
+
+    import sim
+    sim.install()
+    from core.robot import Robot
+
+Run ``python -m sim`` from src to start the framework on simulated hardware.
+"""
+import sys
+import time
+import struct
+
+_installed = False
+
+
+def _patch_time():
+    # ticks wrap around on MicroPython, the simulated ticks never do
+    time.ticks_ms = lambda: time.monotonic_ns() // 1000000
+    time.ticks_us = lambda: time.monotonic_ns() // 1000
+    time.ticks_diff = lambda end, start: end - start
+    time.ticks_add = lambda ticks, delta: ticks + delta
+    time.sleep_ms = lambda ms: time.sleep(ms / 1000)
+    time.sleep_us = lambda us: time.sleep(us / 1000000)
+
+
+def _print_exception(e, file=sys.stderr):
+    import traceback
+
+    traceback.print_exception(type(e), e, e.__traceback__, file=file)
+
+
+def install():
+    """Register the simulated modules, safe to call more than once"""
+    global _installed
+    if _installed:
+        return
+    from . import machine, network
+
+    if not hasattr(time, "ticks_ms"):
+        _patch_time()
+    sys.modules["machine"] = machine
+    sys.modules["network"] = network
+    sys.modules["ustruct"] = struct
+    if not hasattr(sys, "print_exception"):
+        sys.print_exception = _print_exception
+    _installed = True
@@ -0,0 +1,32 @@
+"""
+Run the framework on simulated hardware, from the src directory:
+
+    python -m sim [robot] [--port 8080]
+
+Uses config/config.json like the board, the websocket server listens on
+localhost.
+"""
+import argparse
+import sim
+
+sim.install()
+
+from core.boot_profiler import boot_profiler  # noqa: E402
+from core.framework import RobotFramework  # noqa: E402
+from core.robot import Robot  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m sim")
+    parser.add_argument("robot", nargs="?", default="21-dof-humanoid")
+    parser.add_argument("--port", type=int, default=8080)
+    args = parser.parse_args()
+
+    boot_profiler.mark("imports")
+    robot_framework = RobotFramework(Robot.from_config(args.robot))
+    robot_framework.network_manager.port = args.port
+    robot_framework.run_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""Simulated machine module, see sim.install()"""
+
+# PCA9685 registers
+_MODE1 = 0x00
+_LED0_ON_L = 0x06
+_ALL_LED_ON_L = 0xFA
+_ALL_LED_OFF_H = 0xFD
+_PRESCALE = 0xFE
+
+_MODE1_AI = 0x20
+_CHANNELS = 16
+
+
+class Pin:
+    IN = 0
+    OUT = 1
+
+    def __init__(self, id, mode=-1, pull=-1, value=None):
+        self.id = id
+        self._value = value or 0
+
+    def value(self, value=None):
+        if value is None:
+            return self._value
+        self._value = value
+
+
+class PWM:
+    def __init__(self, pin, freq=50, duty=0):
+        self.pin = pin
+        self._freq = freq
+        self._duty = duty
+
+    def freq(self, freq=None):
+        if freq is None:
+            return self._freq
+        self._freq = freq
+
+    def duty(self, duty=None):
+        if duty is None:
+            return self._duty
+        self._duty = duty
+
+    def deinit(self):
+        self._duty = 0
+
+
+class VirtualPCA9685:
+    """
+    Register file of a PCA9685. Writes auto-increment when the AI bit of MODE1
+    is set, writes to the ALL_LED registers reach every channel like they do on
+    the chip. The power on prescale gives 200Hz.
+    """
+
+    def __init__(self):
+        self.registers = bytearray(256)
+        self.registers[_MODE1] = 0x11
+        self.registers[_PRESCALE] = 0x1E
+
+    def _next(self, register: int):
+        if self.registers[_MODE1] & _MODE1_AI:
+            return (register + 1) & 0xFF
+        return register
+
+    def write(self, register: int, data):
+        for value in data:
+            self.registers[register] = value
+            if _ALL_LED_ON_L <= register <= _ALL_LED_OFF_H:
+                offset = register - _ALL_LED_ON_L
+                for channel in range(_CHANNELS):
+                    self.registers[_LED0_ON_L + 4 * channel + offset] = value
+            register = self._next(register)
+
+    def read(self, register: int, length: int):
+        data = bytearray(length)
+        self.read_into(register, data)
+        return data
+
+    def read_into(self, register: int, buf):
+        for i in range(len(buf)):
+            buf[i] = self.registers[register]
+            register = self._next(register)
+
+    def channel(self, index: int):
+        """The (on, off) counts of a channel, the full on and off bits included"""
+        base = _LED0_ON_L + 4 * index
+        registers = self.registers
+        return (
+            registers[base] | registers[base + 1] << 8,
+            registers[base + 2] | registers[base + 3] << 8,
+        )
+
+
+class I2C:
+    """
+    Simulated I2C bus. Every bus has a VirtualPCA9685 at the eight addresses
+    a board can be strapped to, 0x40 to 0x47, more devices can be added with
+    attach(). transactions and bytes count the bus traffic.
+    """
+
+    def __init__(self, id=0, scl=None, sda=None, freq=400000):
+        self.id = id
+        self.scl = scl
+        self.sda = sda
+        self.freq = freq
+        self.devices = {}
+        for address in range(0x40, 0x48):
+            self.devices[address] = VirtualPCA9685()
+        self.transactions = 0
+        self.bytes = 0
+
+    def attach(self, address: int, device):
+        self.devices[address] = device
+
+    def reset_counters(self):
+        self.transactions = 0
+        self.bytes = 0
+
+    def _device(self, address: int):
+        device = self.devices.get(address, None)
+        if device is None:
+            raise OSError(19)  # ENODEV, as MicroPython raises for a missing ack
+        return device
+
+    def scan(self):
+        return sorted(self.devices)
+
+    def writeto_mem(self, addr: int, memaddr: int, buf, addrsize=8):
+        device = self._device(addr)
+        self.transactions += 1
+        self.bytes += 1 + len(buf)
+        device.write(memaddr, buf)
+
+    def readfrom_mem(self, addr: int, memaddr: int, nbytes: int, addrsize=8):
+        device = self._device(addr)
+        self.transactions += 1
+        self.bytes += 1 + nbytes
+        return bytes(device.read(memaddr, nbytes))
+
+    def readfrom_mem_into(self, addr: int, memaddr: int, buf, addrsize=8):
+        device = self._device(addr)
+        self.transactions += 1
+        self.bytes += 1 + len(buf)
+        device.read_into(memaddr, buf)
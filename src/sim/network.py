@@ -0,0 +1,42 @@
+"""Simulated network module, see sim.install()"""
+
+STA_IF = 0
+AP_IF = 1
+
+
+class WLAN:
+    """An interface that connects straight away on the loopback address.
+    Like on the board there is one WLAN object per interface."""
+
+    _interfaces = {}
+
+    def __new__(cls, interface: int = STA_IF):
+        wlan = cls._interfaces.get(interface, None)
+        if wlan is None:
+            wlan = object.__new__(cls)
+            wlan.interface = interface
+            wlan._active = False
+            wlan._connected = False
+            wlan.ssid = None
+            cls._interfaces[interface] = wlan
+        return wlan
+
+    def active(self, active=None):
+        if active is None:
+            return self._active
+        self._active = bool(active)
+        if not self._active:
+            self._connected = False
+
+    def connect(self, ssid: str = None, password: str = None):
+        self.ssid = ssid
+        self._connected = self._active
+
+    def disconnect(self):
+        self._connected = False
+
+    def isconnected(self):
+        return self._connected
+
+    def ifconfig(self):
+        return ("127.0.0.1", "255.0.0.0", "127.0.0.1", "127.0.0.1")
@@ -0,0 +1,33 @@
+"""
+The tests run the framework on the simulated hardware of src/sim, the
+simulated modules are installed before any test imports a core module.
+"""
+import os
+import shutil
+import sys
+
+import pytest
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC)
+
+import sim  # noqa: E402
+
+sim.install()
+
+
+@pytest.fixture
+def src_dir(monkeypatch):
+    """Run the test from src, the configs are loaded relative to it like on
+    the board"""
+    monkeypatch.chdir(SRC)
+    return SRC
+
+
+@pytest.fixture
+def config_path(tmp_path):
+    """A config.json for RobotFramework made from the example config, src has
+    no config.json, the one of a board holds its wifi credentials"""
+    path = tmp_path / "config.json"
+    shutil.copy(os.path.join(SRC, "config", "config.example.json"), path)
+    return str(path)
@@ -0,0 +1,110 @@
+"""
+Heap allocations of a full pose update on the simulated hardware.
+
+    MICROPYTHON=/path/to/micropython python -m pytest tests/test_allocations.py
+
+CPython allocates an iterator for every loop and boxes every int above 256,
+so it can not tell an update that allocates nothing from one that allocates
+a little per joint. The updates are run under the MicroPython unix port
+instead, ``gc.mem_alloc()`` counts every byte allocated with the collector
+disabled and an update must allocate nothing at all. The tests are skipped
+when no ``micropython`` binary is found.
+"""
+import json
+import os
+import shutil
+import subprocess
+
+import pytest
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+MICROPYTHON = os.environ.get("MICROPYTHON", None) or shutil.which("micropython")
+
+# Run from src by the MicroPython unix port, prints the bytes allocated by
+# each update as json. "per_joint" allocates a small buffer for every joint
+# and shows the measurement catches it.
+SCRIPT = """
+import sys
+sys.path.insert(0, ".")
+import sim
+sim.install()
+import json
+from array import array
+from bench.suite import alloc_per_op, PoseOps, POSE_ANGLES
+from core.framework import RobotFramework
+from core.robot import Robot
+
+WARMUP = 300
+
+robot = Robot.from_config("21-dof-humanoid")
+framework = RobotFramework(robot, web_server=False, config_path=CONFIG_PATH)
+joints = robot.joint_list
+pose_ops = PoseOps(robot)
+count = len(joints)
+indices = bytearray(range(count))
+angles = [array("h", [10 * angle] * count) for angle in POSE_ANGLES]
+side = [0]
+
+
+def stage_and_flush():
+    side[0] ^= 1
+    angle = POSE_ANGLES[side[0]]
+    for joint in joints:
+        joint.stage_angle(angle)
+    robot.flush()
+
+
+def binary_set_joints():
+    side[0] ^= 1
+    framework.binary_set_joints(indices, angles[side[0]], count)
+
+
+def per_joint():
+    side[0] ^= 1
+    angle = POSE_ANGLES[side[0]]
+    for joint in joints:
+        bytearray(4)
+        joint.stage_angle(angle)
+    robot.flush()
+
+
+ops = {
+    "stage_and_flush": stage_and_flush,
+    "apply_pose": pose_ops.apply_pose,
+    "binary_set_joints": binary_set_joints,
+    "per_joint": per_joint,
+}
+result = {}
+for name in ops:
+    for _ in range(WARMUP):
+        ops[name]()
+    result[name] = alloc_per_op(ops[name])
+print(json.dumps(result))
+"""
+
+
+@pytest.fixture(scope="module")
+def allocations(tmp_path_factory):
+    if MICROPYTHON is None:
+        pytest.skip("no micropython binary, set MICROPYTHON to the unix port")
+    config_path = tmp_path_factory.mktemp("config") / "config.json"
+    shutil.copy(os.path.join(SRC, "config", "config.example.json"), config_path)
+    script = f"CONFIG_PATH = {str(config_path)!r}\n{SCRIPT}"
+    output = subprocess.run(
+        [MICROPYTHON, "-c", script],
+        cwd=SRC,
+        capture_output=True,
+        text=True,
+        timeout=120,
+    )
+    assert output.returncode == 0, output.stderr or output.stdout
+    return json.loads(output.stdout.splitlines()[-1])
+
+
+@pytest.mark.parametrize("op", ["stage_and_flush", "apply_pose", "binary_set_joints"])
+def test_pose_update_allocates_nothing(allocations, op):
+    assert allocations[op] == 0
+
+
+def test_per_joint_allocation_is_counted(allocations):
+    assert allocations["per_joint"] > 0
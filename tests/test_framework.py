@@ -0,0 +1,39 @@
+from array import array
+
+import pytest
+
+from core.framework import RobotFramework
+from core.networking import BINARY_ANGLE_NONE
+from core.robot import Robot
+
+ROBOT = "21-dof-humanoid"
+
+
+@pytest.fixture
+def framework(src_dir, config_path):
+    robot = Robot.from_config(ROBOT)
+    return RobotFramework(robot, web_server=False, config_path=config_path)
+
+
+def test_rejected_binary_frame_stages_nothing(framework):
+    robot = framework.robot
+    joints = robot.joint_list[:3]
+    joints[2].min_angle = None
+    joints[2].max_angle = None
+    indices = bytearray([0, 1, 2])
+    angles = array("h", [900, 950, -200])
+    with pytest.raises(ValueError):
+        framework.binary_set_joints(indices, angles, 3)
+    assert all(board.dirty == 0 for board in robot.boards)
+
+    robot.flush()
+    assert [joint.angle for joint in joints] == [None, None, None]
+
+
+def test_binary_frame_is_clamped_to_the_limits(framework):
+    joint = framework.robot.joint_list[1]
+    indices = bytearray([1, 2])
+    angles = array("h", [10 * joint.max_angle + 50, BINARY_ANGLE_NONE])
+    framework.binary_set_joints(indices, angles, 2)
+    assert abs(joint.angle - joint.max_angle) < 1
+    assert framework.robot.joint_list[2].angle is None
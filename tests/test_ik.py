@@ -0,0 +1,26 @@
+import pytest
+
+from core.ik import IKSolver, Limb
+from core.robot import Robot
+
+ROBOT = "21-dof-humanoid"
+
+
+@pytest.fixture
+def robot(src_dir):
+    return Robot.from_config(ROBOT)
+
+
+@pytest.mark.parametrize("target", [(0.0, 2000.0, 0.0), (0.0, -2000.0, 0.0)])
+def test_unlimited_joints_stay_in_the_servo_range(robot, target):
+    limb = Limb(robot, "left_wrist", target)
+    for index in limb.chain:
+        robot.joint_list[index].min_angle = None
+        robot.joint_list[index].max_angle = None
+    solver = IKSolver(robot)
+    solver.solve([limb])
+    for index in limb.chain:
+        servo = robot.joint_list[index].servo
+        assert 0 <= solver.angles[index] <= servo.actuation_range
+    # Staging the unreachable solution does not raise
+    solver.stage([limb])
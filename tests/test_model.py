@@ -0,0 +1,20 @@
+import os
+
+import pytest
+
+from core.robot import Robot
+
+ROBOT = "21-dof-humanoid"
+MODEL_PATH = f"config/robots/{ROBOT}.model"
+
+
+@pytest.mark.parametrize("keep", [0.5, 0.9])
+def test_corrupt_model_cache_is_rebuilt(src_dir, keep):
+    expected = Robot.from_config(ROBOT).joint_names
+    with open(MODEL_PATH, "rb") as model_file:
+        data = model_file.read()
+    with open(MODEL_PATH, "wb") as model_file:
+        model_file.write(data[: int(len(data) * keep)])
+
+    assert Robot.from_config(ROBOT).joint_names == expected
+    assert os.stat(MODEL_PATH)[6] == len(data)
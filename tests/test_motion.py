@@ -0,0 +1,52 @@
+import pytest
+
+from core.motion import MotionEngine
+from core.robot import Robot
+
+ROBOT = "21-dof-humanoid"
+
+
+@pytest.fixture
+def robot(src_dir):
+    return Robot.from_config(ROBOT)
+
+
+def test_play_rejects_targets_past_the_limits(robot):
+    engine = MotionEngine(robot)
+    joint = robot.joint_list[0]
+    joint.min_angle = 0
+    for angle in (-20, joint.max_angle + 1):
+        with pytest.raises(ValueError):
+            engine.play([{"time": 100, "joints": {joint.name: angle}}])
+    assert engine.status()["queued"] == 0
+
+
+def test_play_rejects_targets_past_the_servo_range(robot):
+    engine = MotionEngine(robot)
+    joint = robot.joint_list[0]
+    joint.min_angle = None
+    joint.max_angle = None
+    with pytest.raises(ValueError):
+        engine.play([{"time": 100, "joints": {joint.name: -1}}], "replace")
+    with pytest.raises(ValueError):
+        engine.play(
+            [{"time": 100, "joints": {joint.name: joint.servo.actuation_range + 1}}]
+        )
+    assert engine.active is None
+
+
+def test_play_rejects_malformed_keyframes(robot):
+    engine = MotionEngine(robot)
+    for keyframes in ([1], [{"time": 100, "joints": [1]}]):
+        with pytest.raises(ValueError):
+            engine.play(keyframes)
+    assert engine.status()["queued"] == 0
+
+
+def test_play_accepts_the_limits(robot):
+    engine = MotionEngine(robot)
+    joint = robot.joint_list[0]
+    engine.play([{"time": 0, "joints": {joint.name: joint.min_angle}}], "replace")
+    engine.tick()
+    robot.flush()
+    assert abs(joint.angle - joint.min_angle) < 1
@@ -0,0 +1,36 @@
+import pytest
+
+from core.robot import Robot
+
+ROBOT = "21-dof-humanoid"
+
+
+@pytest.fixture
+def robot(src_dir):
+    return Robot.from_config(ROBOT)
+
+
+def test_rejected_pose_stages_nothing(robot):
+    joints = robot.joint_list[:3]
+    joints[2].min_angle = None
+    pose = {joints[0].name: 90, joints[1].name: 95, joints[2].name: -20}
+    with pytest.raises(ValueError):
+        robot.apply_pose(pose)
+    assert all(board.dirty == 0 for board in robot.boards)
+
+    # A later flush from another path writes nothing of the rejected pose
+    robot.flush()
+    assert [joint.angle for joint in joints] == [None, None, None]
+
+
+def test_unknown_joint_stages_nothing(robot):
+    joint = robot.joint_list[1]
+    with pytest.raises(ValueError):
+        robot.apply_pose({joint.name: 90, "tail": 10})
+    assert all(board.dirty == 0 for board in robot.boards)
+
+
+def test_pose_is_clamped_to_the_limits(robot):
+    joint = robot.joint_list[1]
+    robot.apply_pose({joint.name: joint.max_angle + 5, robot.joint_list[2].name: None})
+    assert abs(joint.angle - joint.max_angle) < 1
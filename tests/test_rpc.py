@@ -0,0 +1,132 @@
+"""
+RPC handling of RobotServerClient over a WebSocketConnection with the real
+send queue, the socket is a StreamReader fed with client frames and a
+writer that keeps everything written to it.
+"""
+import asyncio
+import json
+import ustruct
+
+from core.networking import (
+    RobotServerClient,
+    BINARY_HEADER,
+    BINARY_HEADER_SIZE,
+    BINARY_ACK_HEADER,
+    BINARY_SET_JOINTS,
+)
+from libs.websockets.ws_connection import WebSocketConnection, OP_BINARY, OP_TEXT
+from libs.websockets.ws_server import WebSocketServer
+
+
+class RecordingWriter:
+    def __init__(self):
+        self.data = bytearray()
+        self.closed = False
+
+    def write(self, data):
+        self.data.extend(data)
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+def frame(opcode: int, payload: bytes):
+    """An unmasked final frame, payloads are kept under 126 bytes"""
+    return bytes((0x80 | opcode, len(payload))) + payload
+
+
+def messages(data: bytes):
+    """The (opcode, payload) of the server frames in data"""
+    result = []
+    offset = 0
+    while offset < len(data):
+        length = data[offset + 1] & 0x7F
+        offset += 2
+        opcode = data[offset - 2] & 0x0F
+        result.append((opcode, bytes(data[offset : offset + length])))
+        offset += length
+    return result
+
+
+def make_client(commands=None, binary_commands=None):
+    reader = asyncio.StreamReader()
+    writer = RecordingWriter()
+    connection = WebSocketConnection("test", reader, writer, None)
+    client = RobotServerClient(connection, commands or {}, binary_commands or {})
+    return reader, writer, client
+
+
+def echo_joints(indices, angles, count: int):
+    return count
+
+
+def broken():
+    raise AttributeError("'int' object has no attribute 'get'")
+
+
+def test_pipelined_binary_acks():
+    async def run():
+        reader, writer, client = make_client(
+            binary_commands={BINARY_SET_JOINTS: echo_joints}
+        )
+        for sequence in range(1, 6):
+            request = bytearray(BINARY_HEADER_SIZE)
+            ustruct.pack_into(
+                BINARY_HEADER, request, 0, BINARY_SET_JOINTS, sequence, 0
+            )
+            reader.feed_data(frame(OP_BINARY, bytes(request)))
+        # Every request is handled before the send queue is drained
+        for _ in range(5):
+            await client.process()
+        await client.connection.flush(1000)
+        return messages(writer.data)
+
+    acks = asyncio.run(run())
+    sequences = [ustruct.unpack_from(BINARY_ACK_HEADER, ack)[1] for _, ack in acks]
+    assert sequences == [1, 2, 3, 4, 5]
+
+
+def test_handler_exception_is_answered():
+    async def run():
+        reader, writer, client = make_client(
+            commands={"broken": broken, "ping": lambda: "pong"}
+        )
+        reader.feed_data(frame(OP_TEXT, b'{"method": "broken", "id": 1}'))
+        reader.feed_data(frame(OP_TEXT, b'{"method": "ping", "id": 2}'))
+        await client.process()
+        await client.process()
+        await client.connection.flush(1000)
+        return [json.loads(payload) for _, payload in messages(writer.data)]
+
+    error, pong = asyncio.run(run())
+    assert error["type"] == "error" and error["id"] == 1
+    assert pong["payload"] == "pong" and pong["id"] == 2
+
+
+class FailingClient:
+    def __init__(self, connection):
+        self.connection = connection
+
+    async def process(self):
+        raise AttributeError("bug in a handler")
+
+
+def test_failed_client_is_removed():
+    async def run():
+        server = WebSocketServer(None)
+        reader = asyncio.StreamReader()
+        writer = RecordingWriter()
+        connection = WebSocketConnection(
+            "test", reader, writer, server.remove_connection
+        )
+        client = FailingClient(connection)
+        server.clients.append(client)
+        await server._run_client(client)
+        return server, writer
+
+    server, writer = asyncio.run(run())
+    assert server.clients == []
+    assert writer.closed
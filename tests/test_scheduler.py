@@ -0,0 +1,68 @@
+import time
+
+from core.scheduler import Scheduler, MAX_TASK_ERRORS, MAX_BACKOFF_US
+
+
+def failing():
+    raise AttributeError("bad tick")
+
+
+def run_for(scheduler: Scheduler, ms: int):
+    end = time.ticks_add(time.ticks_ms(), ms)
+    while time.ticks_diff(end, time.ticks_ms()) > 0:
+        scheduler.run_pending()
+
+
+def test_failing_task_does_not_stop_the_others():
+    scheduler = Scheduler()
+    ticks = []
+    scheduler.add("failing", failing, 1000, priority=1)
+    scheduler.add("control", lambda: ticks.append(1), 1000)
+    run_for(scheduler, 30)
+
+    stats = scheduler.stats()
+    assert stats["control"]["runs"] > MAX_TASK_ERRORS
+    assert len(ticks) == stats["control"]["runs"]
+    # Retried after MAX_TASK_ERRORS, but with a growing wait between the runs
+    assert MAX_TASK_ERRORS < stats["failing"]["errors"] < stats["control"]["runs"]
+    assert stats["failing"]["backoff_us"] > 0
+
+
+def test_task_recovering_stays_enabled():
+    scheduler = Scheduler()
+    runs = [0]
+
+    def flaky():
+        runs[0] += 1
+        if runs[0] % 2:
+            raise ValueError("every other tick")
+
+    scheduler.add("flaky", flaky, 1000)
+    run_for(scheduler, 30)
+    assert scheduler.stats()["flaky"]["backoff_us"] == 0
+    assert runs[0] > MAX_TASK_ERRORS
+
+
+def test_backoff_is_capped():
+    scheduler = Scheduler()
+    task = scheduler.add("failing", failing, 1000)
+    for _ in range(MAX_TASK_ERRORS + 20):
+        scheduler._failed(task, ValueError("i2c"))
+    assert task.backoff_us == MAX_BACKOFF_US
+
+
+def test_task_runs_at_its_rate_after_recovering():
+    scheduler = Scheduler()
+    runs = [0]
+
+    def recovering():
+        runs[0] += 1
+        if runs[0] <= MAX_TASK_ERRORS + 2:
+            raise OSError(19)
+
+    scheduler.add("recovering", recovering, 1000)
+    run_for(scheduler, 40)
+    stats = scheduler.stats()["recovering"]
+    assert stats["errors"] == MAX_TASK_ERRORS + 2
+    assert stats["backoff_us"] == 0
+    assert runs[0] > MAX_TASK_ERRORS + 10
@@ -0,0 +1,49 @@
+import asyncio
+
+from libs.websockets.ws_server import WebSocketServer
+
+
+class HttpWriter:
+    def __init__(self):
+        self.data = bytearray()
+        self.closed = False
+
+    def get_extra_info(self, name):
+        return ("127.0.0.1", 50000)
+
+    def write(self, data):
+        self.data.extend(data)
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+def get(server: WebSocketServer, path: str):
+    async def run():
+        reader = asyncio.StreamReader()
+        reader.feed_data(f"GET {path} HTTP/1.1\r\nHost: robot\r\n\r\n".encode())
+        reader.feed_eof()
+        writer = HttpWriter()
+        await server._accept_conn(reader, writer)
+        return writer
+
+    writer = asyncio.run(run())
+    assert writer.closed
+    return bytes(writer.data)
+
+
+def test_without_static_dir_answers_404():
+    response = get(WebSocketServer(None), "/")
+    assert response.startswith(b"HTTP/1.1 404 Not Found\r\n")
+
+
+def test_static_dir_serves_files(tmp_path):
+    (tmp_path / "index.html").write_bytes(b"<html></html>")
+    server = WebSocketServer(str(tmp_path))
+    response = get(server, "/")
+    assert response.startswith(b"HTTP/1.1 200 OK\r\n")
+    assert response.endswith(b"\r\n\r\n<html></html>")
+    assert get(server, "/missing.js").startswith(b"HTTP/1.1 404 Not Found\r\n")
@@ -0,0 +1,87 @@
+"""
+Convert a JSON keyframe animation into the binary format streamed from flash
+by core.animation.AnimationPlayer.
+
+The JSON file holds the frame rate and keyframes in the play_motion format:
+
+    {
+        "fps": 50,
+        "keyframes": [
+            {"time": 0, "joints": {"head": 90}},
+            {"time": 500, "joints": {"head": 30}, "easing": "ease_in_out"}
+        ]
+    }
+
+An optional "joints" list fixes the column order, by default every joint used
+by a keyframe gets a column in order of first use.
+
+Usage: python tools/anim_convert.py wave.json src/animations/wave.anim
+"""
+import json
+import os
+import struct
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from core.keyframes import (  # noqa: E402
+    ANIMATION_MAGIC,
+    ANIMATION_VERSION,
+    ANIMATION_HEADER,
+    sample_keyframes,
+)
+
+
+def joint_names_from_keyframes(keyframes: list):
+    names = []
+    for keyframe in keyframes:
+        for name in keyframe.get("joints", {}):
+            if name not in names:
+                names.append(name)
+    return names
+
+
+def convert(animation: dict, out_file):
+    fps = int(animation.get("fps", 50))
+    keyframes = animation.get("keyframes", [])
+    joint_names = animation.get("joints", None) or joint_names_from_keyframes(
+        keyframes
+    )
+    if len(joint_names) > 255:
+        raise ValueError("an animation is limited to 255 joints")
+
+    frames = list(sample_keyframes(keyframes, fps, joint_names))
+    out_file.write(
+        struct.pack(
+            ANIMATION_HEADER,
+            ANIMATION_MAGIC,
+            ANIMATION_VERSION,
+            len(joint_names),
+            fps,
+            len(frames),
+        )
+    )
+    for name in joint_names:
+        encoded = name.encode("utf-8")
+        out_file.write(struct.pack("<B", len(encoded)))
+        out_file.write(encoded)
+    frame_format = "<%dh" % len(joint_names)
+    for angles in frames:
+        out_file.write(struct.pack(frame_format, *angles))
+    return len(frames)
+
+
+def main(argv):
+    if len(argv) != 3:
+        print(__doc__)
+        return 1
+    with open(argv[1]) as json_file:
+        animation = json.load(json_file)
+    with open(argv[2], "wb") as out_file:
+        frame_count = convert(animation, out_file)
+    print(f"wrote {frame_count} frames to {argv[2]}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
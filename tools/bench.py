@@ -0,0 +1,126 @@
+"""
+Run the benchmark suite against the simulated hardware and compare results.
+
+    python tools/bench.py run [--robot NAME] [--iterations N] [--out FILE]
+    python tools/bench.py compare BASELINE RESULTS [--threshold PERCENT]
+
+run prints the results as JSON, or writes them to --out. compare reports every
+metric that got worse by more than the threshold and exits with status 1 if
+there is one. Results captured from a board with ``bench.main()`` can be
+compared too, the last JSON line of the capture is used.
+
+Metrics ending in _per_s are better when higher, all others when lower.
+"""
+import argparse
+import contextlib
+import json
+import os
+import sys
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+
+def run(robot: str, iterations: int):
+    sys.path.insert(0, SRC)
+    # The configs are loaded relative to src, like on the board
+    os.chdir(SRC)
+
+    import sim
+
+    sim.install()
+    from bench import run as run_suite
+    from core.framework import EXAMPLE_CONFIG_PATH
+
+    # Keep the driver output out of the JSON. The host has no config.json of
+    # a board, the framework runs with the example config.
+    with contextlib.redirect_stdout(sys.stderr):
+        return run_suite(robot, iterations, EXAMPLE_CONFIG_PATH)
+
+
+def load_results(path: str):
+    with open(path) as results_file:
+        text = results_file.read()
+    try:
+        return json.loads(text)
+    except ValueError:
+        pass
+    # A capture of the board console, the results are the last JSON line
+    lines = [line for line in text.splitlines() if line.startswith("{")]
+    if not lines:
+        raise ValueError(f"no results in {path}")
+    return json.loads(lines[-1])
+
+
+def higher_is_better(metric: str):
+    return metric.endswith("_per_s")
+
+
+def compare(baseline: dict, results: dict, threshold: float):
+    """Returns a (benchmark, metric, baseline, result, change %) row for every
+    metric in both results, and the rows that regressed"""
+    rows = []
+    regressions = []
+    for name, metrics in sorted(results["results"].items()):
+        base_metrics = baseline["results"].get(name, {})
+        for metric, value in sorted(metrics.items()):
+            base = base_metrics.get(metric, None)
+            if value is None or base is None:
+                continue
+            if base == 0:
+                change = 0.0 if value == 0 else float("inf")
+            else:
+                change = (value - base) * 100 / abs(base)
+            row = (name, metric, base, value, change)
+            rows.append(row)
+            worse = -change if higher_is_better(metric) else change
+            if worse > threshold:
+                regressions.append(row)
+    return rows, regressions
+
+
+def format_row(row):
+    name, metric, base, value, change = row
+    return f"{name:24} {metric:26} {base:>12.1f} {value:>12.1f} {change:>+8.1f}%"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run")
+    run_parser.add_argument("--robot", default="21-dof-humanoid")
+    run_parser.add_argument("--iterations", type=int, default=200)
+    run_parser.add_argument("--out")
+
+    compare_parser = commands.add_parser("compare")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("results")
+    compare_parser.add_argument("--threshold", type=float, default=10.0)
+
+    args = parser.parse_args(argv)
+
+    if args.command == "run":
+        out = os.path.abspath(args.out) if args.out else None
+        results = json.dumps(run(args.robot, args.iterations), indent=2)
+        if out:
+            with open(out, "w") as out_file:
+                out_file.write(results + "\n")
+        else:
+            print(results)
+        return 0
+
+    rows, regressions = compare(
+        load_results(args.baseline), load_results(args.results), args.threshold
+    )
+    for row in rows:
+        print(format_row(row))
+    if regressions:
+        print(f"\n{len(regressions)} regressions over {args.threshold}%:")
+        for row in regressions:
+            print(format_row(row))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
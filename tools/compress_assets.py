@@ -0,0 +1,49 @@
+"""
+Write a gzip compressed copy next to every file of the static asset directory,
+the board serves <file>.gz to browsers that accept gzip. A copy that is not
+smaller than its file is left out.
+
+Usage: python tools/compress_assets.py [src/www]
+"""
+import gzip
+import os
+import sys
+
+DEFAULT_DIR = os.path.join(os.path.dirname(__file__), "..", "src", "www")
+
+
+def compress(path: str):
+    """Write path.gz, returns its size or None when it is not smaller"""
+    with open(path, "rb") as asset_file:
+        data = asset_file.read()
+    # mtime 0 keeps the output the same for the same input
+    compressed = gzip.compress(data, compresslevel=9, mtime=0)
+    if len(compressed) >= len(data):
+        if os.path.exists(path + ".gz"):
+            os.remove(path + ".gz")
+        return None
+    with open(path + ".gz", "wb") as out_file:
+        out_file.write(compressed)
+    return len(compressed)
+
+
+def main(argv):
+    if len(argv) > 2:
+        print(__doc__)
+        return 1
+    root = argv[1] if len(argv) == 2 else DEFAULT_DIR
+    for directory, _, files in os.walk(root):
+        for name in sorted(files):
+            if name.endswith(".gz"):
+                continue
+            path = os.path.join(directory, name)
+            size = compress(path)
+            if size is None:
+                print(f"{path}: not compressed")
+            else:
+                print(f"{path}: {os.path.getsize(path)} -> {size} bytes")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))